@@ -5,8 +5,12 @@ import argparse
 import collections
 import functools
 import gzip
+import json
 import os
+import uuid
+import numpy as np
 from singlecellmultiomics.utils import Prefetcher
+from singlecellmultiomics.bamProcessing.bamFunctions import get_aligned_pairs_array
 
 def get_allele_dict():
     return collections.defaultdict(nested_set_defaultdict)
@@ -15,6 +19,137 @@ def nested_set_defaultdict():
 def set_defaultdict():
     return collections.defaultdict (set)
 
+
+ALLELE_INDEX_MAGIC = b'SCMOALI1'
+ALLELE_INDEX_BASES = 'ACGTN'
+# ASCII code -> column in AlleleIndex.codes, -1 for bases which are not indexed
+_ALLELE_INDEX_BASE_CODES = np.full(256, -1, dtype=np.int64)
+for _column, _base in enumerate(ALLELE_INDEX_BASES):
+    _ALLELE_INDEX_BASE_CODES[ord(_base)] = _column
+
+
+class AlleleIndex():
+    """Array based index of the alleles of the variants of a single contig.
+
+    The positions of the variants are stored as sorted array, for every position the haplotype set of every base
+    is stored as integer code in a (positions x ALLELE_INDEX_BASES) matrix. The codes refer to
+    haplotype_sets, code 0 means no haplotype is associated with the base.
+    Lookups are binary searches, and the index can be written to a file which is memory mapped when loaded.
+
+    Example:
+        >>> index = AlleleIndex.from_dict({100: {'A': {'SAMPLE_A'}, 'T': {'SAMPLE_B'}}})
+        >>> index.get_alleles_at(100, 'T')
+        {'SAMPLE_B'}
+        >>> index.slice(0, 50).positions
+        array([], dtype=int64)
+    """
+
+    def __init__(self, positions, codes, haplotype_sets):
+        """Initialise AlleleIndex
+
+        Args:
+            positions (np.array) : sorted (zero based) positions of the variants
+            codes (np.array) : (positions x ALLELE_INDEX_BASES) matrix of haplotype set codes
+            haplotype_sets (list) : set of haplotypes for every code, the first element is None
+        """
+        self.positions = positions
+        self.codes = codes
+        self.haplotype_sets = haplotype_sets
+
+    def __len__(self):
+        return len(self.positions)
+
+    @classmethod
+    def from_dict(cls, position_to_alleles):
+        """Create an index from a position -> base -> haplotypes dictionary (AlleleResolver.locationToAllele[chrom])"""
+        positions = np.array(sorted(position_to_alleles), dtype=np.int64)
+        haplotype_sets = [None]
+        set_codes = {}
+        codes = np.zeros((len(positions), len(ALLELE_INDEX_BASES)), dtype=np.int64)
+        for row, position in enumerate(positions.tolist()):
+            for base, haplotypes in position_to_alleles[position].items():
+                if len(base) != 1 or _ALLELE_INDEX_BASE_CODES[ord(base[0]) & 0xff] == -1 or len(haplotypes) == 0:
+                    continue
+                key = tuple(sorted(haplotypes))
+                if key not in set_codes:
+                    set_codes[key] = len(haplotype_sets)
+                    haplotype_sets.append(set(key))
+                codes[row, _ALLELE_INDEX_BASE_CODES[ord(base)]] = set_codes[key]
+        return cls(positions, codes.astype(np.min_scalar_type(len(haplotype_sets))), haplotype_sets)
+
+    def slice(self, start=None, end=None):
+        """Obtain an index of the variants between start and end (inclusive), the slice is copied to memory"""
+        lower = 0 if start is None else np.searchsorted(self.positions, start, 'left')
+        upper = len(self.positions) if end is None else np.searchsorted(self.positions, end, 'right')
+        return AlleleIndex(np.array(self.positions[lower:upper]), np.array(self.codes[lower:upper]),
+                           self.haplotype_sets)
+
+    def get_codes(self, positions, bases):
+        """Obtain the haplotype set codes of many (position, base) pairs at once
+
+        Args:
+            positions (np.array) : zero based positions
+            bases (np.array) : ASCII codes (uint8) of the bases
+
+        Returns:
+            codes (np.array) : haplotype set code for every pair, 0 when no haplotype is associated
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        result = np.zeros(len(positions), dtype=np.int64)
+        if len(self.positions) == 0 or len(positions) == 0:
+            return result
+        rows = np.minimum(np.searchsorted(self.positions, positions), len(self.positions) - 1)
+        columns = _ALLELE_INDEX_BASE_CODES[bases]
+        hit = (self.positions[rows] == positions) & (columns >= 0)
+        result[hit] = self.codes[rows[hit], columns[hit]]
+        return result
+
+    def get_alleles_at(self, position, base):
+        """Obtain the set of haplotypes associated with base at position, None when there is no such variant"""
+        row = np.searchsorted(self.positions, position)
+        if row == len(self.positions) or self.positions[row] != position or len(base) != 1:
+            return None
+        column = _ALLELE_INDEX_BASE_CODES[ord(base) & 0xff]
+        if column == -1:
+            return None
+        return self.haplotype_sets[self.codes[row, column]]
+
+    def write(self, path):
+        """Write the index to path, the file can be loaded using AlleleIndex.load"""
+        meta = json.dumps({
+            'size': len(self.positions),
+            'code_dtype': np.dtype(self.codes.dtype).str,
+            'haplotype_sets': [sorted(haplotypes) for haplotypes in self.haplotype_sets[1:]]
+        }).encode()
+        with open(path, 'wb') as f:
+            f.write(ALLELE_INDEX_MAGIC)
+            f.write(np.uint64(len(meta)).tobytes())
+            f.write(meta)
+            f.write(b'\0' * (-f.tell() % 8))
+            f.write(np.ascontiguousarray(self.positions, dtype=np.int64).tobytes())
+            f.write(np.ascontiguousarray(self.codes).tobytes())
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by AlleleIndex.write, the arrays are memory mapped"""
+        with open(path, 'rb') as f:
+            if f.read(len(ALLELE_INDEX_MAGIC)) != ALLELE_INDEX_MAGIC:
+                raise ValueError(f'{path} is not an allele index')
+            meta_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            meta = json.loads(f.read(meta_size).decode())
+        offset = len(ALLELE_INDEX_MAGIC) + 8 + meta_size
+        offset += -offset % 8
+        size = meta['size']
+        code_dtype = np.dtype(meta['code_dtype'])
+        if size == 0:
+            positions = np.zeros(0, dtype=np.int64)
+            codes = np.zeros((0, len(ALLELE_INDEX_BASES)), dtype=code_dtype)
+        else:
+            positions = np.memmap(path, dtype=np.int64, mode='r', offset=offset, shape=(size,))
+            codes = np.memmap(path, dtype=code_dtype, mode='r', offset=offset + size * 8,
+                              shape=(size, len(ALLELE_INDEX_BASES)))
+        return cls(positions, codes, [None] + [set(haplotypes) for haplotypes in meta['haplotype_sets']])
+
 class AlleleResolver(Prefetcher):
 
     def clean_vcf_name(self, vcffile):
@@ -75,11 +210,13 @@ class AlleleResolver(Prefetcher):
         self.phased = phased
         self.verbose = verbose
         self.locationToAllele = get_allele_dict()  # chrom -> pos-> base -> sample(s)
+        self.allele_indices = {}  # chrom -> AlleleIndex
         self.select_samples = select_samples
         self.region_start = region_start
         self.region_end = region_end
 
         self.lazyLoad = lazyLoad
+        self.uglyMode = uglyMode
 
         if vcffile is None:
             return
@@ -104,6 +241,7 @@ class AlleleResolver(Prefetcher):
                 raise NotImplementedError(
                     "Sample selection is not implemented for non proper VCF")
             lazyLoad = False
+        self.uglyMode = uglyMode
 
         # collections.defaultdict(set) ) #(chrom, pos)-> base -> sample(s)
 
@@ -147,56 +285,60 @@ class AlleleResolver(Prefetcher):
 
             chrom (str):  contig/chromosome to write cache file for (every contig has it's own cache)
         """
-        temp_path = path + '.unfinished'
-        with gzip.open(temp_path, 'wt') as f:
-            for position in sorted(list(self.locationToAllele[chrom].keys())):
-                for base in self.locationToAllele[chrom][position]:
-                    f.write(
-                        f'{position}\t{base}\t{",".join(sorted(list(self.locationToAllele[chrom][position][base])))}\n')
-        os.rename(temp_path, path)
+        # Write to a temporary file first, other processes can be reading or writing the same cache file
+        temp_path = f'{path}.{uuid.uuid4()}.unfinished'
+        self.allele_indices[chrom].write(temp_path)
+        os.replace(temp_path, path)
 
     def read_cached(self, path, chrom):
-        """Read cache file
+        """Read cache file, only the variants between region_start and region_end are kept
 
         Args:
             path (str):  path of the cache file
             chrom (str):  contig/chromosome
         """
-        with gzip.open(path, 'rt') as f:
-            for line in f:
-                position, base, samples = line.strip().split('\t', 3)
-                position = int(position)
-                if self.region_start is not None and position<self.region_start:
-                    continue
-                if self.region_end is not None and position>self.region_end:
-                    break
-
-                self.locationToAllele[chrom][position][base] = set(samples.split(','))
-
-
+        index = AlleleIndex.load(path)
+        if self.region_start is not None or self.region_end is not None:
+            index = index.slice(self.region_start, self.region_end)
+        self.allele_indices[chrom] = index
 
     def instance(self, arg_update):
         if 'self' in self.args:
             del self.args['self']
-        clone = AlleleResolver(**self.args)
+        args = self.args.copy()
+        args.update(arg_update)
+        clone = AlleleResolver(**args)
         return clone
 
 
     def prefetch(self, contig, start, end):
+        """Obtain a resolver which only holds the variants of contig between start and end
+
+        Variants of other contigs are loaded on demand by the returned resolver
+        """
+        if getattr(self, 'vcffile', None) is None or self.uglyMode:
+            # The variants cannot be fetched per region
+            return self
 
-        clone = self.instance({'region_start':start, 'region_end':end})
+        clone = self.instance({'region_start':start, 'region_end':end, 'lazyLoad':True})
 
         #print(f'Prefetching {contig}:{start}-{end}')
         try:
-            self.fetchChromosome(self.vcffile, contig, True)
+            clone.fetchChromosome(self.vcffile, contig, True)
         except ValueError:
             # This means the chromosome is not available
             pass
         return clone
 
+    def _index_contigs(self):
+        """Move the variants of the loaded contigs from locationToAllele to AlleleIndex objects"""
+        for chrom in list(self.locationToAllele):
+            self.allele_indices[chrom] = AlleleIndex.from_dict(self.locationToAllele.pop(chrom))
+
     def fetchChromosome(self, vcffile, chrom, clear=False):
         if clear:
             self.locationToAllele = get_allele_dict()  # chrom -> pos-> base -> sample(s)
+            self.allele_indices = {}
 
         vcffile = self.clean_vcf_name(vcffile)
         # allocate:
@@ -218,7 +360,7 @@ class AlleleResolver(Prefetcher):
             if self.select_samples is not None:
                 sample_list_id = '-'.join(sorted(list(self.select_samples)))
                 cache_file_name = cache_file_name + '_' + sample_list_id
-            cache_file_name += '.tsv.gz'
+            cache_file_name += '.alleles'
             if os.path.exists(cache_file_name):
                 if self.verbose:
                     print(f"Cached file exists at {cache_file_name}")
@@ -234,9 +376,11 @@ class AlleleResolver(Prefetcher):
         added = 0
         if self.verbose:
             print(f'Reading variants for {chrom} ', end='')
+        # The cache file contains all variants of the contig
+        fetch_start, fetch_end = (None, None) if write_cache_file_flag else (self.region_start, self.region_end)
         with pysam.VariantFile(vcffile) as v:
             try:
-                for rec in v.fetch(chrom, start=self.region_start, stop=self.region_end):
+                for rec in v.fetch(chrom, start=fetch_start, stop=fetch_end):
                     used = False
                     bad = False
                     bases_to_alleles = collections.defaultdict(
@@ -307,6 +451,7 @@ class AlleleResolver(Prefetcher):
         #del unTrusted
         if self.verbose:
             print(f'{added} variants [OK]')
+        self._index_contigs()
         if self.use_cache and write_cache_file_flag:
             if self.verbose:
                 print("writing cache file")
@@ -316,6 +461,8 @@ class AlleleResolver(Prefetcher):
                 if self.verbose:
                     print(f"Exception writing cache: {e}")
                 pass  # @todo
+            if self.region_start is not None or self.region_end is not None:
+                self.allele_indices[chrom] = self.allele_indices[chrom].slice(self.region_start, self.region_end)
 
     def getAllele(self, reads):
         alleles = set()
@@ -323,30 +470,47 @@ class AlleleResolver(Prefetcher):
             if read is None or read.is_unmapped:
                 continue
             chrom = read.reference_name
-            for readPos, refPos in read.get_aligned_pairs(matches_only=True):
-                readBase = read.query_sequence[readPos]
-                c = self.getAllelesAt(chrom, refPos, readBase)
+            self._lazy_load(chrom)
+            index = self.allele_indices.get(chrom)
+            if index is None or chrom in self.locationToAllele:
+                # Variants which are not indexed are looked up one by one
+                for readPos, refPos in read.get_aligned_pairs(matches_only=True):
+                    readBase = read.query_sequence[readPos]
+                    c = self.getAllelesAt(chrom, refPos, readBase)
+                    if c is not None and len(c) == 1:
+                        alleles.update(c)
+                continue
+
+            # Look up all aligned bases of the read at once
+            query_positions, reference_positions = get_aligned_pairs_array(read)
+            bases = np.frombuffer(read.query_sequence.encode(), dtype=np.uint8)[query_positions]
+            for code in np.unique(index.get_codes(reference_positions, bases)).tolist():
+                c = index.haplotype_sets[code]
                 if c is not None and len(c) == 1:
                     alleles.update(c)
         return alleles
 
     # @functools.lru_cache(maxsize=1000) not necessary anymore... complete data is already saved in dict
 
-    def getAllelesAt(self, chrom, pos, base):
-        if self.lazyLoad and chrom not in self.locationToAllele:
+    def _lazy_load(self, chrom):
+        if self.lazyLoad and chrom not in self.locationToAllele and chrom not in self.allele_indices:
             try:
                 self.fetchChromosome(self.vcffile, chrom, clear=True)
             except Exception as e:
                 print(e)
                 pass
 
-        if chrom not in self.locationToAllele or pos not in self.locationToAllele[chrom]:
-            return None
+    def getAllelesAt(self, chrom, pos, base):
+        self._lazy_load(chrom)
 
-        if base not in self.locationToAllele[chrom][pos]:
-            return None
+        if chrom in self.locationToAllele and pos in self.locationToAllele[chrom]:
+            if base not in self.locationToAllele[chrom][pos]:
+                return None
+            return self.locationToAllele[chrom][pos][base]
 
-        return self.locationToAllele[chrom][pos][base]
+        if chrom in self.allele_indices:
+            return self.allele_indices[chrom].get_alleles_at(pos, base)
+        return None
 
 # FWD_-13_C REV_-16_C
 # FWD_-16_C REV_+12_C
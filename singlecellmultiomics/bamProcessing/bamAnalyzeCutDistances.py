@@ -8,6 +8,7 @@ from scipy.optimize import curve_fit
 import argparse
 from singlecellmultiomics.bamProcessing.bamFunctions import get_contigs_with_reads, get_r1_counts_per_cell
 from singlecellmultiomics.bamProcessing.bamBinCounts import merge_overlapping_ranges
+from singlecellmultiomics.bamProcessing.moleculeSummary import MoleculeSummary
 from collections import Counter, defaultdict
 import numpy as np
 import seaborn as sns
@@ -54,7 +55,10 @@ def get_sc_cut_dictionary(bam_path: str, filter_function=None, strand_specific=F
     """
     Generates cut distribution dictionary  (contig)->sample->position->obs
 
+    The bam_path can also point to a molecule summary folder written by bamtagmultiome (-molecule_summary),
+    the dictionary is then obtained from the summary (only for the default filter_function and without regions)
     """
+    use_summary = filter_function is None
     if filter_function is None:
         filter_function = read_counts_function
     cut_sites = {}
@@ -64,6 +68,19 @@ def get_sc_cut_dictionary(bam_path: str, filter_function=None, strand_specific=F
     else:
         bam_paths=bam_path
 
+    if any(MoleculeSummary.is_summary(path) for path in bam_paths):
+        if not use_summary or regions is not None:
+            raise ValueError('A molecule summary can only be used without filter_function and regions')
+        for path in bam_paths:
+            prefix = path.rstrip('/').split('/')[-1].replace('.bam','') if prefix_with_bam else None
+            for contig, r in MoleculeSummary(path).get_cut_dictionary(strand_specific=strand_specific,
+                                                                      prefix=prefix).items():
+                if not contig in cut_sites:
+                    cut_sites[contig]=r
+                else:
+                    for sample, positions in r.items():
+                        cut_sites[contig][sample].update(positions)
+        return cut_sites
 
 
 
@@ -8,13 +8,15 @@ import pickle
 import gzip
 import pandas as pd
 import multiprocessing
+import collections
+from array import array
 from singlecellmultiomics.bamProcessing import get_contig_sizes, get_contig_size
 from statsmodels.nonparametric.smoothers_lowess import lowess
 from datetime import datetime
 from itertools import chain
 from more_itertools import windowed
 from typing import Generator
-from singlecellmultiomics.methylation import MethylationCountMatrix
+from singlecellmultiomics.methylation import SparseMethylationCountMatrix
 from pysamiterators import CachedFasta
 from pysam import FastaFile
 from singlecellmultiomics.utils import reverse_complement
@@ -263,9 +265,67 @@ def obtain_approximate_reference_cut_position(site: int, contig: str, alt_spans:
     return contig, site + alt_start
 
 
+BinCountBlock = collections.namedtuple('BinCountBlock', 'bin_ids samples counts')
+BinCountBlock.__doc__ = """Fragment counts of a single job: counts is a dense (bins x samples) matrix,
+the rows are labeled by bin_ids and the columns by samples"""
+
+
+def bin_count_block_from_dict(counts: dict) -> BinCountBlock:
+    """Convert a counts[bin_id][sample] = obs dictionary to a BinCountBlock"""
+    samples = {}
+    rows, columns, values = [], [], []
+    for row, sample_dict in enumerate(counts.values()):
+        for sample, value in sample_dict.items():
+            rows.append(row)
+            columns.append(samples.setdefault(sample, len(samples)))
+            values.append(value)
+    matrix = np.zeros((len(counts), len(samples)), dtype=np.int64)
+    matrix[rows, columns] = values
+    return BinCountBlock(list(counts), list(samples), matrix)
+
+
+def bin_count_blocks_to_frame(blocks, samples: dict) -> pd.DataFrame:
+    """Combine BinCountBlocks into a single (bins x samples) DataFrame
+
+    Args:
+        blocks (list) : list of (bin_ids, sample column indices, counts) tuples, the column indices refer to samples
+        samples (dict) : sample -> column index
+
+    Returns:
+        frame (pd.DataFrame) : counts, identical to pd.DataFrame(counts).T of a counts[bin_id][sample] dictionary,
+            bins without counts for a sample are NaN
+    """
+    bin_rows = {}
+    rows = []
+    for bin_ids, _, _ in blocks:
+        rows.append(np.fromiter((bin_rows.setdefault(bin_id, len(bin_rows)) for bin_id in bin_ids),
+                                dtype=np.int64, count=len(bin_ids)))
+
+    matrix = np.zeros((len(bin_rows), len(samples)), dtype=np.int64)
+    for block_rows, (_, columns, counts) in zip(rows, blocks):
+        # Bins can be counted in multiple blocks when multiple alignment files are supplied
+        matrix[np.ix_(block_rows, columns)] += counts
+
+    frame = pd.DataFrame(np.where(matrix > 0, matrix, np.nan),
+                         index=pd.MultiIndex.from_tuples(list(bin_rows)) if len(bin_rows) else None,
+                         columns=list(samples))
+    return frame
+
+
 def obtain_counts(commands, reference, live_update=True, show_n_cells=4, update_interval=3, threads=4, count_function=None):
+    """Count fragments in bins using multiple processes
+
+    Args:
+        commands (iterable) : jobs generated by generate_commands
+        reference : reference handle, used for the live update plots
+        count_function : function which executes a job, should return a BinCountBlock or a
+            counts[bin_id][sample] = obs dictionary. Defaults to count_fragments_binned_block
+
+    Returns:
+        counts (pd.DataFrame) : (bins x samples) frame, bins without counts for a sample are NaN
+    """
     if count_function is None:
-        count_function = count_fragments_binned
+        count_function = count_fragments_binned_block
 
     if live_update:
         from singlecellmultiomics.utils.plotting import GenomicPlot
@@ -282,7 +342,9 @@ def obtain_counts(commands, reference, live_update=True, show_n_cells=4, update_
     # import random
     # random.shuffle(commands)
 
-    counts = {}
+    # The blocks of the finished jobs, the matrix is only assembled when required
+    samples = {}  # sample -> column index
+    blocks = []
 
     prev = None
 
@@ -296,23 +358,19 @@ def obtain_counts(commands, reference, live_update=True, show_n_cells=4, update_
 
         for i, result in enumerate(workers.imap_unordered(count_function,
                                                           commands)):
-            # Result is of the format: counts[bin_id][sample] = obs (int)
-            #counts.update(result)
-            for bin_id, sample_dict in result.items():
-                if not bin_id in counts:
-                    counts[bin_id] =  sample_dict
-                else:
-                    counts[bin_id].update(sample_dict)
-
-
+            if isinstance(result, dict):
+                result = bin_count_block_from_dict(result)
+            columns = np.fromiter((samples.setdefault(sample, len(samples)) for sample in result.samples),
+                                  dtype=np.int64, count=len(result.samples))
+            blocks.append((result.bin_ids, columns, result.counts))
 
             if live_update and update_method == 'partial_df':
                 if (datetime.now() - start_time).total_seconds() > 2 and (
                         prev is None or (datetime.now() - prev).total_seconds() >= update_interval):
-                    if len(result) == 0:
+                    if len(result.bin_ids) == 0:
                         continue
 
-                    df = pd.DataFrame(counts).T
+                    df = bin_count_blocks_to_frame(blocks, samples)
                     if df.sum().sum() == 0:
                         continue
                     prev = datetime.now()
@@ -323,7 +381,7 @@ def obtain_counts(commands, reference, live_update=True, show_n_cells=4, update_
                     df = df[top_cells.index].fillna(0)
                     df = np.clip(0, 2, df / np.percentile(df, 99, axis=0))
 
-                    for contig in [list(result.keys())[0][0]]:
+                    for contig in [result.bin_ids[0][0]]:
                         x = np.array([(stop + start) / 2 for start, stop in df.loc[contig].index.values])
 
                         for cell_index, (cell, row) in enumerate(df.loc[contig].T.iterrows()):
@@ -335,10 +393,10 @@ def obtain_counts(commands, reference, live_update=True, show_n_cells=4, update_
                             fig.canvas.draw()
                     plt.pause(0.001)
 
+    counts = bin_count_blocks_to_frame(blocks, samples)
     # Show final result
     if live_update:
-        df = pd.DataFrame(counts).T
-        df = df[top_cells.index].fillna(0)
+        df = counts[top_cells.index].fillna(0)
         df = np.clip(0, 2, df / np.percentile(df, 99, axis=0))
 
         for contig in cell_plots[0]['plot'].contigs:
@@ -510,7 +568,7 @@ def count_methylation_binned(args):
 
     min_counts_per_bin = kwargs.get('min_counts_per_bin',10) # Min measurements across all cells
     # Cant use defaultdict because of pickles :\
-    met_counts = MethylationCountMatrix(threads=kwargs.get('threads', None))  # Sample->(contig,bin_start,bin_end)-> [methylated_counts, unmethylated]
+    met_counts = SparseMethylationCountMatrix()  # Sample->(contig,bin_start,bin_end)-> [methylated_counts, unmethylated]
 
     # Define which reads we want to count:
     known =  set()
@@ -653,7 +711,7 @@ def count_methylation_binned(args):
 
 
                 if final_call is not None:
-                    met_counts[sample, bin_id][final_call]+=1
+                    met_counts.add(sample, bin_id, final_call)
 
     met_counts.prune(min_samples=kwargs.get('min_samples',0), min_variance=kwargs.get('min_variance',0))
     if reference is not None:
@@ -662,12 +720,12 @@ def count_methylation_binned(args):
     return met_counts
 
 
-def count_fragments_binned(args):
+def iter_fragments_binned(args):
+    """Obtain the (bin_id, sample) of every fragment counted by a job generated by generate_commands"""
     (alignments_path, bin_size, max_fragment_size, \
      contig, start, end, \
      min_mq, alt_spans, key_tags, dedup, kwargs) = args
 
-    counts = {}  # Sample->(contig,bin_start,bin_end)->counts
     # Define which reads we want to count:
 
     p = 0
@@ -714,18 +772,44 @@ def count_fragments_binned(args):
             else:
                 bin_id = (contig, bin_start, bin_end)
 
-            # Add a (single) count tot the dictionary:
-            if not bin_id in counts:
-                counts[bin_id] = {}
+            yield bin_id, sample
 
-            if not sample in counts[bin_id]:
-                counts[bin_id][sample] = 1
-            else:
-                counts[bin_id][sample] += 1
+
+def count_fragments_binned(args):
+    counts = {}  # (contig,bin_start,bin_end)->Sample->counts
+    for bin_id, sample in iter_fragments_binned(args):
+        # Add a (single) count tot the dictionary:
+        if not bin_id in counts:
+            counts[bin_id] = {}
+
+        if not sample in counts[bin_id]:
+            counts[bin_id][sample] = 1
+        else:
+            counts[bin_id][sample] += 1
 
     return counts
 
 
+def count_fragments_binned_block(args) -> BinCountBlock:
+    """Count the fragments of a job generated by generate_commands
+
+    Returns:
+        block (BinCountBlock) : the counts as dense matrix, which is much cheaper to transfer between processes
+            than the dictionary returned by count_fragments_binned
+    """
+    bins, samples = {}, {}
+    rows, columns = array('q'), array('q')
+    for bin_id, sample in iter_fragments_binned(args):
+        rows.append(bins.setdefault(bin_id, len(bins)))
+        columns.append(samples.setdefault(sample, len(samples)))
+
+    shape = (len(bins), len(samples))
+    counts = np.bincount(
+        np.ravel_multi_index((np.frombuffer(rows, dtype=np.int64), np.frombuffer(columns, dtype=np.int64)), shape),
+        minlength=shape[0] * shape[1]).reshape(shape)
+    return BinCountBlock(list(bins), list(samples), counts)
+
+
 def count_fragments_binned_wrap(args):
     (alignments_path, bin_size, max_fragment_size, \
      contig, start, end, \
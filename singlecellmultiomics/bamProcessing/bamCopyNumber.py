@@ -607,7 +607,7 @@ if __name__ == '__main__':
 
     if histplot is not None:
         print("Creating molecule histogram ... ",end="")
-        df = pd.DataFrame(counts).T.fillna(0)
+        df = counts.fillna(0)
         fig, ax = plt.subplots()
         cell_sums = df.sum()
         cell_sums.name = 'Frequency'
@@ -623,7 +623,7 @@ if __name__ == '__main__':
 
     # Convert the count dictionary to a dataframe
 
-    df = pd.DataFrame(counts).T.fillna(0)
+    df = counts.fillna(0)
 
     if df.shape[0]==0:
         raise ValueError('Resulting count matrix is empty. Is this file correctly tagged? Try adding the --ignore_mp flag')
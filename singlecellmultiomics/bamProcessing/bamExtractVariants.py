@@ -19,6 +19,7 @@ from collections import Counter
 import multiprocessing
 import pickle
 import gzip
+from bisect import bisect_left, bisect_right
 from contextlib import ExitStack
 
 class VariantWrapper:
@@ -94,8 +95,8 @@ def job_gen( induced_variants_path, germline_variants_path,
                 window_radius, MAX_REF_MOLECULES,max_buffer_size, debug_bam_folder)
 
 
-def get_molecule_base_calls(molecule, variant):
-    c = molecule.get_consensus(allow_unsafe=True)
+def get_molecule_base_calls(molecule, variant, consensus=None):
+    c = molecule.get_consensus(allow_unsafe=True) if consensus is None else consensus
 
     if not (variant.chrom, variant.pos-1) in c:
         return None
@@ -133,6 +134,228 @@ def filter_alt_calls(alt_phased: collections.Counter, threshold: float):
 
 
 
+def get_germline_allele_resolver(germline_variants_path, germline_variants_sample, contig, start, end):
+    """Obtain an unphased AlleleResolver containing the heterozygous germline variants in the supplied region"""
+    unphased_allele_resolver = singlecellmultiomics.alleleTools.AlleleResolver(
+        use_cache=False,
+        phased=False,
+        verbose = True)
+
+    if germline_variants_path is not None:
+        with pysam.VariantFile(germline_variants_path) as germline:
+            for i, ar_variant in enumerate(germline.fetch(
+                    contig, start, end )):
+
+                if germline_variants_sample is None:
+                    # If any of the samples is not heterozygous: continue
+                    if any( (ar_variant.samples[sample].alleles!=2 for sample in ar_variant.samples) ):
+                        continue
+                elif len(set(ar_variant.samples[germline_variants_sample].alleles))!=2:
+                    continue
+                unphased_allele_resolver.locationToAllele[ar_variant.chrom][ar_variant.pos - 1] = {
+                            ar_variant.alleles[0]: {'U'}, ar_variant.alleles[1]: {'V'}
+                            }
+    return unphased_allele_resolver
+
+
+def get_variant_clusters(variants, window_radius):
+    """Group variants of which the windows (position +/- window_radius) overlap
+
+    Args:
+        variants (list) : variants sorted by contig and position
+        window_radius (int) : radius of the window around every variant
+
+    Yields:
+        cluster (list) : variants on the same contig with overlapping windows
+    """
+    cluster = []
+    for variant in variants:
+        if len(cluster) and (cluster[-1].contig != variant.contig or
+                             variant.pos - window_radius > cluster[-1].pos + window_radius):
+            yield cluster
+            cluster = []
+        cluster.append(variant)
+    if len(cluster):
+        yield cluster
+
+
+def recall_variant_cluster(alignments, variants, unphased_allele_resolver, molecule_class, fragment_class,
+                           window_radius, max_ref_molecules, max_buffer_size, max_associated_fragments=40):
+    """Score all molecules overlapping a cluster of variants in a single pass
+
+    The molecules in the region spanned by the windows of the variants are assembled once.
+    Every molecule is scored against the variants it overlaps, these are found by a binary search
+    on the sorted variant positions.
+
+    Args:
+        alignments (pysam.AlignmentFile) : alignments to assemble the molecules from
+        variants (list) : variants on a single contig sorted by position, see get_variant_clusters
+        unphased_allele_resolver (AlleleResolver) : resolver containing the germline variants to phase with
+
+    Returns:
+        variant_calls (dict) : sample -> variant_key -> call (1: alt, 0: ref)
+        locations_done (set) : variant keys which were processed
+        phased_variants (dict) : variant_key -> germline variants phased to the alternative allele
+
+    Raises:
+        MemoryError : when the molecule buffer is exceeded
+    """
+    contig = variants[0].contig
+    positions = [variant.pos - 1 for variant in variants]
+    variant_keys = [(variant.contig, variant.pos, variant.ref, variant.alts[0]) for variant in variants]
+    alt_phased = [Counter() for variant in variants]
+    reference_called_molecules = [[] for variant in variants]  # (sample, phased) for every variant
+
+    variant_calls = dict()
+    phased_variants = dict()
+
+    molecule_iter = MoleculeIterator(
+        alignments,
+        molecule_class,
+        fragment_class,
+        contig=contig,
+        start=max(0, variants[0].pos - window_radius),
+        end=variants[-1].pos + window_radius,
+        molecule_class_args={
+           'allele_resolver':unphased_allele_resolver,
+            'max_associated_fragments':max_associated_fragments,
+        },
+        max_buffer_size=max_buffer_size
+    )
+
+    for molecule in molecule_iter:
+        if molecule.spanStart is None:
+            continue
+        # The variants overlapping the molecule
+        first = bisect_left(positions, molecule.spanStart)
+        last = bisect_right(positions, molecule.spanEnd)
+        if first == last:
+            continue
+
+        consensus = molecule.get_consensus(allow_unsafe=True)
+        phased = None
+        for variant_index in range(first, last):
+            variant = variants[variant_index]
+            base_call = get_molecule_base_calls(molecule, variant, consensus)
+            if base_call is None:
+                continue
+            base, quality = base_call
+            if base==variant.alts[0]:
+                call='A'
+                if molecule.sample not in variant_calls:
+                    variant_calls[molecule.sample] = {}
+                variant_calls[molecule.sample][variant_keys[variant_index]] = 1
+            elif base==variant.ref:
+                call='R'
+            else:
+                continue
+
+            # Obtain all germline variants which are phased :
+            if phased is None:
+                phased = get_phased_variants(molecule, unphased_allele_resolver)
+
+            if call == 'R' and len(phased) > 0:
+                # If we can phase the alternative allele to a germline variant
+                # the reference calls can indicate absence
+                if len(reference_called_molecules[variant_index]) < max_ref_molecules:
+                    reference_called_molecules[variant_index].append((molecule.sample, phased))
+            elif call == 'A':
+                for chrom, pos, base in phased:
+                    alt_phased[variant_index][(chrom, pos, base)] += 1
+
+    for variant_key, variant_alt_phased, variant_reference_called in zip(
+            variant_keys, alt_phased, reference_called_molecules):
+        if len(variant_alt_phased) > 0 and len(variant_reference_called):
+            # Clean the alt_phased variants for variants which are not >90% the same
+            alt_phased_filtered = filter_alt_calls(variant_alt_phased, 0.9)
+            phased_variants[variant_key] = alt_phased_filtered
+            for sample, phased_gsnvs in variant_reference_called:
+                if any(p in alt_phased_filtered for p in phased_gsnvs):
+                    if not sample in variant_calls:
+                        variant_calls[sample] = {}
+                    variant_calls[sample][variant_key] = 0
+
+    return variant_calls, set(variant_keys), phased_variants
+
+
+def recall_variants_sweep(args, max_associated_fragments=40, max_ref_molecules=5_000):
+    """Sweep-line version of recall_variants
+
+    Instead of assembling the molecules in the window of every variant separately, the variants are sorted and
+    the molecules of every cluster of variants with overlapping windows are assembled only once, and scored against
+    all variants they overlap. The germline variants are loaded once per contig.
+    Clusters for which the molecule buffer is exceeded are retried per variant.
+
+    Args:
+        args (tuple) : job generated by job_gen
+
+    Returns:
+        variant_calls (dict) : sample -> variant_key -> call (1: alt, 0: ref)
+        locations_done (set) : variant keys which were processed
+        phased_variants (dict) : variant_key -> germline variants phased to the alternative allele
+    """
+    variants, alignment_file_path, target_path, mode, germline_variants_path, germline_variants_sample, germline_bam_path, window_radius, MAX_REF_MOLECULES,max_buffer_size, debug_bam_folder = args
+
+    if debug_bam_folder is not None:
+        # The debug alignments are written per variant
+        return recall_variants(args)
+
+    window_radius = 600
+
+    if mode== 'NLA':
+        mc = NlaIIIMolecule
+        fc = NlaIIIFragment
+    else:
+        mc = Molecule
+        fc = Fragment
+
+    variant_calls = dict()
+    phased_variants = dict()
+    locations_done = set()
+
+    alignments = pysam.AlignmentFile(alignment_file_path,threads=4)
+    if germline_bam_path is not None:
+        with pysam.AlignmentFile(germline_bam_path,threads=4) as germline_alignments:
+            # Skip variants which are present in the germline bam file
+            variants = [variant for variant in variants
+                        if not has_variant_reads(germline_alignments, variant.chrom, variant.pos-1,
+                                                 variant.alts[0], min_reads=1, stepper='nofilter')]
+
+    variants = sorted(variants, key=lambda variant: (variant.contig, variant.pos))
+    for contig, contig_variants in itertools.groupby(variants, key=lambda variant: variant.contig):
+        contig_variants = list(contig_variants)
+        unphased_allele_resolver = get_germline_allele_resolver(
+            germline_variants_path, germline_variants_sample, contig,
+            max(0, contig_variants[0].pos - window_radius), contig_variants[-1].pos + window_radius)
+
+        for cluster in get_variant_clusters(contig_variants, window_radius):
+            # When the buffer is exceeded for a cluster of multiple variants, process its variants one by one
+            sub_clusters = (cluster, ) if len(cluster) == 1 else (cluster, *([variant] for variant in cluster))
+            for sub_cluster in sub_clusters:
+                try:
+                    cluster_calls, cluster_done, cluster_phased = recall_variant_cluster(
+                        alignments, sub_cluster, unphased_allele_resolver, mc, fc,
+                        window_radius=window_radius,
+                        max_ref_molecules=max_ref_molecules,
+                        max_buffer_size=max_buffer_size,
+                        max_associated_fragments=max_associated_fragments)
+                except MemoryError:
+                    if len(sub_cluster) == 1:
+                        print(f"Buffer exceeded for {sub_cluster[0].contig} {sub_cluster[0].pos}")
+                    continue
+                for sample, calls in cluster_calls.items():
+                    if sample not in variant_calls:
+                        variant_calls[sample] = {}
+                    variant_calls[sample].update(calls)
+                phased_variants.update(cluster_phased)
+                locations_done.update(cluster_done)
+                if sub_cluster is cluster:
+                    break
+
+    alignments.close()
+    return variant_calls, locations_done, phased_variants
+
+
 def recall_variants(args):
 
     variants, alignment_file_path, target_path, mode, germline_variants_path, germline_variants_sample, germline_bam_path, window_radius, MAX_REF_MOLECULES,max_buffer_size, debug_bam_folder = args
@@ -181,25 +404,8 @@ def recall_variants(args):
 
         #print(contig,reference_start,reference_end,variant.alts[0],variant.ref)
         ### Set up allele resolver
-        unphased_allele_resolver = singlecellmultiomics.alleleTools.AlleleResolver(
-            use_cache=False,
-            phased=False,
-            verbose = True)
-
-        if germline_variants_path is not None:
-            with pysam.VariantFile(germline_variants_path) as germline:
-                for i, ar_variant in enumerate(germline.fetch(
-                        variant.chrom, reference_start, reference_end )):
-
-                    if germline_variants_sample is None:
-                        # If any of the samples is not heterozygous: continue
-                        if any( (ar_variant.samples[sample].alleles!=2 for sample in ar_variant.samples) ):
-                            continue
-                    elif len(set(ar_variant.samples[germline_variants_sample].alleles))!=2:
-                        continue
-                    unphased_allele_resolver.locationToAllele[ar_variant.chrom][ar_variant.pos - 1] = {
-                                ar_variant.alleles[0]: {'U'}, ar_variant.alleles[1]: {'V'}
-                                }
+        unphased_allele_resolver = get_germline_allele_resolver(
+            germline_variants_path, germline_variants_sample, variant.chrom, reference_start, reference_end)
         ####
 
         ref_phased = Counter()
@@ -354,6 +560,7 @@ if __name__ == '__main__':
     argparser.add_argument('-t', type=int,default=8,help='Threads')
     argparser.add_argument('-minqual', type=float,help='Min variant quality to extract (from the -extract vcf file)')
     argparser.add_argument('-jobsize', type=int,default=5,help='Amount of variants being processed per Thread ')
+    argparser.add_argument('--sweep', action='store_true', help='Assemble the molecules of nearby variants only once, use a large -jobsize for the best performance')
 
     args = argparser.parse_args()
 
@@ -378,13 +585,14 @@ if __name__ == '__main__':
             debug_bam_folder=args.debug_bam_folder
             )
 
+    recall_function = recall_variants_sweep if args.sweep else recall_variants
     if args.t==1:
 
         def dummy_imap(func, args):
             for arg in args:
                 yield func(arg)
 
-        for i,(vc,done, alt_phased) in enumerate(dummy_imap(recall_variants, jobs )):
+        for i,(vc,done, alt_phased) in enumerate(dummy_imap(recall_function, jobs )):
 
             for cell, calls in vc.items():
                 variant_calls[cell].update(calls)
@@ -394,7 +602,7 @@ if __name__ == '__main__':
 
             print('Collecting variant calls')
             for i,(vc,done, alt_phased) in enumerate(
-                workers.imap_unordered(recall_variants,jobs)):
+                workers.imap_unordered(recall_function,jobs)):
 
                 for cell, calls in vc.items():
                     variant_calls[cell].update(calls)
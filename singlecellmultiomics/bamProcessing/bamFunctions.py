@@ -2,12 +2,17 @@ import os
 import pysam
 import time
 import contextlib
+import struct
+import zlib
+import heapq
+import re
 from shutil import which, move
 from singlecellmultiomics.utils import BlockZip, Prefetcher
 import uuid
 import os
 from collections import defaultdict, Counter
 from singlecellmultiomics.bamProcessing.pileup import pileup_truncated
+from singlecellmultiomics.bamProcessing.moleculeSummary import MoleculeSummary
 import numpy as np
 import pandas as pd
 from typing import Generator
@@ -51,7 +56,7 @@ def get_r1_counts_per_cell(bam_path, prefix_with_bam=False):
     """Obtain the amount of unique read1 reads per cell
 
     Args:
-        bam_path : str
+        bam_path : str, path to a bam file or to a molecule summary folder written by bamtagmultiome (-molecule_summary)
         prefix_with_bam(bool) : add bam name as prefix of cell name
     Returns:
         cell_obs (Counter) : {sampleA:n_molecules, sampleB:m_molecules, ...}
@@ -66,9 +71,12 @@ def get_r1_counts_per_cell(bam_path, prefix_with_bam=False):
     cell_obs = Counter()
     for bam_path in bam_paths:
         if prefix_with_bam:
-            prefix = bam_path.split('/')[-1].replace('.bam','')
+            prefix = bam_path.rstrip('/').split('/')[-1].replace('.bam','')
         else:
             prefix=None
+        if MoleculeSummary.is_summary(bam_path):
+            cell_obs += MoleculeSummary(bam_path).get_molecule_counts_per_cell(prefix=prefix)
+            continue
         with Pool() as workers:
             for cell_obs_for_contig in workers.imap_unordered(_get_r1_counts_per_cell,
                 (
@@ -106,6 +114,94 @@ def get_contigs_with_reads(bam_path: str, with_length: bool = False)  -> Generat
         except ValueError:
             pass
 
+def _read_bai_linear_index(index_path: str, virtual_offsets: bool = False) -> list:
+    """Read the linear index and the per contig statistics from a .bai file
+
+    Args:
+        index_path(str): path to .bai file
+        virtual_offsets(bool): return BGZF virtual offsets instead of compressed file offsets
+
+    Returns:
+        references(list) : for every reference a tuple (ioffsets, ref_begin, ref_end, n_mapped),
+            ioffsets is a numpy array of compressed (BGZF block) file offsets for every 16kb window,
+            ref_begin and ref_end are the compressed offsets of the first and last alignment of the contig,
+            these are None when the contig has no alignments.
+    """
+    shift = 0 if virtual_offsets else 16
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'BAI\x01':
+        raise ValueError(f'{index_path} is not a BAI index')
+
+    pos = 4
+    n_ref, = struct.unpack_from('<i', data, pos)
+    pos += 4
+    references = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        ref_begin, ref_end, n_mapped = None, None, 0
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, pos)
+            pos += 8
+            if bin_id == 37450 and n_chunk == 2:
+                # Pseudo bin containing the offsets and the amount of mapped reads
+                ref_begin, ref_end, n_mapped, _ = struct.unpack_from('<QQQQ', data, pos)
+                ref_begin, ref_end = ref_begin >> shift, ref_end >> shift
+            pos += 16 * n_chunk
+        n_intv, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        ioffsets = np.frombuffer(data, dtype='<u8', count=n_intv, offset=pos) >> shift
+        pos += 8 * n_intv
+        references.append((ioffsets, ref_begin, ref_end, n_mapped))
+    return references
+
+
+def get_index_read_density(bam_path: str, window_size: int = 16384) -> dict:
+    """Estimate the amount of mapped reads in every 16kb window of every contig using the bam index
+
+    The estimate is obtained from the linear index of the .bai file, the amount of compressed bytes between the
+    file offsets of two consecutive windows is proportional to the amount of reads in the window.
+    These fractions are scaled to the amount of mapped reads per contig. When no .bai index is available
+    (for example when a .csi index is used) the reads reported by idxstats are distributed uniformly over the contig.
+
+    Args:
+        bam_path(str): path to indexed bam file
+        window_size(int): size of the windows of the linear index, 16384 for .bai files
+
+    Returns:
+        read_density(dict) : {contig (str) : estimated reads per window (np.array) }
+    """
+    contig_sizes = get_contig_sizes(bam_path)
+    index_path = get_index_path(bam_path)
+    read_density = {}
+    if index_path is not None and index_path.endswith('.bai'):
+        for contig, (ioffsets, ref_begin, ref_end, n_mapped) in zip(contig_sizes, _read_bai_linear_index(index_path)):
+            n_windows = int(np.ceil(contig_sizes[contig] / window_size))
+            if n_mapped == 0 or ref_begin is None or len(ioffsets) == 0:
+                read_density[contig] = np.zeros(n_windows)
+                continue
+            # Windows without alignments have an offset of zero, these get the offset of the previous window:
+            offsets = np.maximum.accumulate(np.maximum(ioffsets.astype(np.int64), ref_begin))
+            window_bytes = np.diff(np.append(offsets, max(ref_end, offsets[-1]))).astype(float)
+            if window_bytes.sum() == 0:
+                window_bytes[:] = 1
+            density = np.zeros(max(n_windows, len(window_bytes)))
+            density[:len(window_bytes)] = n_mapped * window_bytes / window_bytes.sum()
+            read_density[contig] = density
+    else:
+        for line in pysam.idxstats(bam_path).split('\n'):
+            try:
+                contig, contig_len, mapped_reads, unmapped_reads = line.strip().split()
+            except ValueError:
+                continue
+            if contig == '*':
+                continue
+            n_windows = max(1, int(np.ceil(int(contig_len) / window_size)))
+            read_density[contig] = np.full(n_windows, int(mapped_reads) / n_windows)
+    return read_density
+
+
 def merge_bams( bams: list, output_path: str, threads: int=4 ):
     """Merge bamfiles to output_path
 
@@ -139,6 +235,237 @@ def merge_bams( bams: list, output_path: str, threads: int=4 ):
             os.remove(o+'.bai')
     return output_path
 
+# Empty BGZF block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def _read_bgzf_block(handle, coffset: int) -> tuple:
+    """Read and decompress the BGZF block starting at the supplied compressed offset
+
+    Returns:
+        data(bytes) : uncompressed block contents
+        block_size(int) : size of the compressed block in bytes
+    """
+    handle.seek(coffset)
+    header = handle.read(12)
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = handle.read(xlen)
+    bsize = None
+    i = 0
+    while i < xlen:
+        si1, si2, slen = struct.unpack_from('<BBH', extra, i)
+        if si1 == 66 and si2 == 67:
+            bsize, = struct.unpack_from('<H', extra, i + 4)
+        i += 4 + slen
+    if bsize is None:
+        raise ValueError('Not a BGZF block')
+    cdata = handle.read(bsize - xlen - 19)
+    return zlib.decompress(cdata, -15), bsize + 1
+
+
+def write_bgzf_blocks(handle, data: bytes, compresslevel: int = 6):
+    """Compress data into one or more BGZF blocks and write these to handle
+
+    Args:
+        handle : handle opened in binary mode to write the blocks to
+        data (bytes) : uncompressed data, split into blocks of at most 0xff00 bytes
+        compresslevel (int) : zlib compression level
+    """
+    for i in range(0, len(data), 0xff00):
+        chunk = data[i:i + 0xff00]
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        cdata = compressor.compress(chunk) + compressor.flush()
+        handle.write(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25))
+        handle.write(cdata)
+        handle.write(struct.pack('<II', zlib.crc32(chunk), len(chunk)))
+
+
+def _copy_bgzf_range(source, target, start: int, end: int, buffer_size: int = 1024 * 1024):
+    """Copy the uncompressed data between two virtual offsets of a BGZF file to target
+
+    Complete BGZF blocks are copied without decompression, only the (partial) blocks at the start and the end
+    of the range are recompressed.
+
+    Args:
+        source : handle to the BGZF file opened in binary mode
+        target : handle to write the BGZF blocks to
+        start(int) : virtual offset of the start of the range
+        end(int) : virtual offset of the end of the range (exclusive)
+    """
+    if end <= start:
+        return
+    cstart, ustart = start >> 16, start & 0xffff
+    cend, uend = end >> 16, end & 0xffff
+    if ustart > 0:
+        data, block_size = _read_bgzf_block(source, cstart)
+        if cstart == cend:
+            write_bgzf_blocks(target, data[ustart:uend])
+            return
+        write_bgzf_blocks(target, data[ustart:])
+        cstart += block_size
+    source.seek(cstart)
+    remaining = cend - cstart
+    while remaining > 0:
+        chunk = source.read(min(buffer_size, remaining))
+        if not chunk:
+            break
+        target.write(chunk)
+        remaining -= len(chunk)
+    if uend > 0:
+        data, _ = _read_bgzf_block(source, cend)
+        write_bgzf_blocks(target, data[:uend])
+
+
+def _alignment_sort_key(read):
+    return (read.reference_id, read.reference_start, read.is_reverse)
+
+
+def _get_bam_body_range(bam_path: str) -> tuple:
+    """Obtain the virtual offsets of the start of the first alignment and of the end of the last alignment"""
+    with pysam.AlignmentFile(bam_path, 'rb') as f:
+        body_start = f.tell()
+    with open(bam_path, 'rb') as raw:
+        raw.seek(0, 2)
+        size = raw.tell()
+        raw.seek(max(0, size - len(BGZF_EOF)))
+        if raw.read() == BGZF_EOF:
+            size -= len(BGZF_EOF)
+    return body_start, size << 16
+
+
+def _get_concatenation_info(bam_path: str) -> dict:
+    """Obtain the information required to concatenate the alignments of a sorted and indexed bam file"""
+    info = {'path': bam_path}
+    info['body_start'], info['body_end'] = _get_bam_body_range(bam_path)
+    with pysam.AlignmentFile(bam_path, 'rb') as f:
+        info['header'] = f.header.to_dict()
+        info['unplaced'] = f.nocoordinate
+        first = next(f, None)
+        if first is None:
+            return info
+        info['first'] = (first.reference_id, first.reference_start)
+
+        # The last alignment is found by reading from the last window of the linear index of the last contig with reads
+        references = [(ref_end, ioffsets) for ioffsets, ref_begin, ref_end, n_mapped
+                      in _read_bai_linear_index(get_index_path(bam_path), virtual_offsets=True) if n_mapped > 0]
+        ref_end, ioffsets = max(references, key=lambda ref: ref[0])
+        f.seek(max(info['body_start'], int(ioffsets[-1])))
+        for read in f:
+            info['last'] = (read.reference_id, read.reference_start)
+    return info
+
+
+def _find_split_offset(bam_path: str, key: tuple, start: int = None) -> tuple:
+    """Find the virtual offset of the first alignment with a (reference_id, reference_start) larger than key
+
+    Args:
+        bam_path(str) : path to sorted and indexed bam file
+        key(tuple) : (reference_id, reference_start)
+        start(int) : virtual offset to start scanning from, when not supplied the linear index is used
+
+    Returns:
+        offset(int) : virtual offset of the first alignment after key, None when there is no such alignment
+        skipped(list) : alignments which were scanned and are not larger than key
+    """
+    skipped = []
+    with pysam.AlignmentFile(bam_path, 'rb') as f:
+        if start is None:
+            ioffsets = _read_bai_linear_index(get_index_path(bam_path), virtual_offsets=True)[key[0]][0]
+            window = min(key[1] >> 14, len(ioffsets) - 1)
+            start = max(f.tell(), int(ioffsets[window])) if window >= 0 else f.tell()
+        f.seek(start)
+        while True:
+            offset = f.tell()
+            read = next(f, None)
+            if read is None:
+                return None, skipped
+            if (read.reference_id, read.reference_start) > key:
+                return offset, skipped
+            skipped.append(read)
+
+
+def concatenate_sorted_bams(bams: list, output_path: str, threads: int = 4):
+    """Concatenate sorted bam files covering consecutive genomic regions into one sorted bam file
+
+    The alignments of every file are copied as compressed BGZF blocks, only the alignments at the boundaries
+    between two files which overlap each other are decompressed and merged. This is much cheaper than
+    merging all alignments. The read groups of all files are combined into a single header.
+    When the files cannot be concatenated (because more than two files overlap or the files contain
+    alignments without coordinates) merge_bams is used instead.
+
+    All input bam files are removed
+
+    Args:
+        bams : list or tuple containing paths to sorted and indexed bam files, the header of the first file is used
+        output_path (str): target path
+
+    Returns:
+        output_path (str)
+    """
+    assert all((os.path.exists(bam+'.bai') for bam in bams)), 'Only indexed files can be concatenated'
+    infos = [_get_concatenation_info(bam) for bam in bams]
+
+    # Combine the headers:
+    header = infos[0]['header']
+    read_groups = {}
+    for info in infos:
+        for read_group in info['header'].get('RG', []):
+            read_groups.setdefault(read_group['ID'], read_group)
+    if len(read_groups):
+        header['RG'] = list(read_groups.values())
+
+    parts = sorted((info for info in infos if 'first' in info), key=lambda info: info['first'])
+    if any(info['unplaced'] > 0 for info in infos) or \
+            any(a['last'] > b['last'] or (i > 0 and parts[i - 1]['last'] > b['first'])
+                for i, (a, b) in enumerate(zip(parts, parts[1:]))):
+        return merge_bams(bams, output_path, threads=threads)
+
+    # Determine which alignments of every file can be copied and which alignments need to be merged:
+    for part in parts:
+        part['copy_start'], part['copy_end'] = part['body_start'], part['body_end']
+    boundaries = []
+    for a, b in zip(parts, parts[1:]):
+        if a['last'] <= b['first']:
+            boundaries.append(None)
+            continue
+        a['copy_end'], _ = _find_split_offset(a['path'], b['first'])
+        with pysam.AlignmentFile(a['path'], 'rb') as f:
+            f.seek(a['copy_end'])
+            tail = list(f)
+        b['copy_start'], head = _find_split_offset(b['path'], a['last'], start=b['body_start'])
+        if b['copy_start'] is None:
+            b['copy_start'] = b['body_end']
+        boundaries.append(sorted(tail + head, key=_alignment_sort_key))
+
+    boundary_path = f'{output_path}.boundary.bam'
+    with open(output_path, 'wb') as out:
+        # Write the header:
+        with pysam.AlignmentFile(boundary_path, 'wb', header=header) as f:
+            pass
+        with open(boundary_path, 'rb') as raw:
+            _copy_bgzf_range(raw, out, 0, _get_bam_body_range(boundary_path)[0])
+
+        for part, boundary in zip(parts, boundaries + [None]):
+            with open(part['path'], 'rb') as raw:
+                _copy_bgzf_range(raw, out, part['copy_start'], part['copy_end'])
+            if boundary is None:
+                continue
+            # Write the merged alignments of the overlapping region between this file and the next file:
+            with pysam.AlignmentFile(boundary_path, 'wb', header=header) as f:
+                for read in boundary:
+                    f.write(read)
+            with open(boundary_path, 'rb') as raw:
+                _copy_bgzf_range(raw, out, *_get_bam_body_range(boundary_path))
+        out.write(BGZF_EOF)
+    os.remove(boundary_path)
+
+    pysam.index(output_path, f'-@ {threads}')
+    for o in bams:
+        os.remove(o)
+        os.remove(o+'.bai')
+    return output_path
+
+
 def verify_and_fix_bam(bam_path):
     """
     Check if the bam file is not truncated and indexed.
@@ -386,6 +713,64 @@ def get_reference_path_from_bam(bam, ignore_missing=False):
             'Supply either a path to a bam file or pysam.AlignmentFile object')
 
 
+class ReorderBufferWriter():
+    """Writes reads in coordinate sorted order to a bam file handle without sorting the complete file.
+
+    Reads are held in memory until a read is written which starts more than window bp further, then they are
+    written in sorted order. When a read is written which starts before the last read which was already
+    written to the handle, the output cannot be sorted anymore; is_sorted is set to False and all following
+    reads are written directly. Reads without coordinates are written at the end.
+
+    Args:
+        handle (pysam.AlignmentFile) : handle to write the reads to
+        window (int) : amount of bp reads can be written out of order
+    """
+
+    def __init__(self, handle, window: int):
+        self.handle = handle
+        self.header = handle.header
+        self.window = window
+        self.is_sorted = True
+        self.buffer = []
+        self.unplaced = []
+        self.frontier = None
+        self.last_written = None
+        self.n_written = 0
+
+    def write(self, read):
+        if not self.is_sorted:
+            self.handle.write(read)
+            return
+        if read.reference_id < 0:
+            self.unplaced.append(read)
+            return
+
+        key = (read.reference_id, read.reference_start, read.is_reverse)
+        if self.last_written is not None and key[:2] < self.last_written[:2]:
+            self.is_sorted = False
+            self._flush()
+            self.handle.write(read)
+            return
+
+        heapq.heappush(self.buffer, (key, self.n_written, read))
+        self.n_written += 1
+        if self.frontier is None or key > self.frontier:
+            self.frontier = key
+        self._flush((self.frontier[0], self.frontier[1] - self.window))
+
+    def _flush(self, until: tuple = None):
+        while len(self.buffer) and (until is None or self.buffer[0][0][:2] < until):
+            self.last_written, _, read = heapq.heappop(self.buffer)
+            self.handle.write(read)
+
+    def close(self):
+        self._flush()
+        for read in self.unplaced:
+            self.handle.write(read)
+        self.unplaced = []
+        self.handle.close()
+
+
 @contextlib.contextmanager
 def sorted_bam_file(
         write_path,
@@ -396,6 +781,7 @@ def sorted_bam_file(
         input_is_sorted=False,
         mode='wb',
         fast_compression=False, # Use fast compression for merge (-1 flag)
+        reorder_window=None,
         **kwargs
         ):
     """ Get writing handle to a sorted bam file
@@ -419,6 +805,10 @@ def sorted_bam_file(
 
         mode (str) : Output mode, use wbu for uncompressed writing.
 
+        reorder_window (int) : Sort the reads in memory while writing, reads can be written at most reorder_window bp
+            out of order. The sort step is skipped when all reads were written within this window,
+            otherwise the file is sorted afterwards.
+
         **kwargs : arguments to pass to the new pysam.AlignmentFile output handle
 
     Example:
@@ -500,11 +890,30 @@ def sorted_bam_file(
         # Raise when this fails
         raise
 
+    if reorder_window is not None:
+        unsorted_alignments = ReorderBufferWriter(unsorted_alignments, reorder_window)
+
     # Yield a handle to the alignments,
     # this handle will be released when the handle runs out of scope
     yield unsorted_alignments
     unsorted_alignments.close()
 
+    if reorder_window is not None:
+        if read_groups is not None:
+            add_readgroups_to_header(unsorted_path, read_groups, header_write_mode='bgzf')
+        if unsorted_alignments.is_sorted:
+            os.rename(unsorted_path, write_path)
+            pysam.index(write_path, '-@ 4')
+        else:
+            sort_and_index(
+                unsorted_path,
+                write_path,
+                remove_unsorted=True,
+                local_temp_sort=local_temp_sort,
+                fast_compression=fast_compression
+                )
+        return
+
     if read_groups is not None:
         add_readgroups_to_header(unsorted_path, read_groups)
 
@@ -867,6 +1276,74 @@ def get_read_group_from_read(read, format, with_attr_dict=False):
     return rg_id
 
 
+_MD_TOKEN = re.compile(r'(\d+)|\^([A-Za-z]+)|([A-Za-z])')
+
+
+def get_aligned_pairs_array(read):
+    """Obtain the aligned query and reference positions of a read as arrays
+
+    The result is identical to read.get_aligned_pairs(matches_only=True), but is computed per CIGAR
+    operation instead of per base.
+
+    Args:
+        read (pysam.AlignedSegment) : read to obtain the aligned positions for
+
+    Returns:
+        query_positions (np.array) : query position of every aligned base
+        reference_positions (np.array) : reference position of every aligned base
+    """
+    query_blocks, reference_blocks = [], []
+    if not read.is_unmapped and read.cigartuples is not None:
+        query_pos, reference_pos = 0, read.reference_start
+        for operation, length in read.cigartuples:
+            if operation == 0 or operation == 7 or operation == 8:  # M, = and X
+                query_blocks.append(np.arange(query_pos, query_pos + length, dtype=np.int64))
+                reference_blocks.append(np.arange(reference_pos, reference_pos + length, dtype=np.int64))
+                query_pos += length
+                reference_pos += length
+            elif operation == 1 or operation == 4:  # I and S
+                query_pos += length
+            elif operation == 2 or operation == 3:  # D and N
+                reference_pos += length
+
+    if len(query_blocks) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if len(query_blocks) == 1:
+        return query_blocks[0], reference_blocks[0]
+    return np.concatenate(query_blocks), np.concatenate(reference_blocks)
+
+
+def get_aligned_reference_bases(read, query_positions=None):
+    """Obtain the reference bases of the aligned positions of a read using the MD tag
+
+    The result is identical to the upper case reference bases of read.get_aligned_pairs(matches_only=True, with_seq=True)
+
+    Args:
+        read (pysam.AlignedSegment) : read with MD tag
+        query_positions (np.array) : aligned query positions obtained using get_aligned_pairs_array,
+            or a sorted subset of these positions. When not supplied all aligned positions are used
+
+    Returns:
+        reference_bases (np.array) : upper case reference base (uint8) of every (selected) aligned base
+    """
+    if not read.has_tag('MD'):
+        raise ValueError('MD tag not present')
+    aligned_query_positions, _ = get_aligned_pairs_array(read)
+    # Matching bases are equal to the query base, mismatches are stored in the MD tag.
+    # The MD tag describes all aligned bases, the substitutions are applied before selecting query_positions
+    reference_bases = np.frombuffer(read.query_sequence.upper().encode(), dtype=np.uint8)[aligned_query_positions]
+    aligned_index = 0
+    for match_length, deletion, mismatch in _MD_TOKEN.findall(read.get_tag('MD')):
+        if match_length:
+            aligned_index += int(match_length)
+        elif mismatch:
+            reference_bases[aligned_index] = ord(mismatch.upper())
+            aligned_index += 1
+    if query_positions is None:
+        return reference_bases
+    return reference_bases[np.searchsorted(aligned_query_positions, query_positions)]
+
+
 def random_sample_bam(bam,n,**sample_location_args):
     """Sample a bam file at random locations
 
@@ -911,6 +1388,21 @@ def replace_bam_header(origin_bam_path, header, target_bam_path=None, header_wri
 
         os.rename(complete_temp_path, target_bam_path)
 
+    elif header_write_mode == 'bgzf':
+
+        # Copy the compressed alignments behind the new header:
+        header_path = origin_bam_path.replace('.bam', '') + '.header.bam'
+        with pysam.AlignmentFile(header_path, 'wb', header=header):
+            pass
+        with open(complete_temp_path, 'wb') as out:
+            with open(header_path, 'rb') as raw:
+                _copy_bgzf_range(raw, out, 0, _get_bam_body_range(header_path)[0])
+            with open(origin_bam_path, 'rb') as raw:
+                _copy_bgzf_range(raw, out, *_get_bam_body_range(origin_bam_path))
+            out.write(BGZF_EOF)
+        os.remove(header_path)
+        os.rename(complete_temp_path, target_bam_path)
+
     elif header_write_mode == 'samtools':
 
         # Write the new header to this sam file:
@@ -928,7 +1420,7 @@ def replace_bam_header(origin_bam_path, header, target_bam_path=None, header_wri
         os.system(rehead_cmd)
     else:
         raise ValueError(
-            'header_write_mode should be either, auto, pysam or samtools')
+            'header_write_mode should be either, auto, pysam, bgzf or samtools')
 
 
 
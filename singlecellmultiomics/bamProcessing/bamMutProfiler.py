@@ -80,7 +80,7 @@ if __name__ == '__main__':
 
     if histplot is not None:
         print("Creating molecule histogram ... ",end="")
-        df = pd.DataFrame(counts).T.fillna(0)
+        df = counts.fillna(0)
         fig, ax = plt.subplots()
         cell_sums = df.sum()
         cell_sums.name = 'Frequency'
@@ -95,7 +95,7 @@ if __name__ == '__main__':
 
     # Convert the count dictionary to a dataframe
     print("Filtering count matrix ... ", end="")
-    df = pd.DataFrame(counts).T.fillna(0)
+    df = counts.fillna(0)
     # remove cells were the median is zero
     if args.norm_method=='median':
         try:
@@ -11,6 +11,9 @@ import numpy as np
 import itertools
 import singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods
 import gzip  # for loading blacklist bedfiles
+from singlecellmultiomics.countTableProcessing.sparseCountTable import SparseCountTable
+from singlecellmultiomics.bamProcessing import get_contigs_with_reads, get_index_path
+from multiprocessing import Pool
 TagDefinitions = singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods.TagDefinitions
 
 
@@ -75,6 +78,11 @@ def coordinate_to_bins(point, bin_size, sliding_increment):
             for i in range(start_id, end_id + 1)]
 
 
+def is_sparse_output_path(path):
+    """Check if the count table should be written as sparse matrix (.npz, .mtx or .mtx.gz)"""
+    return path.endswith('.npz') or path.endswith('.mtx') or path.endswith('.mtx.gz')
+
+
 def read_has_alternative_hits_to_non_alts(read):
     if read.has_tag('XA'):
         for alt_align in read.get_tag('XA').split(';'):
@@ -346,8 +354,7 @@ def assignReads(
                         start < 0 or end > args.ref_lengths[read.reference_name]):
                     continue
                 for sample in samples:
-                    countTable[sample][tuple(
-                        list(key) + [start, end])] += countToAdd
+                    countTable.add(sample, tuple(list(key) + [start, end]), countToAdd)
 
     elif args.bedfile is not None:
 
@@ -363,7 +370,7 @@ def assignReads(
             start, end, bname = more_args[0], more_args[1], more_args[2]
             jfeat = tuple(list(key) + [start, end, bname])
             if len(key):
-                countTable[sample][jfeat] += countToAdd
+                countTable.add(sample, jfeat, countToAdd)
             # else: this will also emit non assigned reads
             #    countTable[sample][ 'None' ] += countToAdd
 
@@ -375,13 +382,104 @@ def assignReads(
 
             for sample in samples:
                 if len(key) == 1:
-                    countTable[sample][key[0]] += countToAdd
+                    countTable.add(sample, key[0], countToAdd)
                 else:
-                    countTable[sample][key] += countToAdd
+                    countTable.add(sample, key, countToAdd)
 
     return assigned
 
 
+def generate_count_shards(args, shard_size=10_000_000, bed_rows_per_shard=1000):
+    """Divide the alignment files into shards which can be counted independently
+
+    Every read is part of a single shard, the shards are generated in the order in which create_count_table
+    processes the reads.
+
+    Args:
+        args : create_count_table arguments
+        shard_size (int) : size of the region of a shard in base pairs
+        bed_rows_per_shard (int) : amount of bed file rows per shard when a bed file is used
+
+    Yields:
+        bam_path (str) : alignment file to count
+        region (tuple) : (contig, start, end) reads starting in this region are counted, None when bed_rows is supplied
+        bed_rows (list) : [(contig, start, end, name), ..] bed rows to count, None when region is supplied
+    """
+    for bamFile in args.alignmentfiles:
+        if args.bedfile is None:
+            for contig, length in get_contigs_with_reads(bamFile, with_length=True):
+                if args.contig is not None and contig != args.contig:
+                    continue
+                if contig == '*':
+                    # Reads without coordinate
+                    yield bamFile, ('*', None, None), None
+                    continue
+                for start in range(0, length, shard_size):
+                    yield bamFile, (contig, start, min(length, start + shard_size)), None
+        else:
+            with open(args.bedfile, "r") as bfile:
+                bed_rows = []
+                for row in bfile:
+                    parts = row.strip().split()
+                    chromo, start, end, bname = parts[0], int(float(
+                        parts[1])), int(float(parts[2])), parts[3]
+                    if args.contig is not None and chromo != args.contig:
+                        continue
+                    bed_rows.append((chromo, start, end, bname))
+                    if len(bed_rows) >= bed_rows_per_shard:
+                        yield bamFile, None, bed_rows
+                        bed_rows = []
+                if len(bed_rows):
+                    yield bamFile, None, bed_rows
+
+
+def _count_shard(args):
+    """Count the reads of a single shard (Function is used as Pool chunk)
+
+    Args:
+        args: create_count_table arguments, bam_path, region, bed_rows, joinFeatures, featureTags,
+            sampleTags, blacklist_dic
+
+    Returns:
+        countTable (SparseCountTable) : counts of the shard
+        assigned (int) : amount of assigned reads
+    """
+    args, bamFile, region, bed_rows, joinFeatures, featureTags, sampleTags, blacklist_dic = args
+    countTable = SparseCountTable()
+    assigned = 0
+    with pysam.AlignmentFile(bamFile) as f:
+        if args.bin:
+            args.ref_lengths = {
+                r: f.get_reference_length(r) for r in f.references}
+        if bed_rows is None:
+            contig, start, end = region
+            for read in (f.fetch(contig) if start is None else f.fetch(contig, start, end)):
+                # Reads starting before the region belong to the previous shard
+                if start is not None and read.reference_start < start:
+                    continue
+                assigned += assignReads(read,
+                                        countTable,
+                                        args,
+                                        joinFeatures,
+                                        featureTags,
+                                        sampleTags,
+                                        blacklist_dic=blacklist_dic)
+        else:
+            for chromo, start, end, bname in bed_rows:
+                for read in f.fetch(chromo, start, end):
+                    assigned += assignReads(read,
+                                            countTable,
+                                            args,
+                                            joinFeatures,
+                                            featureTags,
+                                            sampleTags,
+                                            more_args=[start,
+                                                       end,
+                                                       bname],
+                                            blacklist_dic=blacklist_dic)
+    return countTable, assigned
+
+
 def create_count_table(args, return_df=False):
 
     if len(args.alignmentfiles) == 0:
@@ -461,8 +559,7 @@ def create_count_table(args, return_df=False):
             "No features supplied! Please supply -featureTags -joinedFeatureTags and or -binTag")
 
     sampleTags = args.sampleTags.split(',')
-    countTable = collections.defaultdict(
-        collections.Counter)  # cell->feature->count
+    countTable = SparseCountTable()  # (feature, cell) -> count
 
     if args.blacklist is not None:
         # create blacklist dictionary {chromosome : [ (start1, end1), ..., (startN, endN) ]}
@@ -482,71 +579,95 @@ def create_count_table(args, return_df=False):
     else:
         blacklist_dic = None
 
-    assigned = 0
-    for bamFile in args.alignmentfiles:
+    threads = getattr(args, 't', None)
+    parallel = threads is not None and threads > 1 and args.head is None
+    if parallel and not all(get_index_path(bamFile) is not None for bamFile in args.alignmentfiles):
+        print("Not all alignment files are indexed, counting using a single process")
+        parallel = False
 
-        with pysam.AlignmentFile(bamFile) as f:
-            i = 0  # make sure i is defined
-            if args.bin:
-                # Obtain the reference sequence lengths
-                ref_lengths = {
-                    r: f.get_reference_length(r) for r in f.references}
-                args.ref_lengths = ref_lengths
-            if args.bedfile is None:
-                # for adding counts associated with a tag OR with binning
-                if args.contig is not None:
-                    pysam_iterator = f.fetch(args.contig)
-                else:
-                    pysam_iterator = f
-
-                for i, read in enumerate(pysam_iterator):
-                    if i % 1_000_000 == 0:
-                        print(
-                            f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
-
-                    if args.head is not None and i > args.head:
-                        break
-
-                    assigned += assignReads(read,
-                                            countTable,
-                                            args,
-                                            joinFeatures,
-                                            featureTags,
-                                            sampleTags,
-                                            blacklist_dic = blacklist_dic)
-            else:  # args.bedfile is not None
-                # for adding counts associated with a bedfile
-                with open(args.bedfile, "r") as bfile:
-                    #breader = csv.reader(bfile, delimiter = "\t")
-                    for row in bfile:
-
-                        parts = row.strip().split()
-                        chromo, start, end, bname = parts[0], int(float(
-                            parts[1])), int(float(parts[2])), parts[3]
-                        if args.contig is not None and chromo != args.contig:
-                            continue
-                        for i, read in enumerate(f.fetch(chromo, start, end)):
-                            if i % 1_000_000 == 0:
-                                print(
-                                    f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
-                            assigned += assignReads(read,
-                                                    countTable,
-                                                    args,
-                                                    joinFeatures,
-                                                    featureTags,
-                                                    sampleTags,
-                                                    more_args=[start,
-                                                               end,
-                                                               bname],
-                                                    blacklist_dic = blacklist_dic)
-
-                            if args.head is not None and i > args.head:
-                                break
+    assigned = 0
+    if parallel:
+        shards = ((args, bamFile, region, bed_rows, joinFeatures, featureTags, sampleTags, blacklist_dic)
+                  for bamFile, region, bed_rows in generate_count_shards(
+                      args, shard_size=getattr(args, 'shard_size', 10_000_000)))
+        n_shards = 0
+        with Pool(threads) as workers:
+            # The partial tables are merged in the order of the shards, this yields the same table as serial counting
+            for shard_table, shard_assigned in workers.imap(_count_shard, shards):
+                countTable.merge(shard_table)
+                assigned += shard_assigned
+                n_shards += 1
+        print(f"Finished: counted {n_shards} shards, assigned {assigned}")
+    else:
+        for bamFile in args.alignmentfiles:
 
-            print(
-                f"Finished: {bamFile} Processed {i} reads, assigned {assigned}")
+            with pysam.AlignmentFile(bamFile) as f:
+                i = 0  # make sure i is defined
+                if args.bin:
+                    # Obtain the reference sequence lengths
+                    ref_lengths = {
+                        r: f.get_reference_length(r) for r in f.references}
+                    args.ref_lengths = ref_lengths
+                if args.bedfile is None:
+                    # for adding counts associated with a tag OR with binning
+                    if args.contig is not None:
+                        pysam_iterator = f.fetch(args.contig)
+                    else:
+                        pysam_iterator = f
+
+                    for i, read in enumerate(pysam_iterator):
+                        if i % 1_000_000 == 0:
+                            print(
+                                f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
+
+                        if args.head is not None and i > args.head:
+                            break
+
+                        assigned += assignReads(read,
+                                                countTable,
+                                                args,
+                                                joinFeatures,
+                                                featureTags,
+                                                sampleTags,
+                                                blacklist_dic = blacklist_dic)
+                else:  # args.bedfile is not None
+                    # for adding counts associated with a bedfile
+                    with open(args.bedfile, "r") as bfile:
+                        #breader = csv.reader(bfile, delimiter = "\t")
+                        for row in bfile:
+
+                            parts = row.strip().split()
+                            chromo, start, end, bname = parts[0], int(float(
+                                parts[1])), int(float(parts[2])), parts[3]
+                            if args.contig is not None and chromo != args.contig:
+                                continue
+                            for i, read in enumerate(f.fetch(chromo, start, end)):
+                                if i % 1_000_000 == 0:
+                                    print(
+                                        f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
+                                assigned += assignReads(read,
+                                                        countTable,
+                                                        args,
+                                                        joinFeatures,
+                                                        featureTags,
+                                                        sampleTags,
+                                                        more_args=[start,
+                                                                   end,
+                                                                   bname],
+                                                        blacklist_dic = blacklist_dic)
+
+                                if args.head is not None and i > args.head:
+                                    break
+
+                print(
+                    f"Finished: {bamFile} Processed {i} reads, assigned {assigned}")
     print(f"Finished counting, now exporting to {args.o}")
-    df = pd.DataFrame.from_dict(countTable)
+    if not return_df and is_sparse_output_path(args.o):
+        countTable.write_sparse(args.o)
+        print("Finished export.")
+        return args.o
+
+    df = countTable.to_dataframe()
 
     # Set names of indices
     if not args.noNames:
@@ -593,7 +714,7 @@ if __name__ == '__main__':
     argparser.add_argument(
         '-o',
         type=str,
-        help="output csv path, or pandas dataframe if path ends with pickle.gz",
+        help="output csv path, or pandas dataframe if path ends with pickle.gz. When the path ends with .npz, .mtx or .mtx.gz a sparse (features x samples) matrix is written, the labels of the rows and columns are written to [path].features.tsv.gz and [path].samples.tsv.gz",
         required=False)
     argparser.add_argument(
         '-featureTags',
@@ -636,6 +757,15 @@ if __name__ == '__main__':
         '-contig',
         type=str,
         help='Run only on this chromosome')
+    argparser.add_argument(
+        '-t',
+        type=int,
+        help='Amount of processes to use for counting. The alignment files are divided into regions which are counted in parallel, this requires indexed alignment files')
+    argparser.add_argument(
+        '-shard_size',
+        type=int,
+        default=10_000_000,
+        help='Size of the regions counted by a single process when -t is supplied')
 
     multimapping_args = argparser.add_argument_group('Multimapping', '')
     multimapping_args.add_argument(
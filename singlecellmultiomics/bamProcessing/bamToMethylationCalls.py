@@ -12,7 +12,7 @@ from singlecellmultiomics.bamProcessing.bamBinCounts import generate_commands, c
 import argparse
 from colorama import Fore, Style
 from singlecellmultiomics.utils import dataframe_to_wig
-from singlecellmultiomics.methylation import MethylationCountMatrix
+from singlecellmultiomics.methylation import SparseMethylationCountMatrix
 from singlecellmultiomics.bamProcessing.bamFunctions import get_reference_from_pysam_alignmentFile
 from colorama import Fore,Style
 
@@ -68,7 +68,7 @@ def get_methylation_count_matrix(bam_path,
     )
 
 
-    count_mat = MethylationCountMatrix()
+    count_mat = SparseMethylationCountMatrix()
     if threads==1:
         for command in commands:
             result = count_methylation_binned(command)
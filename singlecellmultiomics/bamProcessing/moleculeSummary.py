@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import Counter, defaultdict
+import glob
+import json
+import os
+import uuid
+import numpy as np
+import pandas as pd
+
+# Columns of a molecule summary: column -> (bam tag or None, dtype), missing integer tags are stored as -1
+MOLECULE_SUMMARY_NUMERIC_COLUMNS = {
+    'DS': ('DS', np.int64),
+    'strand': (None, np.int8),
+    'mapping_quality': (None, np.uint8),
+    'is_read1': (None, np.bool_),
+    'is_reverse': (None, np.bool_),
+    'is_qcfail': (None, np.bool_),
+    'is_duplicate': (None, np.bool_),
+    'af': ('af', np.int32),
+    'TF': ('TF', np.int32),
+    'TR': ('TR', np.int32),
+    'MC': ('MC', np.int32),
+    'uC': ('uC', np.int32),
+    'sZ': ('sZ', np.int32),
+    'sz': ('sz', np.int32),
+    'sX': ('sX', np.int32),
+    'sx': ('sx', np.int32),
+    'sH': ('sH', np.int32),
+    'sh': ('sh', np.int32),
+}
+# String columns are interned, the chunk stores integer codes and a table with the values
+MOLECULE_SUMMARY_STRING_COLUMNS = {
+    'contig': None,
+    'sample': 'SM',
+    'umi': 'RX',
+    'allele': 'DA',
+    'rejection_reason': 'RR',
+}
+# File which marks a folder as molecule summary, written when the folder is prepared for a new summary
+MOLECULE_SUMMARY_MARKER = 'molecule_summary.json'
+
+
+def get_integer_tag(read, tag):
+    """Obtain the value of an integer tag, -1 when the tag is missing or not an integer
+    (the aligner can set MC to the mate cigar, which is not a methylation total)
+    """
+    if not read.has_tag(tag):
+        return -1
+    value = read.get_tag(tag)
+    return value if type(value) is int else -1
+
+
+def get_molecule_summary_read(molecule):
+    """Obtain the read which represents the molecule in the summary: read 1 of the first fragment,
+    this is the read which is not marked as duplicate. When read 1 is not mapped the first associated read is used.
+    """
+    for fragment in molecule:
+        if fragment.has_R1():
+            return fragment.get_R1()
+        break
+    for read in molecule.iter_reads():
+        return read
+    return None
+
+
+class MoleculeSummaryWriter():
+    """Collects one row per written molecule and writes the rows as compressed column chunk.
+
+    Every chunk is a .npz file in the summary folder and contains the rows of one or more tagging tasks.
+    The rows of every task are stored consecutively, the 'regions' of the chunk point to the rows of every task.
+    Rows are only added when a task finished, the rows of a task which timed out are discarded.
+    The summary folder needs to be prepared using create_summary_folder before any chunk is written.
+
+    Example:
+        >>> MoleculeSummaryWriter.create_summary_folder('./tagged.bam.molecules')
+        >>> writer = MoleculeSummaryWriter()
+        >>> rows = [writer.get_row(molecule) for molecule in molecules]
+        >>> writer.add_region('chr1', 0, 1_000_000, rows)
+        >>> writer.write('./tagged.bam.molecules')
+    """
+
+    def __init__(self):
+        self.tables = {column: {} for column in MOLECULE_SUMMARY_STRING_COLUMNS}
+        self.columns = {column: [] for column in (*MOLECULE_SUMMARY_STRING_COLUMNS, *MOLECULE_SUMMARY_NUMERIC_COLUMNS)}
+        self.regions = []  # (contig, start, end, first row, end row)
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    @staticmethod
+    def create_summary_folder(summary_path):
+        """Prepare a folder for a new summary, the chunks of a summary written before to the folder are removed
+
+        Args:
+            summary_path (str) : path to the folder of the summary, created when it does not exist
+
+        Raises:
+            ValueError : when the folder contains files but is not a molecule summary
+        """
+        if os.path.isdir(summary_path) and len(os.listdir(summary_path)) > 0 \
+                and not MoleculeSummary.is_summary(summary_path):
+            raise ValueError(f'{summary_path} is not empty and is not a molecule summary folder')
+        os.makedirs(summary_path, exist_ok=True)
+        for chunk_path in glob.glob(os.path.join(summary_path, '*.npz')):
+            os.remove(chunk_path)
+        with open(os.path.join(summary_path, MOLECULE_SUMMARY_MARKER), 'w') as f:
+            json.dump({'columns': [*MOLECULE_SUMMARY_STRING_COLUMNS, *MOLECULE_SUMMARY_NUMERIC_COLUMNS]}, f)
+
+    @staticmethod
+    def get_row(molecule):
+        """Obtain the summary row of a molecule, the tags of the molecule need to be written first (write_tags)
+
+        Returns:
+            row (tuple) : values in the order of MOLECULE_SUMMARY_STRING_COLUMNS and MOLECULE_SUMMARY_NUMERIC_COLUMNS
+        """
+        read = get_molecule_summary_read(molecule)
+        if read is None:
+            return None
+        strings = tuple(
+            (read.reference_name if column == 'contig' else (str(read.get_tag(tag)) if read.has_tag(tag) else ''))
+            for column, tag in MOLECULE_SUMMARY_STRING_COLUMNS.items())
+        strand = molecule.get_strand()
+        properties = {
+            'strand': -1 if strand is None else int(strand),
+            'mapping_quality': read.mapping_quality,
+            'is_read1': read.is_read1,
+            'is_reverse': read.is_reverse,
+            'is_qcfail': read.is_qcfail,
+            'is_duplicate': read.is_duplicate
+        }
+        numbers = tuple(
+            properties[column] if tag is None else get_integer_tag(read, tag)
+            for column, (tag, dtype) in MOLECULE_SUMMARY_NUMERIC_COLUMNS.items())
+        return strings + numbers
+
+    def add_region(self, contig, start, end, rows):
+        """Add the rows of the molecules of a finished tagging task
+
+        Args:
+            contig (str) : contig of the task, None when all contigs were processed
+            start (int) : start of the task, None when the complete contig was processed
+            end (int) : end of the task (exclusive)
+            rows (list) : rows obtained using get_row
+        """
+        rows = [row for row in rows if row is not None]
+        self.regions.append((contig, start, end, self.n_rows, self.n_rows + len(rows)))
+        n_strings = len(MOLECULE_SUMMARY_STRING_COLUMNS)
+        for column_index, column in enumerate(self.columns):
+            values = [row[column_index] for row in rows]
+            if column_index < n_strings:
+                table = self.tables[column]
+                values = [table.setdefault(value, len(table)) for value in values]
+            self.columns[column].extend(values)
+        self.n_rows += len(rows)
+
+    def write(self, summary_path):
+        """Write the collected rows to a new chunk in the summary folder
+
+        Args:
+            summary_path (str) : path to the folder of the summary, prepared using create_summary_folder
+
+        Returns:
+            chunk_path (str) : path to the chunk written, None when nothing was collected
+        """
+        if len(self.regions) == 0:
+            return None
+        arrays = {
+            column: np.array(values, dtype=np.uint32 if column in MOLECULE_SUMMARY_STRING_COLUMNS
+                             else MOLECULE_SUMMARY_NUMERIC_COLUMNS[column][1])
+            for column, values in self.columns.items()}
+        region_contigs = [contig for contig, start, end, begin, stop in self.regions]
+        meta = {
+            'tables': {column: list(table) for column, table in self.tables.items()},
+            'region_contigs': region_contigs
+        }
+        chunk_path = os.path.join(summary_path, f'{uuid.uuid4()}.npz')
+        # Write to a temporary file first, the summary can be read while tagging is running
+        temp_path = f'{chunk_path}.tmp.npz'
+        np.savez_compressed(
+            temp_path,
+            meta=np.array(json.dumps(meta)),
+            # start, end, first row, end row of every region, -1 for a missing coordinate
+            regions=np.array([[-1 if value is None else value for value in region[1:]] for region in self.regions],
+                             dtype=np.int64),
+            **arrays)
+        os.replace(temp_path, chunk_path)
+        return chunk_path
+
+
+class MoleculeSummary():
+    """Reader for the molecule summary written by bamtagmultiome (-molecule_summary)
+
+    The summary contains one row per molecule with the following columns:
+        contig, DS, strand (0: forward, 1: reverse, -1: unknown), sample (SM), umi (RX), af, TF, TR, allele (DA),
+        methylation totals (MC, uC, sZ, sz, sX, sx, sH, sh), rejection_reason (RR) and
+        mapping_quality, is_read1, is_reverse, is_qcfail and is_duplicate of the representative read of the molecule.
+    Missing integer tags are -1 and missing string tags are empty strings.
+
+    Example:
+        >>> summary = MoleculeSummary('./tagged.bam.molecules')
+        >>> summary.fetch('chr1', 1_000_000, 2_000_000, columns=['sample', 'DS'])
+        >>> summary.get_molecule_counts_per_cell()
+    """
+
+    def __init__(self, summary_path):
+        """Open the molecule summary folder, only the region index of the chunks is loaded"""
+        if not MoleculeSummary.is_summary(summary_path):
+            raise ValueError(f'{summary_path} is not a molecule summary folder')
+        self.path = summary_path
+        self.chunk_paths = sorted(glob.glob(os.path.join(summary_path, '*.npz')))
+        self.chunk_paths = [path for path in self.chunk_paths if not path.endswith('.tmp.npz')]
+
+        # Region index: (contig, start, end, chunk index, first row, end row)
+        self.regions = []
+        for chunk_index, chunk_path in enumerate(self.chunk_paths):
+            with np.load(chunk_path) as chunk:
+                meta = json.loads(str(chunk['meta']))
+                for contig, (start, end, begin, stop) in zip(meta['region_contigs'], chunk['regions'].tolist()):
+                    self.regions.append((contig,
+                                         None if start == -1 else start,
+                                         None if end == -1 else end,
+                                         chunk_index, begin, stop))
+        self.regions.sort(key=lambda region: (str(region[0]), -1 if region[1] is None else region[1]))
+
+    @staticmethod
+    def is_summary(path):
+        """Check if path points to a molecule summary folder"""
+        return os.path.isfile(os.path.join(path, MOLECULE_SUMMARY_MARKER))
+
+    def __len__(self):
+        return sum(stop - begin for *_, begin, stop in self.regions)
+
+    def get_contigs(self):
+        """Obtain the contigs with molecules in the summary"""
+        contigs = set(contig for contig, *_ in self.regions if contig is not None)
+        if any(contig is None for contig, *_ in self.regions):
+            # The molecules of all contigs were written as a single region
+            contigs.update(self.fetch(columns=['contig'])['contig'].unique())
+        return sorted(contigs)
+
+    def _get_chunk_regions(self, contig, start, end):
+        selected = defaultdict(list)
+        for region_contig, region_start, region_end, chunk_index, begin, stop in self.regions:
+            if contig is not None and region_contig is not None and region_contig != contig:
+                continue
+            if start is not None and region_end is not None and region_end <= start:
+                continue
+            if end is not None and region_start is not None and region_start >= end:
+                continue
+            selected[chunk_index].append((begin, stop))
+        return selected
+
+    def fetch(self, contig=None, start=None, end=None, columns=None):
+        """Obtain the molecules of which the site (DS) is located in the region
+
+        Args:
+            contig (str) : contig to obtain the molecules for, None for all contigs
+            start (int) : start of the region (inclusive), None for the start of the contig
+            end (int) : end of the region (exclusive), None for the end of the contig
+            columns (list) : columns to load, all columns are loaded when not supplied
+
+        Returns:
+            molecules (pd.DataFrame) : one row per molecule, the string columns are categorical
+        """
+        if columns is None:
+            columns = [*MOLECULE_SUMMARY_STRING_COLUMNS, *MOLECULE_SUMMARY_NUMERIC_COLUMNS]
+        load_columns = list(columns)
+        # The columns required to filter on the region
+        for column in ('contig', 'DS'):
+            if column not in load_columns:
+                load_columns.append(column)
+
+        values = {column: [] for column in load_columns}
+        for chunk_index, row_ranges in self._get_chunk_regions(contig, start, end).items():
+            rows = np.concatenate([np.arange(begin, stop) for begin, stop in row_ranges])
+            with np.load(self.chunk_paths[chunk_index]) as chunk:
+                tables = json.loads(str(chunk['meta']))['tables']
+                for column in load_columns:
+                    column_values = chunk[column][rows]
+                    if column in tables:
+                        column_values = np.array(tables[column], dtype=object)[column_values] \
+                            if len(column_values) else np.zeros(0, dtype=object)
+                    values[column].append(column_values)
+
+        frame = pd.DataFrame({
+            column: np.concatenate(values[column]) if len(values[column]) else
+            np.zeros(0, dtype=object if column in MOLECULE_SUMMARY_STRING_COLUMNS else
+                     MOLECULE_SUMMARY_NUMERIC_COLUMNS[column][1])
+            for column in load_columns})
+
+        selected = np.ones(len(frame), dtype=bool)
+        if contig is not None:
+            selected &= (frame['contig'] == contig).values
+        if start is not None:
+            selected &= (frame['DS'] >= start).values
+        if end is not None:
+            selected &= (frame['DS'] < end).values
+        frame = frame.loc[selected, list(columns)].reset_index(drop=True)
+        for column in columns:
+            if column in MOLECULE_SUMMARY_STRING_COLUMNS:
+                frame[column] = frame[column].astype('category')
+        return frame
+
+    @staticmethod
+    def _is_counted(frame, min_mapping_quality):
+        # Identical to the read filters of get_r1_counts_per_cell and read_counts_function
+        return frame['is_read1'] & ~frame['is_qcfail'] & ~frame['is_duplicate'] & \
+            (frame['mapping_quality'] >= min_mapping_quality)
+
+    def get_molecule_counts_per_cell(self, prefix=None, min_mapping_quality=0):
+        """Obtain the amount of molecules per cell, the equivalent of get_r1_counts_per_cell
+
+        Args:
+            prefix (str) : prefix the sample names with this value: the keys become (prefix, sample)
+
+        Returns:
+            cell_obs (Counter) : {sampleA:n_molecules, sampleB:m_molecules, ...}
+        """
+        frame = self.fetch(columns=['sample', 'is_read1', 'is_qcfail', 'is_duplicate', 'mapping_quality'])
+        frame = frame[self._is_counted(frame, min_mapping_quality)]
+        counts = frame['sample'].value_counts(sort=False)
+        return Counter({(sample if prefix is None else (prefix, sample)): int(count)
+                        for sample, count in counts.items() if count > 0})
+
+    def get_cut_dictionary(self, strand_specific=False, prefix=None, min_mapping_quality=1):
+        """Obtain the cut distribution dictionary {contig: {sample: Counter(position: obs)}},
+        the equivalent of get_sc_cut_dictionary using read_counts_function
+
+        Args:
+            strand_specific (bool) : the positions become (is_reverse, position) tuples
+            prefix (str) : prefix the sample names with this value: the keys become (prefix, sample)
+        """
+        cut_sites = {}
+        for contig in self.get_contigs():
+            frame = self.fetch(contig, columns=['sample', 'DS', 'is_reverse', 'is_read1', 'is_qcfail', 'is_duplicate',
+                                                'mapping_quality'])
+            frame = frame[self._is_counted(frame, min_mapping_quality) & (frame['DS'] >= 0)]
+            cut_positions = defaultdict(Counter)
+            keys = ['sample', 'is_reverse', 'DS'] if strand_specific else ['sample', 'DS']
+            for key, count in frame.groupby(keys, observed=True).size().items():
+                if count == 0:
+                    continue
+                sample = key[0] if prefix is None else (prefix, key[0])
+                position = (bool(key[1]), int(key[2])) if strand_specific else int(key[1])
+                cut_positions[sample][position] += int(count)
+            cut_sites[contig] = cut_positions
+        return cut_sites
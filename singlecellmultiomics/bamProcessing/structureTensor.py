@@ -147,6 +147,9 @@ class TensorStackMolecule(singlecellmultiomics.molecule.Molecule):
 
 
 class SingleEndTranscriptTensorable(singlecellmultiomics.fragment.Fragment):
+
+    umi_index_compatible = False
+
     def __init__(self, reads, **kwargs):
         singlecellmultiomics.fragment.Fragment.__init__(self, reads, **kwargs)
 
@@ -8,6 +8,11 @@ from colorama import Style
 import os
 import collections
 import itertools
+import json
+import bisect
+import hashlib
+import uuid
+import numpy as np
 
 
 # http://codereview.stackexchange.com/questions/88912/create-a-list-of-all-strings-within-hamming-distance-of-a-reference-string-with
@@ -24,13 +29,195 @@ def hamming_circle(s, n, alphabet):
             yield ''.join(cousin)
 
 
+# Every base is encoded using 3 bits, the codes are non-zero such that barcodes of different lengths have different keys
+PACKED_BASE_CODES = {'A': 1, 'C': 2, 'G': 3, 'T': 4, 'N': 5}
+PACKED_MAX_LENGTH = 21
+# Translation table used to encode a barcode into an octal string, unknown characters are translated into an invalid digit
+_packed_translation = {i: '9' for i in range(256)}
+_packed_translation.update({ord(base): str(code) for base, code in PACKED_BASE_CODES.items()})
+PACKED_TABLE_MAGIC = b'SCMOBCT1'
+
+
+class PackedBarcodeTable():
+    """Compact lookup table of barcodes and their hamming distance expansion
+
+    Barcodes are stored as 3-bit packed integers in a sorted numpy array, lookups are performed using binary search
+    on a memoryview of the array, which avoids the overhead of numpy calls for single lookups.
+    Expanded barcodes which are at the same (lowest) distance of two or more barcodes are not stored,
+    identical to BarcodeParser.expand.
+
+    Args:
+        keys (np.ndarray) : sorted packed barcodes (uint64)
+        origin_ids (np.ndarray) : for every key the id of the barcode it was expanded from (int32)
+        distances (np.ndarray) : for every key the hamming distance to the barcode it was expanded from (uint8)
+        origins (list) : barcodes the table was expanded from
+        indices (list) : index of every barcode in origins
+    """
+
+    def __init__(self, keys, origin_ids, distances, origins, indices):
+        self.keys = keys
+        self.origin_ids = origin_ids
+        self.distances = distances
+        self.origins = origins
+        self.indices = indices
+        self._create_views()
+
+    def _create_views(self):
+        self._keys = memoryview(np.ascontiguousarray(self.keys))
+        self._origin_ids = memoryview(np.ascontiguousarray(self.origin_ids))
+        self._distances = memoryview(np.ascontiguousarray(self.distances))
+
+    def __getstate__(self):
+        # Memoryviews cannot be pickled, only the arrays are stored
+        return {'keys': np.asarray(self.keys),
+                'origin_ids': np.asarray(self.origin_ids),
+                'distances': np.asarray(self.distances),
+                'origins': self.origins,
+                'indices': self.indices}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._create_views()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def encode(barcode):
+        """Encode barcode as integer, returns None when the barcode cannot be encoded"""
+        if len(barcode) > PACKED_MAX_LENGTH or len(barcode) == 0:
+            return None
+        try:
+            return int(barcode.translate(_packed_translation), 8)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def can_encode(barcodes):
+        return all(
+            0 < len(barcode) <= PACKED_MAX_LENGTH and all(base in PACKED_BASE_CODES for base in barcode)
+            for barcode in barcodes)
+
+    @classmethod
+    def from_barcodes(cls, barcodes, hammingDistanceExpansion):
+        """Create the table for a barcode to index mapping
+
+        Args:
+            barcodes (dict) : barcode -> index
+            hammingDistanceExpansion (int) : include all barcodes up to this hamming distance
+
+        Returns:
+            table (PackedBarcodeTable)
+        """
+        origins = list(barcodes.keys())
+        indices = [barcodes[barcode] for barcode in origins]
+
+        # For every code the codes it can be substituted with, identical to hamming_circle using alphabet 'ACTGN'
+        alternatives = np.array([[0] * 4] +
+                                [[c for c in PACKED_BASE_CODES.values() if c != code]
+                                 for code in PACKED_BASE_CODES.values()], dtype=np.int64)
+
+        keys, origin_ids, distances = [], [], []
+        lengths = np.array([len(barcode) for barcode in origins])
+        for length in np.unique(lengths):
+            ids = np.flatnonzero(lengths == length).astype(np.int32)
+            digits = np.array([[PACKED_BASE_CODES[base] for base in origins[i]] for i in ids], dtype=np.int64)
+            weights = 8 ** np.arange(length - 1, -1, -1, dtype=np.int64)
+            codes = digits @ weights
+            for distance in range(0, min(hammingDistanceExpansion, length) + 1):
+                for positions in itertools.combinations(range(length), distance):
+                    for replacements in itertools.product(range(4), repeat=distance):
+                        mutated = codes.copy()
+                        for position, replacement in zip(positions, replacements):
+                            mutated += (alternatives[digits[:, position], replacement] -
+                                        digits[:, position]) * weights[position]
+                        keys.append(mutated)
+                        origin_ids.append(ids)
+                        distances.append(np.full(len(ids), distance, dtype=np.uint8))
+
+        if len(keys) == 0:
+            return cls(np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint8),
+                       origins, indices)
+        keys = np.concatenate(keys).astype(np.uint64)
+        origin_ids = np.concatenate(origin_ids)
+        distances = np.concatenate(distances)
+
+        # Sort on key, then on distance, and keep the closest origin when it is unique:
+        order = np.lexsort((distances, keys))
+        keys, origin_ids, distances = keys[order], origin_ids[order], distances[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        tied = np.zeros(len(keys), dtype=bool)
+        tied[:-1] = (keys[1:] == keys[:-1]) & (distances[1:] == distances[:-1])
+        keep = first & ~tied
+        return cls(keys[keep], origin_ids[keep], distances[keep], origins, indices)
+
+    def lookup(self, barcode):
+        """Obtain (index, origin barcode, hamming distance) for barcode, returns None when not present"""
+        key = self.encode(barcode)
+        if key is None:
+            return None
+        i = bisect.bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return None
+        origin_id = self._origin_ids[i]
+        return (self.indices[origin_id], self.origins[origin_id], self._distances[i])
+
+    def save(self, path):
+        """Write the table to a binary file which can be memory mapped by PackedBarcodeTable.load"""
+        meta = json.dumps({'n': len(self.keys), 'origins': self.origins, 'indices': self.indices}).encode()
+        with open(path, 'wb') as f:
+            f.write(PACKED_TABLE_MAGIC)
+            f.write(np.uint64(len(meta)).tobytes())
+            f.write(meta)
+            # Align the arrays on 8 bytes
+            f.write(b'\0' * (-(len(PACKED_TABLE_MAGIC) + 8 + len(meta)) % 8))
+            f.write(np.ascontiguousarray(self.keys, dtype=np.uint64).tobytes())
+            f.write(np.ascontiguousarray(self.origin_ids, dtype=np.int32).tobytes())
+            f.write(np.ascontiguousarray(self.distances, dtype=np.uint8).tobytes())
+
+    @classmethod
+    def load(cls, path):
+        """Load a table written by PackedBarcodeTable.save, the arrays are memory mapped"""
+        with open(path, 'rb') as f:
+            if f.read(len(PACKED_TABLE_MAGIC)) != PACKED_TABLE_MAGIC:
+                raise ValueError(f'{path} is not a packed barcode table')
+            meta_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            meta = json.loads(f.read(meta_size).decode())
+        n = meta['n']
+        offset = len(PACKED_TABLE_MAGIC) + 8 + meta_size
+        offset += -offset % 8
+        if n == 0:
+            keys, origin_ids, distances = np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint8)
+        else:
+            keys = np.memmap(path, dtype=np.uint64, mode='r', offset=offset, shape=(n,))
+            origin_ids = np.memmap(path, dtype=np.int32, mode='r', offset=offset + 8 * n, shape=(n,))
+            distances = np.memmap(path, dtype=np.uint8, mode='r', offset=offset + 12 * n, shape=(n,))
+        return cls(keys, origin_ids, distances, meta['origins'], meta['indices'])
+
+
 class BarcodeParser():
 
     def __init__(
             self,
             barcodeDirectory='barcodes',
             hammingDistanceExpansion=0,
-            spaceFill=False):
+            spaceFill=False,
+            compact=False,
+            lazy=False,
+            cache_dir=None):
+        """Parse all barcode files in barcodeDirectory
+
+        Args:
+            barcodeDirectory (str) : folder containing the barcode files, the file name (without extension) is the alias
+            hammingDistanceExpansion (int) : expand the barcodes up to this hamming distance
+            compact (bool) : store the expanded barcodes in a PackedBarcodeTable instead of a dictionary,
+                this uses far less memory and is faster to construct. Aliases with barcodes which cannot be
+                packed use a dictionary.
+            lazy (bool) : only parse and expand the barcode file of an alias when the alias is used
+            cache_dir (str) : store the expanded barcodes in this folder, and load them from this folder when the
+                barcode file and hamming distance did not change. Implies compact.
+        """
 
         barcodeDirectory = os.path.join(
             os.path.dirname(
@@ -39,73 +226,122 @@ class BarcodeParser():
         barcode_files = list(glob.glob(f'{barcodeDirectory}/*'))
 
         self.spaceFill = spaceFill
+        self.compact = compact or cache_dir is not None
+        self.cache_dir = cache_dir
         self.hammingDistanceExpansion = hammingDistanceExpansion
         self.barcodes = collections.defaultdict(
             dict)  # alias -> barcode -> index
         # alias -> barcode -> (index, hammingDistance)
         self.extendedBarcodes = collections.defaultdict(dict)
+        # alias -> PackedBarcodeTable
+        self.packedBarcodes = {}
+        # alias -> path of barcode file which is not loaded yet
+        self.pendingBarcodeFiles = {}
 
         for barcodeFile in barcode_files:
             barcodeFileAlias = os.path.splitext(
                 os.path.basename(barcodeFile))[0]
-            logging.info(f"Parsing {barcodeFile}, alias {barcodeFileAlias}")
-
-            # Decide the file type (index first or name first)
-            indexNotFirst = False
-            with open(barcodeFile) as f:
-                for i, line in enumerate(f):
-                    parts = line.strip().split()
-                    if len(parts) == 1 and ' ' in line:
-                        parts = line.strip().split(' ')
-                    if len(parts) == 1:
-                        pass
-                    elif len(parts) == 2:
-                        indexFirst = not all((c in 'ATCGNX') for c in parts[0])
-                        if not indexFirst:
-                            indexNotFirst = True
-                        # print(parts[1],indexFirst)
-
-            with open(barcodeFile) as f:
-                for i, line in enumerate(f):
-                    parts = line.strip().split()
-                    if len(parts) == 1 and ' ' in line:
-                        parts = line.strip().split(' ')
-                    if len(parts) == 1:
-                        self.addBarcode(
-                            barcodeFileAlias, barcode=parts[0], index=i)
-                        #self.barcodes[barcodeFileAlias][parts[0]] = i
-                        logging.info(
-                            f"\t{parts[0]}:{i} (No index specified in file)")
-                    elif len(parts) == 2:
-                        if indexNotFirst:
-                            barcode, index = parts
-                        else:
-                            index, barcode = parts
-                        #self.barcodes[barcodeFileAlias][barcode] = index
-
-                        # When the index is only digits, convert to integer
-                        try:
-                            if int(index)==int(str(int(index))):
-                                index = int(index)
-                            else:
-                                pass
-                        except Exception as e:
-                            pass
-                        self.addBarcode(
-                            barcodeFileAlias, barcode=barcode, index=index)
-                        logging.info(
-                            f"\t{barcode}:{index} (index was specified in file, {'index' if indexFirst else 'barcode'} on first column)")
+            self.pendingBarcodeFiles[barcodeFileAlias] = barcodeFile
+
+        if not lazy:
+            self.load_all()
+
+    def load_all(self):
+        """Load all barcode files which are not loaded yet"""
+        for alias in list(self.pendingBarcodeFiles):
+            self._load_alias(alias)
+
+    def _load_alias(self, alias):
+        barcodeFile = self.pendingBarcodeFiles.pop(alias)
+
+        cache_path = None
+        if self.cache_dir is not None and self.hammingDistanceExpansion > 0:
+            cache_path = self.get_cache_path(barcodeFile, self.hammingDistanceExpansion)
+            if os.path.exists(cache_path):
+                logging.info(f"Loading {alias} from {cache_path}")
+                self.load_packed(alias, cache_path)
+                return
+
+        self.parse_barcode_file(barcodeFile, alias)
+        if self.hammingDistanceExpansion > 0 and alias in self.barcodes:
+            self.expand(self.hammingDistanceExpansion, alias=alias)
+            if cache_path is not None and alias in self.packedBarcodes:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # Write to a temporary file first, other processes can be reading or writing the same cache file
+                temp_path = f'{cache_path}.{uuid.uuid4()}.tmp'
+                self.save_packed(alias, temp_path)
+                os.replace(temp_path, cache_path)
+
+    def get_cache_path(self, barcodeFile, hammingDistanceExpansion):
+        """Obtain the path of the cached expansion of barcodeFile, the path depends on the contents of the file"""
+        with open(barcodeFile, 'rb') as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+        alias = os.path.splitext(os.path.basename(barcodeFile))[0]
+        return os.path.join(
+            self.cache_dir,
+            f'{alias}.{content_hash}.hd{hammingDistanceExpansion}.{PACKED_TABLE_MAGIC.decode()}.bct')
+
+    def parse_barcode_file(self, barcodeFile, barcodeFileAlias):
+        """Add the barcodes in barcodeFile to barcodeFileAlias"""
+        logging.info(f"Parsing {barcodeFile}, alias {barcodeFileAlias}")
+
+        # Decide the file type (index first or name first)
+        indexNotFirst = False
+        with open(barcodeFile) as f:
+            for i, line in enumerate(f):
+                parts = line.strip().split()
+                if len(parts) == 1 and ' ' in line:
+                    parts = line.strip().split(' ')
+                if len(parts) == 1:
+                    pass
+                elif len(parts) == 2:
+                    indexFirst = not all((c in 'ATCGNX') for c in parts[0])
+                    if not indexFirst:
+                        indexNotFirst = True
+                    # print(parts[1],indexFirst)
+
+        with open(barcodeFile) as f:
+            for i, line in enumerate(f):
+                parts = line.strip().split()
+                if len(parts) == 1 and ' ' in line:
+                    parts = line.strip().split(' ')
+                if len(parts) == 1:
+                    self.addBarcode(
+                        barcodeFileAlias, barcode=parts[0], index=i)
+                    #self.barcodes[barcodeFileAlias][parts[0]] = i
+                    logging.info(
+                        f"\t{parts[0]}:{i} (No index specified in file)")
+                elif len(parts) == 2:
+                    if indexNotFirst:
+                        barcode, index = parts
                     else:
-                        e = f'The barcode file {barcodeFile} contains more than two columns. Failed to parse!'
-                        logging.error(e)
-                        raise ValueError(e)
+                        index, barcode = parts
+                    #self.barcodes[barcodeFileAlias][barcode] = index
 
-        if hammingDistanceExpansion > 0:
-            for alias in list(self.barcodes.keys()):
-                # print(alias)
-                self.expand(hammingDistanceExpansion, alias=alias)
+                    # When the index is only digits, convert to integer
+                    try:
+                        if int(index)==int(str(int(index))):
+                            index = int(index)
+                        else:
+                            pass
+                    except Exception as e:
+                        pass
+                    self.addBarcode(
+                        barcodeFileAlias, barcode=barcode, index=index)
+                    logging.info(
+                        f"\t{barcode}:{index} (index was specified in file, {'index' if indexFirst else 'barcode'} on first column)")
+                else:
+                    e = f'The barcode file {barcodeFile} contains more than two columns. Failed to parse!'
+                    logging.error(e)
+                    raise ValueError(e)
 
     def getTargetCount(self, barcodeFileAlias):
+        if barcodeFileAlias in self.pendingBarcodeFiles:
+            self._load_alias(barcodeFileAlias)
+        if barcodeFileAlias in self.packedBarcodes:
+            # The packed table also contains the barcodes at distance 0
+            return(len(self.barcodes[barcodeFileAlias]),
+                   len(self.packedBarcodes[barcodeFileAlias]) - len(self.barcodes[barcodeFileAlias]))
         return(len(self.barcodes[barcodeFileAlias]), len(self.extendedBarcodes[barcodeFileAlias]))
 
     def expand(
@@ -115,7 +351,13 @@ class BarcodeParser():
             reportCollisions=True,
             spaceFill=None):
 
+        if alias in self.pendingBarcodeFiles:
+            self._load_alias(alias)
         barcodes = self.barcodes[alias]
+        if self.compact and PackedBarcodeTable.can_encode(barcodes):
+            self.packedBarcodes[alias] = PackedBarcodeTable.from_barcodes(barcodes, hammingDistanceExpansion)
+            return
+
         # hammingBarcode -> ( ( distance,origin) )
         hammingSpace = collections.defaultdict(list)
         for barcode in barcodes:
@@ -270,6 +512,8 @@ class BarcodeParser():
             index,
             hammingDistance=0,
             originBarcode=None):
+        if barcodeFileAlias in self.pendingBarcodeFiles:
+            self._load_alias(barcodeFileAlias)
         if hammingDistance == 0:
             self.barcodes[barcodeFileAlias][barcode] = index
         else:
@@ -278,15 +522,35 @@ class BarcodeParser():
             self.extendedBarcodes[barcodeFileAlias][barcode] = (
                 index, originBarcode, hammingDistance)
 
+    def save_packed(self, alias, path):
+        """Write the expanded barcodes of alias to a file which can be loaded using load_packed"""
+        if alias not in self.packedBarcodes:
+            raise ValueError(f'{alias} has no packed barcode table, expand it using a compact BarcodeParser')
+        self.packedBarcodes[alias].save(path)
+
+    def load_packed(self, alias, path):
+        """Load expanded barcodes of alias written by save_packed"""
+        self.pendingBarcodeFiles.pop(alias, None)
+        table = PackedBarcodeTable.load(path)
+        for barcode, index in zip(table.origins, table.indices):
+            self.barcodes[alias][barcode] = index
+        self.packedBarcodes[alias] = table
+
     # get index and hamming distance to barcode  returns none if not Available
     def getIndexCorrectedBarcodeAndHammingDistance(self, barcode, alias):
+        if alias in self.pendingBarcodeFiles:
+            self._load_alias(alias)
         if barcode in self.barcodes[alias]:
             return (self.barcodes[alias][barcode], barcode, 0)
+        if alias in self.packedBarcodes:
+            result = self.packedBarcodes[alias].lookup(barcode)
+            return (None, None, None) if result is None else result
         if barcode in self.extendedBarcodes[alias]:
             return self.extendedBarcodes[alias][barcode]
         return (None, None, None)
 
     def list(self, showBarcodes=5):  # showBarcodes=None show all
+        self.load_all()
         for barcodeAlias, mapping in self.barcodes.items():
             print(
                 f'{len(mapping)} barcodes{Style.DIM} obtained from {Style.RESET_ALL}{barcodeAlias}')
@@ -304,4 +568,5 @@ class BarcodeParser():
                         (len(mapping) - showBarcodes))
 
     def getBarcodeMapping(self):
+        self.load_all()
         return self.barcodes
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from array import array
+import gzip
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.io
+
+
+class SparseCountTable():
+    """Count table which stores the counts as sparse (feature, sample) coordinates.
+
+    Samples and features are interned to integer ids, every increment is appended to a coordinate buffer.
+    When the buffer is full the increments are summed per (feature, sample) pair, memory usage scales with the
+    amount of non-zero entries instead of with features x samples.
+
+    Example:
+        >>> table = SparseCountTable()
+        >>> table.add(('cellA',), ('chr1', 0, 100_000), 1)
+        >>> table.add(('cellB',), ('chr1', 0, 100_000), 0.5)
+        >>> table.to_sparse() # features x samples scipy.sparse.csr_matrix
+        >>> table.to_dataframe() # identical to pd.DataFrame.from_dict of a {sample:{feature:count}} dictionary
+    """
+
+    def __init__(self, buffer_size=1_000_000):
+        """Initialise SparseCountTable
+
+        Args:
+            buffer_size (int) : amount of increments to buffer before the increments are summed
+        """
+        self.buffer_size = buffer_size
+        self.samples = {}  # sample -> sample id
+        self.features = {}  # feature -> feature id
+        # Samples which have been incremented using a non-integer value
+        self.float_samples = set()
+
+        self.buffer_features = array('q')
+        self.buffer_samples = array('q')
+        self.buffer_values = array('d')
+        self.n_increments = 0  # amount of increments summed so far
+
+        # Summed entries, key is feature_id << 32 | sample_id, order is the index of the first increment
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0, dtype=np.float64)
+        self.order = np.zeros(0, dtype=np.int64)
+
+    def add(self, sample, feature, value):
+        """Add value to the count of feature in sample"""
+        sample_id = self.samples.setdefault(sample, len(self.samples))
+        self.buffer_samples.append(sample_id)
+        self.buffer_features.append(self.features.setdefault(feature, len(self.features)))
+        self.buffer_values.append(value)
+        if type(value) is not int:
+            self.float_samples.add(sample_id)
+        if len(self.buffer_values) >= self.buffer_size:
+            self._flush()
+
+    def __len__(self):
+        """Amount of (feature, sample) pairs with a count"""
+        self._flush()
+        return len(self.keys)
+
+    def _flush(self):
+        if len(self.buffer_values) == 0:
+            return
+        keys = (np.frombuffer(self.buffer_features, dtype=np.int64) << 32) | \
+            np.frombuffer(self.buffer_samples, dtype=np.int64)
+        order = self.n_increments + np.arange(len(keys), dtype=np.int64)
+
+        keys = np.concatenate((self.keys, keys))
+        values = np.concatenate((self.values, np.frombuffer(self.buffer_values, dtype=np.float64)))
+        order = np.concatenate((self.order, order))
+        # The previously summed entries come first, so return_index points to the first increment of every key
+        self.keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        self.values = np.bincount(inverse, weights=values, minlength=len(self.keys))
+        self.order = order[first]
+
+        self.n_increments += len(self.buffer_values)
+        self.buffer_features = array('q')
+        self.buffer_samples = array('q')
+        self.buffer_values = array('d')
+        # Grow the buffer with the table, this keeps the amortised cost of summing linear
+        self.buffer_size = max(self.buffer_size, len(self.keys))
+
+    def merge(self, other):
+        """Add the counts of other to this table.
+
+        The counts of other are added as if the increments of other were added after the increments of this table,
+        merging the tables of consecutive parts of the data yields the same table as counting all data at once.
+
+        Args:
+            other (SparseCountTable) : table to add
+        """
+        feature_ids, sample_ids, values = other.get_coordinates()
+        samples = other.get_sample_labels()
+        features = other.get_feature_labels()
+        # Add the entries in order of their first increment, this keeps the order of the samples and features
+        for index in np.argsort(other.order, kind='stable').tolist():
+            self.buffer_samples.append(self.samples.setdefault(samples[sample_ids[index]], len(self.samples)))
+            self.buffer_features.append(self.features.setdefault(features[feature_ids[index]], len(self.features)))
+            self.buffer_values.append(values[index])
+        for sample_id in other.float_samples:
+            self.float_samples.add(self.samples[samples[sample_id]])
+        if len(self.buffer_values) >= self.buffer_size:
+            self._flush()
+
+    def get_coordinates(self):
+        """Obtain the summed entries
+
+        Returns:
+            feature_ids (np.array)
+            sample_ids (np.array)
+            values (np.array)
+        """
+        self._flush()
+        return self.keys >> 32, self.keys & 0xffffffff, self.values
+
+    def to_sparse(self):
+        """Obtain the counts as scipy.sparse.csr_matrix, the rows are the features and the columns the samples.
+        The labels of the rows and columns are obtained using get_feature_labels and get_sample_labels
+        """
+        feature_ids, sample_ids, values = self.get_coordinates()
+        return scipy.sparse.csr_matrix(
+            (values, (feature_ids, sample_ids)), shape=(len(self.features), len(self.samples)))
+
+    def get_feature_labels(self):
+        return list(self.features)
+
+    def get_sample_labels(self):
+        return list(self.samples)
+
+    def to_dataframe(self):
+        """Obtain the counts as dense pandas DataFrame, identical to pd.DataFrame.from_dict of a
+        {sample:{feature:count}} dictionary: features without counts in a sample are NaN,
+        the features are ordered by the sample in which they were first observed
+        """
+        feature_ids, sample_ids, values = self.get_coordinates()
+        # Order the features like the union of the features of all samples
+        entry_order = np.lexsort((self.order, sample_ids))
+        ordered_features = feature_ids[entry_order]
+        _, first = np.unique(ordered_features, return_index=True)
+        feature_order = ordered_features[np.sort(first)]
+        row_of_feature = np.empty(len(self.features), dtype=np.int64)
+        row_of_feature[feature_order] = np.arange(len(feature_order))
+
+        matrix = np.full((len(feature_order), len(self.samples)), np.nan)
+        matrix[row_of_feature[feature_ids], sample_ids] = values
+        feature_labels = self.get_feature_labels()
+        df = pd.DataFrame(
+            matrix,
+            index=pd.Index([feature_labels[i] for i in feature_order.tolist()]),
+            columns=pd.Index(self.get_sample_labels()))
+
+        # Columns with only integer increments and a value for every feature are integer columns
+        for sample_id, sample in enumerate(self.samples):
+            if sample_id not in self.float_samples and not np.isnan(matrix[:, sample_id]).any():
+                df[sample] = df[sample].astype(np.int64)
+        return df
+
+    def write_sparse(self, path):
+        """Write the counts to a sparse matrix file
+
+        When the path ends with .npz the matrix is written using scipy.sparse.save_npz,
+        otherwise in MatrixMarket format (gzipped when the path ends with .gz).
+        The labels of the features (rows) and samples (columns) are written to
+        {path}.features.tsv.gz and {path}.samples.tsv.gz
+
+        Args:
+            path (str) : path to write the matrix to
+        """
+        matrix = self.to_sparse()
+        if path.endswith('.npz'):
+            scipy.sparse.save_npz(path, matrix)
+        elif path.endswith('.gz'):
+            with gzip.open(path, 'wb') as f:
+                scipy.io.mmwrite(f, matrix)
+        else:
+            scipy.io.mmwrite(path, matrix)
+
+        for name, labels in (('features', self.get_feature_labels()), ('samples', self.get_sample_labels())):
+            with gzip.open(f'{path}.{name}.tsv.gz', 'wt') as f:
+                for label in labels:
+                    f.write('\t'.join(map(str, label)) if isinstance(label, tuple) else str(label))
+                    f.write('\n')
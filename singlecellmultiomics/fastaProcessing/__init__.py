@@ -1 +1 @@
-from .fastaHandle import CachedFastaNoHandle, CachedFasta
+from .fastaHandle import CachedFastaNoHandle, CachedFasta, WindowedFastaNoHandle
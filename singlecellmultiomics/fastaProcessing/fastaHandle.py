@@ -1,5 +1,7 @@
 from pysamiterators import CachedFasta
 from pysam import FastaFile
+from singlecellmultiomics.utils.prefetch import Prefetcher
+import numpy as np
 
 
 class CachedFastaNoHandle(CachedFasta):
@@ -12,3 +14,129 @@ class FastaNoHandle(FastaFile):
     def __init__(self, path: str):
         handle = FastaFile(path)
         FastaFile.__init__(self, handle)
+
+
+# Codes of the methylation context of a C, UNKNOWN_CONTEXT is used when the context lies outside the window
+NO_CONTEXT, CPG_CONTEXT, CHG_CONTEXT, CHH_CONTEXT, UNKNOWN_CONTEXT = 0, 1, 2, 3, 255
+
+
+def get_methylation_context_codes(sequence: str) -> tuple:
+    """Obtain the methylation context (CpG/CHG/CHH) of every position of sequence for both strands
+
+    Args:
+        sequence (str) : reference sequence
+
+    Returns:
+        forward (bytes) : context code of every position for a C on the forward strand
+        reverse (bytes) : context code of every position for a G (C on the reverse strand)
+    """
+    seq = np.frombuffer(sequence.upper().encode(), dtype=np.uint8)
+    complement = np.frombuffer(sequence.upper().translate(str.maketrans('ACGT', 'TGCA')).encode(), dtype=np.uint8)
+    acgt = np.isin(seq, np.frombuffer(b'ACGT', dtype=np.uint8))
+    act = np.isin(seq, np.frombuffer(b'ACT', dtype=np.uint8))
+    comp_act = np.isin(complement, np.frombuffer(b'ACT', dtype=np.uint8))
+    g = seq == ord('G')
+    c = seq == ord('C')
+
+    def classify(is_c, first_g, first_h, second_g, second_h, second_acgt):
+        codes = np.full(len(seq), NO_CONTEXT, dtype=np.uint8)
+        codes[is_c & first_h & second_h] = CHH_CONTEXT
+        codes[is_c & first_h & second_g] = CHG_CONTEXT
+        codes[is_c & first_g & second_acgt] = CPG_CONTEXT
+        return codes
+
+    def shifted(values, offset):
+        # values[i + offset], False outside the sequence
+        result = np.zeros(len(values), dtype=bool)
+        if offset > 0:
+            result[:-offset] = values[offset:]
+        else:
+            result[-offset:] = values[:len(values) + offset]
+        return result
+
+    forward = classify(c, shifted(g, 1), shifted(act, 1), shifted(g, 2), shifted(act, 2), shifted(acgt, 2))
+    # The complement of a G is a C, the context of the reverse strand is read towards the left
+    reverse = classify(g, shifted(c, -1), shifted(comp_act, -1), shifted(c, -2), shifted(comp_act, -2), shifted(acgt, -2))
+    # The context of the positions at the edges depends on bases outside the sequence
+    forward[max(0, len(seq) - 2):] = UNKNOWN_CONTEXT
+    reverse[:2] = UNKNOWN_CONTEXT
+    return forward.tobytes(), reverse.tobytes()
+
+
+class WindowedFastaNoHandle(Prefetcher):
+    """Reference fasta file which keeps the sequence of the prefetched region in memory.
+
+    prefetch(contig, start, end) returns a copy which loads the region (plus padding) at once, the sequence
+    is then obtained by slicing. The methylation context of every position in the window is available
+    using get_methylation_context_code. Sequences outside the window are obtained as by CachedFasta;
+    the complete contig is loaded.
+    """
+
+    def __init__(self, path: str, padding: int = 10_000):
+        self.path = path
+        self.padding = padding
+        self.handle = None
+        self.window_contig = None
+        self.window_start = 0
+        self.window_sequence = ''
+        self.context_codes = None
+        self.cached_contig = None
+        self.cached_sequence = None
+
+    def __getstate__(self):
+        # The handle cannot be pickled, it is opened again when required
+        state = self.__dict__.copy()
+        state['handle'] = None
+        state['cached_contig'] = None
+        state['cached_sequence'] = None
+        return state
+
+    def get_handle(self) -> FastaFile:
+        if self.handle is None:
+            self.handle = FastaFile(self.path)
+        return self.handle
+
+    @property
+    def references(self):
+        return self.get_handle().references
+
+    def _prefetch(self, contig, start, end):
+        self.context_codes = None
+        if start is None or end is None:
+            self.window_contig = None
+            self.window_sequence = ''
+            return
+        self.window_contig = contig
+        self.window_start = max(0, start - self.padding)
+        self.window_sequence = self.get_handle().fetch(contig, self.window_start, end + self.padding)
+
+    def fetch(self, chromosome=None, start=None, end=None):
+        if chromosome == self.window_contig and start is not None and end is not None and \
+                self.window_start <= start and end <= self.window_start + len(self.window_sequence):
+            return self.window_sequence[start - self.window_start:end - self.window_start]
+
+        if chromosome != self.cached_contig:
+            self.cached_sequence = self.get_handle().fetch(chromosome)
+            self.cached_contig = chromosome
+        return self.cached_sequence[start:end]
+
+    def get_methylation_context_code(self, chromosome, position, strand):
+        """Obtain the methylation context code of a position
+
+        Args:
+            chromosome (str) : contig
+            position (int) : reference position (zero based)
+            strand (bool) : False for a C on the forward strand, True for a G (C on the reverse strand)
+
+        Returns:
+            code (int) : NO_CONTEXT, CPG_CONTEXT, CHG_CONTEXT or CHH_CONTEXT, None when the context is not known
+        """
+        if chromosome != self.window_contig:
+            return None
+        index = position - self.window_start
+        if index < 0 or index >= len(self.window_sequence):
+            return None
+        if self.context_codes is None:
+            self.context_codes = get_methylation_context_codes(self.window_sequence)
+        code = self.context_codes[1 if strand else 0][index]
+        return None if code == UNKNOWN_CONTEXT else code
@@ -1,7 +1,85 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import gzip
+import io
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from singlecellmultiomics.pyutils.handlelimiter import HandleLimiter
+from singlecellmultiomics.bamProcessing.bamFunctions import BGZF_EOF, write_bgzf_blocks
+
+
+def _compress_bgzf(data, compresslevel):
+    buffer = io.BytesIO()
+    write_bgzf_blocks(buffer, data, compresslevel=compresslevel)
+    return buffer.getvalue()
+
+
+class BgzfWriter:
+    """Text mode writer for BGZF compressed files, the compression is performed in a pool of threads.
+
+    The written text is gathered in a buffer, full buffers are compressed into BGZF blocks by the threads
+    (zlib releases the GIL) and written to the file in order. BGZF files are valid gzip files which can
+    additionally be indexed and read in parallel.
+
+    Example:
+        >>> with BgzfWriter('./R1.fastq.gz', threads=4) as f:
+        >>>     f.write('@read\nACGT\n+\nEEEE\n')
+    """
+
+    def __init__(self, path, compresslevel=1, threads=4, buffer_size=0xff00 * 64):
+        """Initialise BgzfWriter
+
+        Args:
+            path (str) : path to write the BGZF file to
+            compresslevel (int) : zlib compression level (1-9), lower levels compress faster, higher levels yield smaller files
+            threads (int) : amount of compression threads
+            buffer_size (int) : amount of bytes to compress in a single task
+        """
+        self.handle = open(path, 'wb')
+        self.compresslevel = compresslevel
+        self.threads = max(1, threads)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.pending = collections.deque()
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self._submit()
+
+    def _submit(self):
+        if self.buffered == 0:
+            return
+        data = ''.join(self.buffer).encode()
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.pool.submit(_compress_bgzf, data, self.compresslevel))
+        # Limit the amount of buffers in memory
+        while len(self.pending) > 2 * self.threads:
+            self.handle.write(self.pending.popleft().result())
+
+    def flush(self):
+        self._submit()
+        while len(self.pending):
+            self.handle.write(self.pending.popleft().result())
+        self.handle.flush()
+
+    def close(self):
+        if self.handle.closed:
+            return
+        self.flush()
+        self.pool.shutdown()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class FastqHandle:
@@ -10,23 +88,35 @@ class FastqHandle:
             path,
             pairedEnd=False,
             single_cell=False,
-            maxHandles=500):
+            maxHandles=500,
+            compression_threads=None,
+            compresslevel=1):
+        """Initialise FastqHandle
+
+        Args:
+            path (str) : prefix of the output files
+            pairedEnd (bool) : write R1 and R2 files
+            single_cell (bool) : write a separate file for every cell
+            maxHandles (int) : maximum amount of opened handles when single_cell is enabled
+            compression_threads (int) : when supplied, the files are written as BGZF using this amount of
+                compression threads. The files are otherwise compressed using gzip on the calling thread.
+            compresslevel (int) : compression level (1-9), lower is faster, higher yields smaller files
+        """
         self.pe = pairedEnd
         self.sc = single_cell
         self.path = path
         if not self.sc:
+            def open_handle(p):
+                if compression_threads is not None:
+                    return BgzfWriter(p, compresslevel=compresslevel, threads=compression_threads)
+                return gzip.open(p, 'wt', compresslevel=compresslevel)
+
             if pairedEnd:
                 self.handles = [
-                    gzip.open(
-                        path +
-                        'R1.fastq.gz',
-                        'wt',compresslevel=1),
-                    gzip.open(
-                        path +
-                        'R2.fastq.gz',
-                        'wt',compresslevel=1)]
+                    open_handle(path + 'R1.fastq.gz'),
+                    open_handle(path + 'R2.fastq.gz')]
             else:
-                self.handles = [gzip.open(path + 'reads.fastq.gz', 'wt')]
+                self.handles = [open_handle(path + 'reads.fastq.gz')]
         else:
 
             self.handles = HandleLimiter(
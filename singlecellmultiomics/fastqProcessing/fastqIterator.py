@@ -1,7 +1,13 @@
 # Fastq iterator class, Buys de Barbanson
 import collections
+import gc
 import gzip
 import os
+import itertools
+import threading
+import queue
+import subprocess
+from shutil import which
 
 FastqRecord = collections.namedtuple(
     'FastqRecord', 'header sequence plus qual')
@@ -45,3 +51,194 @@ class FastqIterator():
         if any((len(rec.header) == 0 for rec in records)):
             raise StopIteration
         return(records)
+
+
+def _build_records(headers, sequences, plusses, quals):
+    """Build a list of FastqRecords
+
+    The garbage collector is paused while the records are created, the records only contain strings and cannot
+    form reference cycles. Otherwise the allocation of many records triggers many (expensive) collections.
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return list(map(FastqRecord, headers, sequences, plusses, quals))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _read_chunks(handle, chunk_size):
+    while True:
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _read_chunks_threaded(handle, chunk_size, max_chunks=4):
+    """Read chunks from handle in a separate thread, the decompression of gzip files releases the GIL
+
+    The reader thread is stopped and joined when the generator is closed, also when it is not exhausted
+    """
+    chunks = queue.Queue(max_chunks)
+    stop = threading.Event()
+
+    def put(item):
+        # Wait for room in the queue, unless the consumer stopped reading
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for chunk in _read_chunks(handle, chunk_size):
+                if not put(chunk):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        # Drain the queue such that a reader waiting for room can notice the stop event, then join it
+        while thread.is_alive():
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                thread.join(0.1)
+
+
+def open_fastq_binary(path, decompressor='python'):
+    """Open a (gzipped) fastq file for reading bytes
+
+    Args:
+        path (str) : path to fastq file, files ending on .gz are decompressed
+        decompressor (str) : 'python' to decompress using the gzip module, 'igzip' or 'pigz' to decompress
+            in a subprocess using that tool, 'auto' to use igzip or pigz when available
+
+    Returns:
+        handle : file like object to read the decompressed bytes from
+        process : subprocess.Popen used for decompression, or None
+    """
+    if os.path.splitext(path)[1] != '.gz':
+        return open(path, 'rb'), None
+
+    if decompressor == 'auto':
+        decompressor = next((tool for tool in ('igzip', 'pigz') if which(tool) is not None), 'python')
+    if decompressor == 'python':
+        return gzip.open(path, 'rb'), None
+    if decompressor in ('igzip', 'pigz'):
+        if which(decompressor) is None:
+            raise ValueError(f'{decompressor} is not available')
+        process = subprocess.Popen([decompressor, '-dc', path], stdout=subprocess.PIPE)
+        return process.stdout, process
+    raise ValueError(f'Unknown decompressor {decompressor}')
+
+
+def read_fastq_blocks(path, chunk_size=4 * 1024 * 1024, threaded=True, decompressor='python'):
+    """Read the records of a fastq file in blocks
+
+    The file is decompressed in large blocks which are split into lines at once,
+    the records are identical to the records obtained using FastqIterator.
+
+    Args:
+        path (str) : path to fastq file
+        chunk_size (int) : amount of decompressed bytes to read at once
+        threaded (bool) : read and decompress in a separate thread
+        decompressor (str) : see open_fastq_binary
+
+    Yields:
+        records (list) : list of FastqRecord, the list ends at the first record with an empty header
+    """
+    handle, process = open_fastq_binary(path, decompressor=decompressor)
+    chunks = None
+    try:
+        chunks = _read_chunks_threaded(handle, chunk_size) if threaded else _read_chunks(handle, chunk_size)
+        remainder = b''
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is None:
+                # End of the file, the last line does not need to end with a newline:
+                if len(remainder) == 0:
+                    break
+                text = remainder.decode()
+                lines = text.split('\n')
+                lines += [''] * (-len(lines) % 4)
+            else:
+                data = remainder + chunk
+                end = data.rfind(b'\n')
+                if end == -1:
+                    remainder = data
+                    continue
+                text = data[:end].decode()
+                lines = text.split('\n')
+                # Keep the lines of incomplete records for the next block
+                n_complete = len(lines) - len(lines) % 4
+                remainder = b''.join(line.encode() + b'\n' for line in lines[n_complete:]) + data[end + 1:]
+                del lines[n_complete:]
+
+            # Remove trailing whitespace, identical to FastqIterator
+            lines = list(map(str.rstrip, lines))
+
+            headers = lines[0::4]
+            records = _build_records(headers, lines[1::4], lines[2::4], lines[3::4])
+            if '' in headers:
+                yield records[:headers.index('')]
+                return
+            yield records
+    finally:
+        # Stop the reader thread before the handle is closed
+        if chunks is not None:
+            chunks.close()
+        handle.close()
+        if process is not None:
+            process.wait()
+
+
+class FastqBatchIterator():
+    """Iterates over batches of records of one or more fastq files.
+
+    The files are read using read_fastq_blocks, which is much faster than FastqIterator.
+    Every batch is a list of tuples with a FastqRecord for every file, identical to the records yielded by
+    FastqIterator.
+
+    Example:
+        >>> for batch in FastqBatchIterator('./R1.fastq.gz', './R2.fastq.gz'):
+        >>>     for rec1, rec2 in batch:
+        >>>         ...
+    """
+
+    def __init__(self, *paths, batch_size=10_000, **kwargs):
+        """Initialise FastqBatchIterator.
+
+        Args:
+            paths : paths to the fastq files
+            batch_size (int) : maximum amount of records per batch
+            **kwargs : arguments passed to read_fastq_blocks
+        """
+        self.batch_size = batch_size
+        self.records = zip(*(itertools.chain.from_iterable(read_fastq_blocks(path, **kwargs)) for path in paths))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = list(itertools.islice(self.records, self.batch_size))
+        if len(batch) == 0:
+            raise StopIteration
+        return batch
@@ -1 +1,3 @@
 from .features import FeatureContainer, FeatureAnnotatedObject
+from .gtfStore import GTFStore
+from .intervalIndex import IntervalIndex
@@ -10,6 +10,8 @@ from singlecellmultiomics.utils import Prefetcher
 from copy import copy
 import collections
 import pandas as pd
+from singlecellmultiomics.features.gtfStore import GTFStore, parse_gtf_attributes
+from singlecellmultiomics.features.intervalIndex import IntervalIndex
 
 def get_gene_id_to_gene_name_conversion_table(annotation_path_exons,
                                               featureTypes=['gene_name']):
@@ -107,7 +109,14 @@ class FeatureContainer(Prefetcher):
                 region_start=None, region_end=None):
         """Load annotations from a GTF file.
         ignChr: ignore the chr part of the Annotation chromosome
+        When path points to a GTF store (see GTFStore), the features are loaded from the store.
         """
+        if GTFStore.is_store(path):
+            self.loadGTFStore(path, thirdOnly=thirdOnly, identifierFields=identifierFields, ignChr=ignChr,
+                              select_feature_type=select_feature_type, exon_select=exon_select, head=head,
+                              store_all=store_all, contig=contig, offset=offset,
+                              region_start=region_start, region_end=region_end)
+            return
         if region_end is not None or region_start is not None:
             assert contig is not None and region_end is not None and region_start is not None
 
@@ -161,57 +170,11 @@ class FeatureContainer(Prefetcher):
                     if exon_select is not None and exon not in exon_select:
                         continue
 
-                    keyValues = {}
-                    for part in parts[-1].split(';'):
-                        kv = part.strip().split()
-                        if len(kv) == 2:
-                            key = kv[0]
-                            value = kv[1].replace('"', '')
-                            keyValues[key] = value
-
-                    #self.addFeature( self.remapKeys.get(parts[0], parts[0]), int(parts[3]), int(parts[4]), parts[9].replace('"','').replace(';',''))
-
-                    chrom = self.remapKeys.get(chrom, chrom)
-                    chromosome = chrom if ignChr == False else chrom.replace(
-                        'chr', '')
-
-                    if identifierFields is None:
-                        if parts[2] == 'exon':
-                            featureName = keyValues['exon_id']
-                            #featureName = ','.join([keyValues['exon_id'],keyValues['transcript_id']])
-                        elif parts[2] == 'gene':
-                            featureName = keyValues['gene_id']
-                        elif parts[2] == 'transcript':
-                            featureName = keyValues['transcript_id']
-                        else:
-                            featureName = ','.join(
-                                [parts[2], parts[3], parts[4], keyValues['transcript_id']])
-                    else:
-                        featureName = ','.join(
-                            [keyValues.get(i, 'none') for i in identifierFields if i in keyValues])
-
-
-                    start = int( parts[3] ) + offset
-                    end = int( parts[4] ) + offset
-
-                    if region_end is not None and region_start is not None and ( end<region_start or start>region_end):
-                        continue
-
-                    if store_all:
-                        keyValues['type'] = parts[2]
-                        self.addFeature(
-                            self.remapKeys.get(
-                                chromosome, chromosome),start,end, strand=parts[6], name=featureName, data=tuple(
-                                keyValues.items()))
-
-                    else:
-                        self.addFeature(
-                            self.remapKeys.get(
-                                chromosome, chromosome), start,end, strand=parts[6], name=featureName, data=','.join(
-                                (':'.join(
-                                    ('type', parts[2])), ':'.join(
-                                    ('gene_id', keyValues['gene_id'])))))
-                    added += 1
+                    keyValues = parse_gtf_attributes(parts[-1])
+                    if self._add_gtf_feature(parts, keyValues, identifierFields=identifierFields, ignChr=ignChr,
+                                             store_all=store_all, offset=offset,
+                                             region_start=region_start, region_end=region_end):
+                        added += 1
 
             if self.verbose:
                 print("Loaded %s features, now sorting" %
@@ -223,6 +186,99 @@ class FeatureContainer(Prefetcher):
             print("The following chromosomes are available:")
             print(', '.join(sorted(list(self.startCoordinates.keys()))))
 
+    def _add_gtf_feature(self, parts, keyValues, identifierFields, ignChr, store_all, offset,
+                         region_start, region_end):
+        """Add a GTF feature, parts are the columns of the GTF line and keyValues the parsed attributes
+
+        Returns:
+            added (bool) : True when the feature was added, False when the feature is outside the region
+        """
+        chrom = parts[0]
+        #self.addFeature( self.remapKeys.get(parts[0], parts[0]), int(parts[3]), int(parts[4]), parts[9].replace('"','').replace(';',''))
+
+        chrom = self.remapKeys.get(chrom, chrom)
+        chromosome = chrom if ignChr == False else chrom.replace(
+            'chr', '')
+
+        if identifierFields is None:
+            if parts[2] == 'exon':
+                featureName = keyValues['exon_id']
+                #featureName = ','.join([keyValues['exon_id'],keyValues['transcript_id']])
+            elif parts[2] == 'gene':
+                featureName = keyValues['gene_id']
+            elif parts[2] == 'transcript':
+                featureName = keyValues['transcript_id']
+            else:
+                featureName = ','.join(
+                    [parts[2], parts[3], parts[4], keyValues['transcript_id']])
+        else:
+            featureName = ','.join(
+                [keyValues.get(i, 'none') for i in identifierFields if i in keyValues])
+
+        start = int( parts[3] ) + offset
+        end = int( parts[4] ) + offset
+
+        if region_end is not None and region_start is not None and ( end<region_start or start>region_end):
+            return False
+
+        if store_all:
+            keyValues['type'] = parts[2]
+            self.addFeature(
+                self.remapKeys.get(
+                    chromosome, chromosome),start,end, strand=parts[6], name=featureName, data=tuple(
+                    keyValues.items()))
+
+        else:
+            self.addFeature(
+                self.remapKeys.get(
+                    chromosome, chromosome), start,end, strand=parts[6], name=featureName, data=','.join(
+                    (':'.join(
+                        ('type', parts[2])), ':'.join(
+                        ('gene_id', keyValues['gene_id'])))))
+        return True
+
+    def loadGTFStore(self, path, thirdOnly=None, identifierFields=['gene_id'],
+                     ignChr=False, select_feature_type=None, exon_select=None,
+                     head=None, store_all=False, contig=None, offset=-1,
+                     region_start=None, region_end=None):
+        """Load annotations from a GTF store created by GTFStore.create, the arguments are identical to loadGTF.
+
+        Only the features overlapping the region are read from the (memory mapped) store.
+        """
+        if region_end is not None or region_start is not None:
+            assert contig is not None and region_end is not None and region_start is not None
+        self.loadedGtfFeatures = thirdOnly
+
+        types = None
+        for selection in (thirdOnly, select_feature_type):
+            if selection is not None:
+                types = set(selection) if types is None else types.intersection(selection)
+
+        store = GTFStore(path)
+        added = 0
+        for store_contig in (store.contigs if contig is None else [contig]):
+            # Stop loading all contigs when head features have been loaded, identical to loadGTF
+            if head is not None and added > head:
+                break
+            features = store.fetch(store_contig,
+                                   region_start=None if region_start is None else region_start - offset,
+                                   region_end=None if region_end is None else region_end - offset,
+                                   types=types)
+            for chrom, feature_type, start, end, strand, frame, keyValues in features:
+                if head is not None and added > head:
+                    break
+                if exon_select is not None and frame not in exon_select:
+                    continue
+                parts = [chrom, None, feature_type, str(start), str(end), None, strand, frame]
+                if self._add_gtf_feature(parts, keyValues, identifierFields=identifierFields, ignChr=ignChr,
+                                         store_all=store_all, offset=offset,
+                                         region_start=region_start, region_end=region_end):
+                    added += 1
+        if self.verbose:
+            print("Loaded %s features from %s, now sorting" %
+                  (sum([len(self.features[c]) for c in self.features]), path))
+        self.sort()
+
     def annotateUTRs(self, utrs=['three_prime_utr', 'five_prime_utr']):
         """flag the exons that contain a utr"""
 
@@ -388,49 +444,48 @@ class FeatureContainer(Prefetcher):
             sampleStart,
             sampleEnd,
             strand=None):
-
+        """Obtain all features overlapping the region sampleStart-sampleEnd (inclusive) and optionally strand."""
+        if not self.sorted:
+            self.sort()
         if chromosome not in self.startCoordinates:
             if self.debug:
                 self.debugMsg(
                     "Chromosome %s is not present in the annotations" %
                     chromosome)
             return([])
-        startIndex = max(
-            0,
-            np.searchsorted(
-                self.startCoordinates[chromosome],
-                sampleStart,
-                'left') - 1)
-        startIndex = min(
-            startIndex, max(
-                0, np.searchsorted(
-                    self.endCoordinates[chromosome], sampleEnd, 'left')))
-        hits = set()
-        x = True
-        while(x and startIndex < len(self.features[chromosome])):
-            d = self.features[chromosome][startIndex]
-            (hitStart, hitEnd, name, hitStrand, data) = d
-            if hitStart > sampleEnd:
-                x = False
-            else:
-                # Does the feature overlap the sampling region
-                if(max(sampleStart, hitStart) <= min(sampleEnd, hitEnd)):
-                    #print(sampleStart,sampleEnd, hitStart,hitEnd, name)
-                    # Check the strand
-                    if strand is None or (strand == hitStrand):
-                        hits.add(d)
-            startIndex += 1
+        _, feature_indices = self.intervalIndex[chromosome].query(
+            [sampleStart], [sampleEnd], strand)
+        return([self.features[chromosome][i] for i in feature_indices.tolist()])
+
+    def findFeaturesBetweenBatch(
+            self,
+            chromosome,
+            sampleStarts,
+            sampleEnds,
+            strands=None):
+        """Obtain the features overlapping many regions at once.
 
-        hits.update(set(self.findFeaturesAt(chromosome, sampleStart, strand)))
-        hits.update(set(self.findFeaturesAt(chromosome, sampleEnd, strand)))
+        Args:
+            chromosome (str) : chromosome of the regions
+            sampleStarts (iterable) : start coordinates of the regions (inclusive)
+            sampleEnds (iterable) : end coordinates of the regions (inclusive)
+            strands : None to ignore the strand, a single strand for all regions or a strand for every region
 
-        return(list(hits))
+        Returns:
+            region_indices (np.array) : index of the region for every hit
+            feature_indices (np.array) : index of the feature in self.features[chromosome] for every hit
+        """
+        if not self.sorted:
+            self.sort()
+        if chromosome not in self.intervalIndex:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return self.intervalIndex[chromosome].query(sampleStarts, sampleEnds, strands)
 
     def sort(self):
         """ Build coordinate sorted datastructure to perform fast lookups."""
         self.endIndexes = {}
         self.endIndexLookup = {}
-        self.fastIndex = {}
+        self.intervalIndex = {}
         self.maxFeatureSizes = {}
         self.sorted = True
         for chromosome in self.features.keys():
@@ -447,22 +502,12 @@ class FeatureContainer(Prefetcher):
                 inR: orig for orig, inR in enumerate(
                     self.endIndexes[chromosome])}
 
-            ####################### perform magic indexing ####################
-            maxLengthFeature = np.max([tup[1] - tup[0]
-                                       for tup in self.features[chromosome]])
-            self.maxFeatureSizes[chromosome] = maxLengthFeature
-
-            lowestStarts = np.fromiter(
-                (min(
-                    (f[0] for f in self.findFeaturesAt(
-                        chromosome,
-                        feature[0],
-                        optim='nb'))) for feature in self.features[chromosome]),
-                dtype=np.int64)
-
-            self.fastIndex[chromosome] = np.searchsorted(
-                self.startCoordinates[chromosome], lowestStarts, 'left')
-            ########################
+            self.maxFeatureSizes[chromosome] = np.max([tup[1] - tup[0]
+                                                      for tup in self.features[chromosome]])
+            self.intervalIndex[chromosome] = IntervalIndex(
+                self.startCoordinates[chromosome],
+                [tup[1] for tup in self.features[chromosome]],
+                [tup[3] for tup in self.features[chromosome]])
 
         # find the longest feature
 
@@ -595,13 +640,12 @@ class FeatureContainer(Prefetcher):
             else:
                 return([fl[0], fr[0]])
 
-    @functools.lru_cache(maxsize=512)
     def findFeaturesAt(
             self,
             chromosome,
             lookupCoordinate,
             strand=None,
-            optim='bdbnb'):
+            optim='index'):
         if not self.sorted:
             self.sort()
         """Obtain the features at a give coordinate and optionally strand."""
@@ -613,30 +657,15 @@ class FeatureContainer(Prefetcher):
                     chromosome)
             return([])
 
+        if optim == 'index':
+            _, feature_indices = self.intervalIndex[chromosome].query_points([lookupCoordinate], strand)
+            return([self.features[chromosome][i] for i in feature_indices.tolist()])
+
         s = np.searchsorted(
             self.startCoordinates[chromosome],
             lookupCoordinate + 1,
             side='left')
-        if optim == 'bdbnb':
-            startRange = self.fastIndex[chromosome][s - 1]
-            # We stop looking at the rightmost h
-            endRange = min(s, len(self.features[chromosome]))
-            if self.debug:
-                self.debugMsg("index: %s" % self.fastIndex[chromosome])
-                self.debugMsg("Fast index result: %s" %
-                              self.fastIndex[chromosome][s - 1])
-                ml = lookupCoordinate - self.maxFeatureSizes[chromosome]
-                self.debugMsg(
-                    "Vanilla index result: %s" %
-                    np.searchsorted(
-                        self.startCoordinates[chromosome],
-                        ml,
-                        side='left'))
-                self.debugMsg("Start looking from %s" % startRange)
-                self.debugMsg("To %s" % endRange)
-
-            return([self.features[chromosome][i] for i in range(startRange, endRange) if (self.features[chromosome][i][1] >= lookupCoordinate and (strand is None or self.features[chromosome][i][3] == strand))])
-        elif optim == 'nb':
+        if optim == 'nb':
             # Be smarter: take only segments where the end coordinate is bigger
             # than the lookupCoordinate
             # We start looking from the most left index possible given our
@@ -833,6 +862,64 @@ class FeatureAnnotatedObject():
             self.set_intron_exon_features()
 
 
+    def get_annotation_blocks(self):
+        """Obtain the regions to annotate
+
+        Yields:
+            block (tuple) : (chromosome, start, end, strand), strand is None when the strand of the features is ignored
+        """
+        raise NotImplementedError()
+
+    def add_feature_hit(self, chromosome, feature):
+        """Add a feature (tuple from FeatureContainer.features) overlapping the object to the hits"""
+        hit_start, hit_end, hit_id, hit_strand, hit_ids = feature
+        self.hits[hit_ids].add(
+            (chromosome, (hit_start, hit_end)))
+
+        if self.capture_locations:
+            if not hit_id in self.feature_locations:
+                self.feature_locations[hit_id] = []
+            self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
+
+    def annotate(self):
+        """Add the features overlapping the blocks obtained from get_annotation_blocks to the hits"""
+        FeatureAnnotatedObject.annotate_batch([self], set_features=False)
+
+    @staticmethod
+    def annotate_batch(objects, set_features=True):
+        """Annotate many objects which share the same FeatureContainer at once.
+
+        The blocks of all objects are looked up using a single query per chromosome, the resulting hits are
+        identical to annotating every object separately.
+
+        Args:
+            objects (list) : FeatureAnnotatedObjects to annotate
+            set_features (bool) : obtain the intron/exon/gene features of the objects after annotating
+        """
+        if len(objects) == 0:
+            return
+        features = objects[0].features
+        # chromosome -> (object index, start, end, strand) for every block
+        queries = collections.defaultdict(lambda: ([], [], [], []))
+        for owner, o in enumerate(objects):
+            for chromosome, start, end, strand in o.get_annotation_blocks():
+                owners, starts, ends, strands = queries[chromosome]
+                owners.append(owner)
+                starts.append(start)
+                ends.append(end)
+                strands.append(strand)
+
+        for chromosome, (owners, starts, ends, strands) in queries.items():
+            block_indices, feature_indices = features.findFeaturesBetweenBatch(chromosome, starts, ends, strands)
+            chromosome_features = features.features.get(chromosome)
+            for block, feature in zip(block_indices.tolist(), feature_indices.tolist()):
+                objects[owners[block]].add_feature_hit(chromosome, chromosome_features[feature])
+
+        for o in objects:
+            o.is_annotated = True
+            if set_features:
+                o.set_intron_exon_features()
+
     def set_spliced(self, is_spliced):
         """ Set wether the transcript is spliced, False has priority over True """
         if self.is_spliced and not is_spliced:
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import gzip
+import json
+import os
+import hashlib
+import uuid
+
+GTF_STORE_MAGIC = b'SCMOGTF1'
+
+
+def parse_gtf_attributes(attributes):
+    """Parse the attribute column of a GTF line into a dictionary, identical to FeatureContainer.loadGTF"""
+    keyValues = {}
+    for part in attributes.split(';'):
+        kv = part.strip().split()
+        if len(kv) == 2:
+            key = kv[0]
+            value = kv[1].replace('"', '')
+            keyValues[key] = value
+    return keyValues
+
+
+class GTFStore():
+    """Columnar binary representation of a GTF file which can be memory mapped.
+
+    The features are sorted by contig and start coordinate. Start, end, type, strand and frame are stored in
+    separate arrays, the attributes are stored as (key, value) pairs referring to interned key and value tables.
+    Region queries use a binary search on the start coordinates and do not parse any text.
+
+    Example:
+        >>> GTFStore.create('./genes.gtf.gz', './genes.gtfstore')
+        >>> store = GTFStore('./genes.gtfstore')
+        >>> for feature in store.fetch('1', 1_000_000, 2_000_000):
+        >>>     print(feature)
+    """
+
+    columns = {
+        'start': np.int64,
+        'end': np.int64,
+        'type': np.uint16,
+        'strand': np.uint8,
+        'frame': np.uint8,
+        'attribute_offsets': np.int64,
+        'attribute_keys': np.uint16,
+        'attribute_values': np.uint32,
+        'value_offsets': np.int64,
+        'value_blob': np.uint8
+    }
+
+    def __init__(self, path):
+        """Open a GTF store written by GTFStore.create, the arrays are memory mapped"""
+        with open(path, 'rb') as f:
+            if f.read(len(GTF_STORE_MAGIC)) != GTF_STORE_MAGIC:
+                raise ValueError(f'{path} is not a GTF store')
+            meta_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            self.meta = json.loads(f.read(meta_size).decode())
+        self.path = path
+        offset = len(GTF_STORE_MAGIC) + 8 + meta_size
+        offset += -offset % 8
+        for column, dtype in self.columns.items():
+            size = self.meta['sizes'][column]
+            if size == 0:
+                setattr(self, column, np.zeros(0, dtype=dtype))
+            else:
+                setattr(self, column, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(size,)))
+            offset += size * np.dtype(dtype).itemsize
+            offset += -offset % 8
+
+        self.contigs = {contig: tuple(row_range) for contig, row_range in self.meta['contigs'].items()}
+        self.types = self.meta['types']
+        self.strands = self.meta['strands']
+        self.frames = self.meta['frames']
+        self.keys = self.meta['keys']
+
+    @staticmethod
+    def is_store(path):
+        """Check if path points to a GTF store"""
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as f:
+            return f.read(len(GTF_STORE_MAGIC)) == GTF_STORE_MAGIC
+
+    @classmethod
+    def create(cls, gtf_path, store_path):
+        """Convert a (gzipped) GTF file into a GTF store
+
+        Args:
+            gtf_path (str) : path to the GTF file
+            store_path (str) : path to write the store to
+        """
+        contigs, starts, ends = [], [], []
+        types, strands, frames = [], [], []
+        attribute_counts, attribute_keys, attribute_values = [], [], []
+        tables = {name: {} for name in ('contig', 'type', 'strand', 'frame', 'key', 'value')}
+
+        def intern(table, value):
+            return tables[table].setdefault(value, len(tables[table]))
+
+        with (gzip.open(gtf_path, 'rt') if gtf_path.endswith('.gz') else open(gtf_path, 'r')) as f:
+            for line in f:
+                if line[0] == '#' or len(line.strip()) == 0:
+                    continue
+                parts = line.rstrip().split(None, 8)
+                contigs.append(intern('contig', parts[0]))
+                types.append(intern('type', parts[2]))
+                starts.append(int(parts[3]))
+                ends.append(int(parts[4]))
+                strands.append(intern('strand', parts[6]))
+                frames.append(intern('frame', parts[7]))
+                keyValues = parse_gtf_attributes(parts[-1])
+                attribute_counts.append(len(keyValues))
+                for key, value in keyValues.items():
+                    attribute_keys.append(intern('key', key))
+                    attribute_values.append(intern('value', value))
+
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        contigs = np.array(contigs, dtype=np.int64)
+        # Sort on contig and start, the sort is stable so the file order is kept for equal starts
+        order = np.lexsort((starts, contigs))
+
+        attribute_counts = np.array(attribute_counts, dtype=np.int64)
+        attribute_starts = np.zeros(len(attribute_counts) + 1, dtype=np.int64)
+        np.cumsum(attribute_counts, out=attribute_starts[1:])
+        # Gather the attribute pairs of every feature in the sorted order
+        sorted_counts = attribute_counts[order]
+        attribute_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(sorted_counts, out=attribute_offsets[1:])
+        pair_indices = np.repeat(attribute_starts[order] - attribute_offsets[:-1], sorted_counts) + \
+            np.arange(attribute_offsets[-1], dtype=np.int64)
+
+        values = [value.encode() for value in tables['value']]
+        value_offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in values], out=value_offsets[1:])
+
+        sorted_contigs = contigs[order]
+        contig_names = list(tables['contig'])
+        contig_ranges, max_sizes = {}, {}
+        for contig_id, contig in enumerate(contig_names):
+            begin, end = np.searchsorted(sorted_contigs, [contig_id, contig_id + 1])
+            contig_ranges[contig] = (int(begin), int(end))
+            max_sizes[contig] = int(np.max(ends[order[begin:end]] - starts[order[begin:end]]))
+
+        arrays = {
+            'start': starts[order],
+            'end': ends[order],
+            'type': np.array(types, dtype=np.uint16)[order],
+            'strand': np.array(strands, dtype=np.uint8)[order],
+            'frame': np.array(frames, dtype=np.uint8)[order],
+            'attribute_offsets': attribute_offsets,
+            'attribute_keys': np.array(attribute_keys, dtype=np.uint16)[pair_indices],
+            'attribute_values': np.array(attribute_values, dtype=np.uint32)[pair_indices],
+            'value_offsets': value_offsets,
+            'value_blob': np.frombuffer(b''.join(values), dtype=np.uint8)
+        }
+        meta = json.dumps({
+            'source': os.path.abspath(gtf_path),
+            'contigs': contig_ranges,
+            'max_feature_sizes': max_sizes,
+            'types': list(tables['type']),
+            'strands': list(tables['strand']),
+            'frames': list(tables['frame']),
+            'keys': list(tables['key']),
+            'sizes': {column: len(array) for column, array in arrays.items()}
+        }).encode()
+
+        with open(store_path, 'wb') as f:
+            f.write(GTF_STORE_MAGIC)
+            f.write(np.uint64(len(meta)).tobytes())
+            f.write(meta)
+            f.write(b'\0' * (-f.tell() % 8))
+            for column, dtype in cls.columns.items():
+                f.write(np.ascontiguousarray(arrays[column], dtype=dtype).tobytes())
+                f.write(b'\0' * (-f.tell() % 8))
+
+    def get_value(self, value_id):
+        return self.value_blob[self.value_offsets[value_id]:self.value_offsets[value_id + 1]].tobytes().decode()
+
+    def get_attributes(self, row):
+        """Obtain the attribute dictionary of the feature at row"""
+        begin, end = self.attribute_offsets[row], self.attribute_offsets[row + 1]
+        return {self.keys[key]: self.get_value(value)
+                for key, value in zip(self.attribute_keys[begin:end].tolist(), self.attribute_values[begin:end].tolist())}
+
+    def get_rows(self, contig, region_start=None, region_end=None, types=None):
+        """Obtain the rows of the features on contig overlapping the region
+
+        Args:
+            contig (str) : contig to obtain the features for
+            region_start (int) : start of the region (GTF coordinates, inclusive)
+            region_end (int) : end of the region (GTF coordinates, inclusive)
+            types (iterable) : only return features of these types
+
+        Returns:
+            rows (np.array) : indices of the features in the store
+        """
+        if contig not in self.contigs:
+            return np.zeros(0, dtype=np.int64)
+        begin, end = self.contigs[contig]
+        if region_start is not None:
+            starts = self.start[begin:end]
+            # No feature which starts before region_start-max_feature_size can overlap the region
+            lower = region_start - self.meta['max_feature_sizes'][contig]
+            begin, end = begin + np.searchsorted(starts, [lower, region_end + 1])
+        rows = np.arange(begin, end)
+        if region_start is not None:
+            rows = rows[self.end[begin:end] >= region_start]
+        if types is not None:
+            type_ids = [i for i, feature_type in enumerate(self.types) if feature_type in types]
+            rows = rows[np.isin(self.type[rows], type_ids)]
+        return rows
+
+    def fetch(self, contig, region_start=None, region_end=None, types=None):
+        """Obtain the features on contig overlapping the region
+
+        Yields:
+            feature (tuple) : (contig, type, start, end, strand, frame, attributes)
+        """
+        for row in self.get_rows(contig, region_start, region_end, types).tolist():
+            yield (contig,
+                   self.types[self.type[row]],
+                   int(self.start[row]),
+                   int(self.end[row]),
+                   self.strands[self.strand[row]],
+                   self.frames[self.frame[row]],
+                   self.get_attributes(row))
+
+
+def get_gtf_store_path(gtf_path, store_dir):
+    """Obtain the path of the GTF store of gtf_path in store_dir, the path depends on the contents of the file"""
+    content_hash = hashlib.sha1()
+    with open(gtf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            content_hash.update(block)
+    name = os.path.basename(gtf_path)
+    return os.path.join(store_dir, f'{name}.{content_hash.hexdigest()}.{GTF_STORE_MAGIC.decode()}.gtfstore')
+
+
+def get_or_create_gtf_store(gtf_path, store_dir):
+    """Obtain the path to the GTF store of gtf_path, the store is created when it does not exist yet"""
+    store_path = get_gtf_store_path(gtf_path, store_dir)
+    if not os.path.exists(store_path):
+        os.makedirs(store_dir, exist_ok=True)
+        # Write to a temporary file first, other processes can be reading or writing the same store
+        temp_path = f'{store_path}.{uuid.uuid4()}.tmp'
+        GTFStore.create(gtf_path, temp_path)
+        os.replace(temp_path, store_path)
+    return store_path
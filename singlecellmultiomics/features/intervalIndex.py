@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+STRAND_CODES = {None: 0, '+': 1, '-': 2}
+
+
+def encode_strands(strands, size):
+    """Convert None, a single strand or a sequence of strands to an array of strand codes, -1 means any strand"""
+    if strands is None:
+        return np.full(size, -1, dtype=np.int8)
+    if isinstance(strands, str):
+        return np.full(size, STRAND_CODES[strands], dtype=np.int8)
+    return np.fromiter((-1 if strand is None else STRAND_CODES[strand] for strand in strands),
+                       dtype=np.int8, count=size)
+
+
+class IntervalIndex():
+    """Index to find the (closed) intervals overlapping many query intervals at once.
+
+    The intervals are divided into levels based on their length. Every level is sorted on start coordinate,
+    the intervals which can overlap a query interval are then found using two binary searches per level:
+    no interval of a level starts before query_start - (maximum length of the level).
+    Because the intervals in a level have a similar length almost all these candidates are hits,
+    long features (genes) do not slow down the lookup of short features (exons).
+
+    Example:
+        >>> index = IntervalIndex([10, 500, 20], [1000, 900, 30], ['+', '+', '-'])
+        >>> index.query([25, 950], [26, 960], strands='+')
+        (array([0, 1]), array([0, 0]))
+    """
+
+    def __init__(self, starts, ends, strands=None, min_level_length=64, level_growth=4):
+        """Initialise IntervalIndex
+
+        Args:
+            starts (iterable) : start coordinates of the intervals (inclusive)
+            ends (iterable) : end coordinates of the intervals (inclusive)
+            strands (iterable) : strand of every interval ('+', '-' or None)
+            min_level_length (int) : maximum interval length of the first level
+            level_growth (int) : increase of the maximum interval length for every next level
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        self.size = len(starts)
+        self.strands = encode_strands(strands, self.size)
+        # Intervals ending before their start never overlap anything
+        valid = np.flatnonzero(ends >= starts)
+        lengths = ends[valid] - starts[valid]
+
+        self.levels = []
+        max_length = min_level_length
+        remaining = np.ones(len(valid), dtype=bool)
+        while remaining.any():
+            selected = remaining & (lengths <= max_length)
+            if selected.any():
+                indices = valid[selected]
+                order = np.argsort(starts[indices], kind='stable')
+                indices = indices[order]
+                self.levels.append((int(lengths[selected].max()), starts[indices], ends[indices], indices))
+                remaining &= ~selected
+            max_length *= level_growth
+
+    def __len__(self):
+        return self.size
+
+    def query(self, query_starts, query_ends, strands=None):
+        """Find the intervals overlapping the query intervals
+
+        Args:
+            query_starts (iterable) : start coordinates of the queries (inclusive)
+            query_ends (iterable) : end coordinates of the queries (inclusive)
+            strands : None to ignore the strand, a single strand for all queries or a strand for every query
+
+        Returns:
+            query_indices (np.array) : index of the query for every hit
+            interval_indices (np.array) : index of the interval for every hit, sorted by query and interval
+        """
+        query_starts = np.asarray(query_starts, dtype=np.int64)
+        query_ends = np.asarray(query_ends, dtype=np.int64)
+        query_strands = encode_strands(strands, len(query_starts))
+
+        hit_queries, hit_intervals = [], []
+        for max_length, starts, ends, indices in self.levels:
+            lower = np.searchsorted(starts, query_starts - max_length, 'left')
+            upper = np.searchsorted(starts, query_ends, 'right')
+            counts = np.maximum(upper - lower, 0)
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            # Expand the candidate ranges of all queries at once
+            queries = np.repeat(np.arange(len(query_starts)), counts)
+            candidates = np.repeat(lower - (np.cumsum(counts) - counts), counts) + np.arange(total)
+            hit = ends[candidates] >= query_starts[queries]
+            strand_hit = (query_strands[queries] == -1) | (self.strands[indices[candidates]] == query_strands[queries])
+            hit &= strand_hit
+            hit_queries.append(queries[hit])
+            hit_intervals.append(indices[candidates[hit]])
+
+        if len(hit_queries) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        hit_queries = np.concatenate(hit_queries)
+        hit_intervals = np.concatenate(hit_intervals)
+        order = np.lexsort((hit_intervals, hit_queries))
+        return hit_queries[order], hit_intervals[order]
+
+    def query_points(self, positions, strands=None):
+        """Find the intervals containing the supplied positions, see query"""
+        return self.query(positions, positions, strands)
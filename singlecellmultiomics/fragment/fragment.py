@@ -44,6 +44,10 @@ class Fragment():
 
     """
 
+    # Fragments are only equal when umi_eq returns True, this allows the
+    # MoleculeIterator to look up candidate molecules using an UmiIndex
+    umi_index_compatible = True
+
     def __init__(self, reads, assignment_radius=3, umi_hamming_distance=1,
                  R1_primer_length=0,
                  R2_primer_length=6,
@@ -888,7 +892,7 @@ class SingleEndTranscriptFragment(Fragment, FeatureAnnotatedObject):
             return False
         return True
 
-    def annotate(self):
+    def get_annotation_blocks(self):
         for read in self:
             if read is None:
                 continue
@@ -901,22 +905,7 @@ class SingleEndTranscriptFragment(Fragment, FeatureAnnotatedObject):
             strand = ('-' if read_strand else '+')
             read.set_tag('mr',strand)
             for start, end in read.get_blocks():
-
-                for hit in self.features.findFeaturesBetween(
-                        chromosome=read.reference_name,
-                        sampleStart=start,
-                        sampleEnd=end,
-                        strand=(None if self.stranded is None else strand)) :
-
-                    hit_start, hit_end, hit_id, hit_strand, hit_ids = hit
-                    self.hits[hit_ids].add(
-                        (read.reference_name, (hit_start, hit_end)))
-
-                    if self.capture_locations:
-                        if not hit_id in self.feature_locations:
-                            self.feature_locations[hit_id] = []
-                        self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
-
+                yield read.reference_name, start, end, (None if self.stranded is None else strand)
 
     def get_site_location(self):
         return self.span[0], self.start
@@ -1059,6 +1048,8 @@ class FragmentWithoutUMI(Fragment):
     Use this class when no UMI information is available
     """
 
+    umi_index_compatible = False
+
     def __init__(self, reads, **kwargs):
         Fragment.__init__(self, reads, **kwargs)
 
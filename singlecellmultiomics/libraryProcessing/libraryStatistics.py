@@ -19,7 +19,6 @@ from singlecellmultiomics.tagtools import tagtools
 import pysamiterators.iterators as pysamIterators
 import gzip
 import pickle
-import subprocess
 from glob import glob
 
 import matplotlib
@@ -77,6 +76,7 @@ if __name__ == '__main__':
         help="only make tables")
 
     argparser.add_argument('-head', type=int)
+    argparser.add_argument('-threads', type=int, help='Amount of processes used to read the bam file, uses all available CPUs when not set')
     argparser.add_argument(
         '-tagged_bam',
         type=str,
@@ -231,12 +231,8 @@ if __name__ == '__main__':
 
         if bamFile is not None and os.path.exists(bamFile):
             print(f'\tTagged > {bamFile}')
-            with pysam.AlignmentFile(bamFile) as f:
-                for i, read in enumerate(f):
-                    for statistic in statistics:
-                        statistic.processRead(read)
-                    if args.head is not None and i >= (args.head - 1):
-                        break
+            # All statistics are gathered in a single pass, the regions of the bam file are processed in parallel
+            process_bam_statistics(bamFile, statistics, n_threads=args.threads, head=args.head)
         else:
             print(f'Did not find a bam file at {bamFile}')
 
@@ -244,42 +240,11 @@ if __name__ == '__main__':
 
         if os.path.exists(
                 f'{library}/tagged/STAR_mappedAligned.sortedByCoord.out.featureCounts.bam'):
-            cmd = f'samtools view {bamFile} -F 4 -f 64 | cut -f 1 | sort | uniq | wc -l'
-            out = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   shell=True
-                                   ).communicate()[0]
-            read1mapped = int(out.partition(b' ')[0])
-            cmd = f'samtools view {bamFile} -F 4 -f 128 | cut -f 1 | sort | uniq | wc -l'
-            out = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   shell=True
-                                   ).communicate()[0]
-            read2mapped = int(out.partition(b' ')[0])
-
-            rc.totalMappedReads['R1'] = read1mapped
-            rc.totalMappedReads['R2'] = read2mapped
-            # Deduplicated reads have RC:i:1 set, -f 64 selects for R2
-            cmd = f'samtools view {bamFile} -F 4 -f 64 | grep RC:i:1 | cut -f 1 | sort | uniq | wc -l'
-            out = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   shell=True
-                                   ).communicate()[0]
-            read1mappeddedup = int(out.partition(b' ')[0])
-            # Deduplicated reads have RC:i:1 set, -f 128 selects for R2
-            cmd = f'samtools view {bamFile} -F 4 -f 128 | grep RC:i:1 |  cut -f 1 | sort | uniq | wc -l'
-            out = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   shell=True
-                                   ).communicate()[0]
-            read2mappeddedup = int(out.partition(b' ')[0])
-
-            rc.totalDedupReads['R1'] = read1mappeddedup
-            rc.totalDedupReads['R2'] = read2mappeddedup
+            # Every read has a single primary alignment: the amount of unique mapped read names equals
+            # rc.totalMappedReads, the amount of mapped primary reads. Deduplicated reads have RC:i:1 set,
+            # only reads with exactly RC 1 are counted (grep RC:i:1 also matched RC:i:12, RC:i:100, ..)
+            rc.totalDedupReads['R1'] = rc.totalRCDedupReads['R1']
+            rc.totalDedupReads['R2'] = rc.totalRCDedupReads['R2']
 
         for statistic in statistics:
             try:
@@ -1 +1 @@
-from .methylation import MethylationCountMatrix
\ No newline at end of file
+from .methylation import MethylationCountMatrix, SparseMethylationCountMatrix
\ No newline at end of file
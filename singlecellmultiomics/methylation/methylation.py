@@ -3,12 +3,44 @@
 
 import pandas as pd
 import numpy as np
+import scipy.sparse
+from array import array
 from multiprocessing import Pool, Manager
 
 def get_bulk_vector(args):
     obj, samples, location = args
     return obj.get_bulk_column(samples, location)
 
+
+def get_sample_distance_matrix(betas):
+    """Obtain the distance between all samples: the mean absolute difference of the betas measured in both samples
+
+    Samples which cannot be compared to all other samples are removed
+
+    Args:
+        betas(pd.DataFrame) : beta values, rows are samples, columns are locations
+
+    Returns:
+        dmat(pd.DataFrame) : distance matrix
+    """
+    def distance(row, matrix):
+        # Amount of differences / total comparisons
+        return np.nansum(np.abs((matrix - row)), axis=1) / (np.isfinite(matrix - row).sum(axis=1))
+
+    def get_dmat(df):
+        dmat = np.apply_along_axis(distance, 1, df.values, matrix=df.values)
+        return pd.DataFrame(dmat, columns=df.index, index=df.index)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dmat = get_dmat(betas)
+
+        while dmat.isna().sum().sum() > 0:
+            sample = dmat.isna().sum().idxmax()
+            dmat.drop(sample, axis=0, inplace=True)
+            dmat.drop(sample, axis=1, inplace=True)
+
+    return dmat
+
 class MethylationCountMatrix:
 
     def __init__(self, counts: dict = None, threads=None):
@@ -84,23 +116,7 @@ class MethylationCountMatrix:
 
     def get_sample_distance_matrix(self):
         self.check_integrity()
-        def distance(row, matrix):
-            # Amount of differences / total comparisons
-            return np.nansum(np.abs((matrix - row)), axis=1) / (np.isfinite(matrix - row).sum(axis=1))
-
-        def get_dmat(df):
-            dmat = np.apply_along_axis(distance, 1, df.values, matrix=df.values)
-            return pd.DataFrame(dmat, columns=df.index, index=df.index)
-
-        with np.errstate(divide='ignore', invalid='ignore'):
-            dmat = get_dmat(self.get_frame('beta'))
-
-            while dmat.isna().sum().sum() > 0:
-                sample = dmat.isna().sum().idxmax()
-                dmat.drop(sample, 0, inplace=True)
-                dmat.drop(sample, 1, inplace=True)
-
-        return dmat
+        return get_sample_distance_matrix(self.get_frame('beta'))
 
 
 
@@ -204,3 +220,297 @@ class MethylationCountMatrix:
             return mat
         else:
             raise ValueError('dtype should be pd or np')
+
+
+def _compact(values):
+    """Convert an integer array to the smallest dtype which can hold all values"""
+    if len(values) == 0:
+        return values.astype(np.uint8)
+    return values.astype(np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max())))
+
+
+def _encode_labels(labels):
+    """Encode a list of tuples column wise
+
+    Integer columns are stored as arrays, relative to the previous integer column (the bin end is stored relative
+    to the bin start), other columns are stored as categories
+    """
+    columns = []
+    previous = None
+    for column in zip(*labels):
+        if all(type(value) is int for value in column):
+            values = np.array(column, dtype=np.int64)
+            columns.append(('int', previous is not None, _compact(values if previous is None else values - previous)))
+            previous = values
+        else:
+            categories = list(dict.fromkeys(column))
+            category_index = {category: i for i, category in enumerate(categories)}
+            columns.append(('category', categories, _compact(np.array([category_index[value] for value in column]))))
+    return len(labels), columns
+
+
+def _decode_labels(encoded):
+    n_labels, columns = encoded
+    if len(columns) == 0:
+        return [()] * n_labels
+    decoded = []
+    previous = None
+    for kind, attribute, values in columns:
+        if kind == 'int':
+            values = values.astype(np.int64)
+            if attribute:
+                values += previous
+            previous = values
+            decoded.append(values.tolist())
+        else:
+            decoded.append([attribute[code] for code in values.tolist()])
+    return list(zip(*decoded))
+
+
+class SparseMethylationCountMatrix:
+    """Methylation count matrix which stores the counts as sparse integer matrices.
+
+    Samples and locations are interned to integer indices. The calls are buffered and summed per
+    (sample, location) pair, the matrix is stored as the methylated and total amount of calls of every pair.
+    The matrix can be used instead of MethylationCountMatrix, the frames obtained using get_frame
+    and get_bulk_frame are identical.
+
+    Example:
+        >>> m = SparseMethylationCountMatrix()
+        >>> m.add('cellA', ('chr1', 1000, 1500), True)
+        >>> m.add('cellA', ('chr1', 1000, 1500), False)
+        >>> m.get_frame('beta')
+    """
+
+    def __init__(self, buffer_size=1_000_000):
+        self.buffer_size = buffer_size
+        self.samples = {}  # sample -> sample index
+        # location -> location index, locations are (contig, bin_start, bin_end) or (contig, bin_start, bin_end, strand)
+        self.sites = {}
+        self._init_buffers()
+
+        # Summed entries, sorted by key: site_index << 32 | sample_index
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.methylated = np.zeros(0, dtype=np.int64)
+        self.total = np.zeros(0, dtype=np.int64)
+
+    def _init_buffers(self):
+        self.buffer_samples = array('q')
+        self.buffer_sites = array('q')
+        self.buffer_methylated = array('q')
+        self.buffer_total = array('q')
+
+    def add(self, sample, location, methylated: bool, count: int = 1):
+        """Add a methylation call of location observed in sample"""
+        self.buffer_samples.append(self.samples.setdefault(sample, len(self.samples)))
+        self.buffer_sites.append(self.sites.setdefault(location, len(self.sites)))
+        self.buffer_methylated.append(count if methylated else 0)
+        self.buffer_total.append(count)
+        if len(self.buffer_total) >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self.buffer_total) == 0:
+            return
+        keys = (np.frombuffer(self.buffer_sites, dtype=np.int64) << 32) | \
+            np.frombuffer(self.buffer_samples, dtype=np.int64)
+        self._add_entries(keys,
+                          np.frombuffer(self.buffer_methylated, dtype=np.int64),
+                          np.frombuffer(self.buffer_total, dtype=np.int64))
+        self._init_buffers()
+        # Grow the buffer with the matrix, this keeps the amortised cost of summing linear
+        self.buffer_size = max(self.buffer_size, len(self.keys))
+
+    def _add_entries(self, keys, methylated, total):
+        keys = np.concatenate((self.keys, keys))
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.methylated = np.bincount(inverse, weights=np.concatenate((self.methylated, methylated)),
+                                      minlength=len(self.keys)).astype(np.int64)
+        self.total = np.bincount(inverse, weights=np.concatenate((self.total, total)),
+                                 minlength=len(self.keys)).astype(np.int64)
+
+    def get_entries(self):
+        """Obtain the summed entries
+
+        Returns:
+            site_indices (np.array), sample_indices (np.array), methylated (np.array), total (np.array)
+        """
+        self._flush()
+        return self.keys >> 32, self.keys & 0xffffffff, self.methylated, self.total
+
+    def get_sparse_matrices(self):
+        """Obtain the methylated and total counts as scipy.sparse.csr_matrix, rows are samples, columns are
+        locations in the order of self.samples and self.sites"""
+        site_indices, sample_indices, methylated, total = self.get_entries()
+        shape = (len(self.samples), len(self.sites))
+        return (scipy.sparse.csr_matrix((methylated, (sample_indices, site_indices)), shape=shape),
+                scipy.sparse.csr_matrix((total, (sample_indices, site_indices)), shape=shape))
+
+    def update(self, other):
+        """Add the counts of other to this matrix, the counts of overlapping locations are summed"""
+        site_indices, sample_indices, methylated, total = other.get_entries()
+        self._flush()
+        sample_map = np.array([self.samples.setdefault(sample, len(self.samples)) for sample in other.samples],
+                              dtype=np.int64)
+        site_map = np.array([self.sites.setdefault(site, len(self.sites)) for site in other.sites],
+                            dtype=np.int64)
+        if len(total):
+            self._add_entries((site_map[site_indices] << 32) | sample_map[sample_indices], methylated, total)
+
+    def get_sample_list(self):
+        return sorted(list(self.samples.keys()))
+
+    def __repr__(self):
+        return f'Methylation call matrix containing {len(self.samples)} samples and {len(self.sites)} locations'
+
+    def __len__(self):
+        self._flush()
+        return len(self.keys)
+
+    def get_without_init(self, key: tuple):
+        """Obtain [unmethylated, methylated] counts of (sample, location)"""
+        sample, location = key
+        self._flush()
+        if sample not in self.samples or location not in self.sites:
+            return (0, 0)
+        index = np.searchsorted(self.keys, (self.sites[location] << 32) | self.samples[sample])
+        if index == len(self.keys) or self.keys[index] != (self.sites[location] << 32) | self.samples[sample]:
+            return (0, 0)
+        return [int(self.total[index] - self.methylated[index]), int(self.methylated[index])]
+
+    def check_integrity(self):
+        if len(self.sites) == 0 or len(self.samples) == 0:
+            print(self)
+            raise ValueError('The count matrix contains no data, verify if the input data was empty or filtered to stringently')
+
+    def _get_site_statistics(self):
+        """Obtain unmethylated, methylated, beta, variance and n_samples for every location index"""
+        site_indices, sample_indices, methylated, total = self.get_entries()
+        n_sites = len(self.sites)
+        total_methylated = np.bincount(site_indices, weights=methylated, minlength=n_sites)
+        total_calls = np.bincount(site_indices, weights=total, minlength=n_sites)
+
+        measured = total > 0
+        betas = methylated[measured] / total[measured]
+        measured_sites = site_indices[measured]
+        n_samples = np.bincount(measured_sites, minlength=n_sites)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = total_methylated / total_calls
+            mean_beta = np.bincount(measured_sites, weights=betas, minlength=n_sites) / n_samples
+            variance = np.bincount(measured_sites, weights=(betas - mean_beta[measured_sites]) ** 2,
+                                   minlength=n_sites) / n_samples
+        return np.stack((total_calls - total_methylated, total_methylated, beta, variance, n_samples), axis=1)
+
+    def prune(self, min_samples: int = 0, min_variance: float = None):
+        """Remove locations measured in less than min_samples samples or with a variance below min_variance.
+        Samples without any data left are removed"""
+        if min_samples is None:
+            min_samples = 0
+        if len(self.sites) == 0 or len(self.samples) == 0 or min_samples == 0 and min_variance is None:
+            return
+
+        statistics = self._get_site_statistics()
+        keep_site = statistics[:, 4] >= min_samples
+        if min_variance is not None:
+            keep_site &= statistics[:, 3] >= min_variance  # NaN variances are removed too
+
+        self._keep_sites(keep_site)
+
+    def delete_location(self, location):
+        self._keep_sites(np.array([site != location for site in self.sites], dtype=bool))
+
+    def _keep_sites(self, keep_site):
+        """Remove the locations for which keep_site is False, samples without any data left are removed"""
+        site_indices, sample_indices, methylated, total = self.get_entries()
+        keep_entry = keep_site[site_indices]
+        keep_sample = np.bincount(sample_indices[keep_entry], minlength=len(self.samples)) > 0
+
+        # Assign new indices to the remaining samples and locations
+        new_site_index = np.cumsum(keep_site) - 1
+        new_sample_index = np.cumsum(keep_sample) - 1
+        self.sites = {site: int(new_site_index[i]) for i, site in enumerate(self.sites) if keep_site[i]}
+        self.samples = {sample: int(new_sample_index[i]) for i, sample in enumerate(self.samples) if keep_sample[i]}
+        # The order of the sites is kept, so the keys stay sorted
+        self.keys = (new_site_index[site_indices[keep_entry]] << 32) | new_sample_index[sample_indices[keep_entry]]
+        self.methylated = methylated[keep_entry]
+        self.total = total[keep_entry]
+
+    def _get_sorted_sites(self):
+        columns = list(sorted(self.sites))
+        return columns, np.array([self.sites[column] for column in columns], dtype=np.int64)
+
+    def get_frame(self, dtype: str):
+        """
+        Get pandas dataframe containing the selected column
+
+        Args:
+            dtype: either 'methylated', 'unmethylated' or 'beta'
+
+        Returns:
+            df(pd.DataFrame) : Dataframe containing the selected column, rows are samples, columns are locations
+        """
+        self.check_integrity()
+        columns, column_sites = self._get_sorted_sites()
+        samples = self.get_sample_list()
+        column_of_site = np.empty(len(self.sites), dtype=np.int64)
+        column_of_site[column_sites] = np.arange(len(columns))
+        row_of_sample = np.empty(len(self.samples), dtype=np.int64)
+        row_of_sample[[self.samples[sample] for sample in samples]] = np.arange(len(samples))
+
+        site_indices, sample_indices, methylated, total = self.get_entries()
+        if dtype == 'methylated':
+            values = methylated
+        elif dtype == 'unmethylated':
+            values = total - methylated
+        elif dtype == 'beta':
+            values = methylated / total
+        else:
+            raise ValueError
+
+        mat = np.full((len(samples), len(columns)), np.nan)
+        mat[row_of_sample[sample_indices], column_of_site[site_indices]] = values
+        return pd.DataFrame(mat, index=samples, columns=pd.MultiIndex.from_tuples(columns))
+
+    def get_bulk_frame(self, dtype='pd', use_multi=True):
+        """
+        Get pandas dataframe containing the selected columns
+
+        Returns:
+            df(pd.DataFrame) : Dataframe containing the selected column, rows are locations,
+        """
+        self.check_integrity()
+        columns, column_sites = self._get_sorted_sites()
+        mat = self._get_site_statistics()[column_sites]
+        if dtype == 'pd':
+            return pd.DataFrame(mat, index=pd.MultiIndex.from_tuples(columns),
+                                columns=('unmethylated', 'methylated', 'beta', 'variance', 'n_samples'))
+        elif dtype == 'np':
+            return mat
+        else:
+            raise ValueError('dtype should be pd or np')
+
+    def get_sample_distance_matrix(self):
+        self.check_integrity()
+        return get_sample_distance_matrix(self.get_frame('beta'))
+
+    def __getstate__(self):
+        # Store the locations column wise and the counts as arrays, this is much smaller than pickling tuples
+        site_indices, sample_indices, methylated, total = self.get_entries()
+        return {
+            'buffer_size': self.buffer_size,
+            'samples': list(self.samples),
+            'sites': _encode_labels(list(self.sites)),
+            'site_indices': _compact(site_indices),
+            'sample_indices': _compact(sample_indices),
+            'methylated': _compact(methylated),
+            'total': _compact(total)
+        }
+
+    def __setstate__(self, state):
+        self.buffer_size = state['buffer_size']
+        self.samples = {sample: i for i, sample in enumerate(state['samples'])}
+        self.sites = {site: i for i, site in enumerate(_decode_labels(state['sites']))}
+        self._init_buffers()
+        self.keys = (state['site_indices'].astype(np.int64) << 32) | state['sample_indices'].astype(np.int64)
+        self.methylated = state['methylated'].astype(np.int64)
+        self.total = state['total'].astype(np.int64)
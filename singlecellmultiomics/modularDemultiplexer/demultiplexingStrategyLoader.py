@@ -10,12 +10,105 @@ from colorama import Style
 import importlib
 import inspect
 import traceback
+import itertools
+import threading
+from multiprocessing import Pool
 import singlecellmultiomics.modularDemultiplexer.demultiplexModules as dm
 import singlecellmultiomics.fastqProcessing.fastqIterator as fastqIterator
-from singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods import NonMultiplexable, IlluminaBaseDemultiplexer
+from singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods import NonMultiplexable, IlluminaBaseDemultiplexer, TaggedRecord
 import logging
 
 
+def demultiplex_read_pair(reads, strategies, baseDemux, library=None, probe=None, collect_rejects=True):
+    """Demultiplex a single read pair using all supplied strategies
+
+    Args:
+        reads (tuple) : FastqRecord for every read of the pair
+        strategies (list) : demultiplexing strategies to apply
+        baseDemux (IlluminaBaseDemultiplexer) : used to tag rejected reads
+        library (str) : library name
+        probe (bool) : ignore errors raised by the strategies
+        collect_rejects (bool) : tag and return the rejected reads
+
+    Returns:
+        demultiplexed (list) : demultiplexed records, one entry for every strategy which accepted the pair
+        rejected (list) : rejected records, one entry for every strategy which rejected the pair
+        yields (list) : short names of the strategies which yielded a read pair
+        errors (list) : error messages for the log file
+    """
+    demultiplexed, rejected, yields, errors = [], [], [], []
+    for strategy in strategies:
+        try:
+            demultiplexed.append(strategy.demultiplex(
+                reads, library=library, probe=probe))
+
+        except NonMultiplexable as reason:
+            if not collect_rejects:
+                continue
+            try:
+                rejected.append(baseDemux.demultiplex(
+                    reads, library=library, reason=reason))
+
+            except NonMultiplexable as e:
+                # we cannot read the header of the read..
+                rejected.append([
+                    '\n'.join(
+                        (read.header +
+                         f';RR:{reason};Rr:{e}',
+                         read.sequence,
+                         read.plus,
+                         read.qual)) for read in reads])
+            continue
+        except Exception as e:
+            if probe:
+                continue
+            print(traceback.format_exc())
+            print(
+                f'{Fore.RED}Fatal error. While demultiplexing strategy {strategy.longName} yielded an error, the error message was: {e}')
+            print('The read(s) causing the error looked like this:')
+            for read in reads:
+                print(str(read))
+            print(Style.RESET_ALL)
+            errors.append(f"Error occured using {strategy.longName}\n")
+        yields.append(strategy.shortName)
+    return demultiplexed, rejected, yields, errors
+
+
+class FormattedRecord():
+    """Tags and fastq representation of a TaggedRecord,
+    used to send demultiplexed records from the worker processes to the process writing the output"""
+    __slots__ = ('tags', 'text')
+
+    def __init__(self, record):
+        self.tags = record.tags
+        self.text = str(record)
+
+    def __repr__(self):
+        return self.text
+
+
+# Arguments of demultiplex_read_pair for the worker processes, set once per process by _init_demultiplex_worker
+_worker_args = None
+
+
+def _init_demultiplex_worker(strategies, baseDemux, library, probe, collect_rejects):
+    global _worker_args
+    _worker_args = (strategies, baseDemux, library, probe, collect_rejects)
+
+
+def _demultiplex_batch(batch):
+    results = []
+    batch_yields = collections.Counter()
+    for reads in batch:
+        demultiplexed, rejected, yields, errors = demultiplex_read_pair(reads, *_worker_args)
+        demultiplexed = [
+            [FormattedRecord(record) if isinstance(record, TaggedRecord) else record for record in records]
+            for records in demultiplexed]
+        results.append((demultiplexed, rejected, errors))
+        batch_yields.update(yields)
+    return results, batch_yields
+
+
 class DemultiplexingStrategyLoader:
     def __init__(
             self,
@@ -152,8 +245,29 @@ class DemultiplexingStrategyLoader:
             targetFile=None,
             rejectHandle=None,
             log_handle=None,
-            probe=None
+            probe=None,
+            n_processes=1,
+            batch_size=10_000
             ):
+        """Demultiplex the read pairs in the supplied fastq files
+
+        Args:
+            fastqfiles (list) : paths to the fastq files, one file for every read of the pair
+            maxReadPairs (int) : stop after demultiplexing this amount of read pairs
+            strategies (list) : demultiplexing strategies to apply, when not supplied the autodetect strategies are used
+            library (str) : library name
+            targetFile (FastqHandle) : handle to write demultiplexed reads to
+            rejectHandle (FastqHandle) : handle to write rejected reads to
+            log_handle : handle to write the log to
+            probe (bool) : ignore errors raised by the strategies
+            n_processes (int) : amount of worker processes used to demultiplex, the output is identical to
+                using a single process
+            batch_size (int) : amount of read pairs sent to a worker process at once
+
+        Returns:
+            processedReadPairs (int) : amount of read pairs processed
+            strategyYields (collections.Counter) : amount of read pairs demultiplexed per strategy
+        """
 
         useStrategies = strategies if strategies is not None else self.getAutodetectStrategies()
         strategyYields = collections.Counter()
@@ -163,57 +277,52 @@ class DemultiplexingStrategyLoader:
             barcodeParser=self.barcodeParser,
             probe=probe)
 
-        for p, reads in enumerate(
-                fastqIterator.FastqIterator(*fastqfiles)):
-            processedReadPairs = p+1
+        def write(demultiplexed, rejected, errors):
+            if targetFile is not None:
+                for recodedRecords in demultiplexed:
+                    targetFile.write(recodedRecords)
+            if rejectHandle is not None:
+                for to_write in rejected:
+                    rejectHandle.write(to_write)
+            if log_handle is not None:
+                for error in errors:
+                    log_handle.write(error)
+
+        read_pairs = itertools.chain.from_iterable(fastqIterator.FastqBatchIterator(*fastqfiles))
+        if maxReadPairs is not None:
+            read_pairs = itertools.islice(read_pairs, maxReadPairs)
+
+        if n_processes > 1:
+            # The reads are read in batches and distributed over the workers,
+            # the results are written in the order of the input.
+            # The amount of batches in memory is limited by pending_batches
+            pending_batches = threading.BoundedSemaphore(4 * n_processes)
+
+            def batches():
+                while True:
+                    batch = list(itertools.islice(read_pairs, batch_size))
+                    if len(batch) == 0:
+                        break
+                    pending_batches.acquire()
+                    yield batch
+
+            with Pool(n_processes, initializer=_init_demultiplex_worker,
+                      initargs=(useStrategies, baseDemux, library, probe, rejectHandle is not None)) as workers:
+                for results, batch_yields in workers.imap(_demultiplex_batch, batches()):
+                    pending_batches.release()
+                    for result in results:
+                        write(*result)
+                    strategyYields.update(batch_yields)
+                    processedReadPairs += len(results)
+        else:
+            for p, reads in enumerate(read_pairs):
+                processedReadPairs = p+1
+                demultiplexed, rejected, yields, errors = demultiplex_read_pair(
+                    reads, useStrategies, baseDemux, library=library, probe=probe,
+                    collect_rejects=rejectHandle is not None)
+                write(demultiplexed, rejected, errors)
+                strategyYields.update(yields)
 
-            for strategy in useStrategies:
-                try:
-                    recodedRecords = strategy.demultiplex(
-                        reads, library=library, probe=probe)
-
-                    if targetFile is not None:
-                        targetFile.write(recodedRecords)
-
-                except NonMultiplexable as reason:
-                    # print('NonMultiplexable')
-                    if rejectHandle is not None:
-
-                        try:
-                            to_write = baseDemux.demultiplex(
-                                reads, library=library, reason=reason)
-                            rejectHandle.write(to_write)
-
-                        except NonMultiplexable as e:
-                            # we cannot read the header of the read..
-                            reads = [
-                                '\n'.join(
-                                    (read.header +
-                                     f';RR:{reason};Rr:{e}',
-                                     read.sequence,
-                                     read.plus,
-                                     read.qual)) for read in reads]
-                            rejectHandle.write(reads)
-
-                    continue
-                except Exception as e:
-                    if probe:
-                        continue
-                    print(traceback.format_exc())
-                    print(
-                        f'{Fore.RED}Fatal error. While demultiplexing strategy {strategy.longName} yielded an error, the error message was: {e}')
-                    print('The read(s) causing the error looked like this:')
-                    for read in reads:
-                        print(str(read))
-                    print(Style.RESET_ALL)
-                    if log_handle is not None:
-                        log_handle.write(
-                            f"Error occured using {strategy.longName}\n")
-                # print(recodedRecord)
-                strategyYields[strategy.shortName] += 1
-            if (maxReadPairs is not None and (
-                    processedReadPairs) >= maxReadPairs):
-                break
         # write yields to log file if applicable:
         if log_handle is not None:
             log_handle.write(f'processed {processedReadPairs+1} read pairs\n')
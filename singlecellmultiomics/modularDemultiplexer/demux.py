@@ -118,6 +118,15 @@ if __name__ == '__main__':
         help="Hamming distance barcode expansion; accept cells with barcodes N distances away from the provided barcodes. Collisions are dealt with automatically. ",
         type=int,
         default=0)
+    bcArgs.add_argument(
+        '--compact_barcodes',
+        help="Store the hamming distance expanded barcodes and indices in compact lookup tables, this uses less memory and starts much faster for higher hamming distances",
+        action='store_true')
+    bcArgs.add_argument(
+        '-barcode_cache',
+        help="Folder to store the hamming distance expanded barcodes and indices in, the expansion is only performed when the barcode file or hamming distance changed. Implies --compact_barcodes",
+        type=str,
+        default=None)
     bcArgs.add_argument(
         '--lbi',
         help="List barcodes being used for cell demultiplexing",
@@ -177,6 +186,21 @@ if __name__ == '__main__':
         help="Amount of reads used to determine barcode type",
         type=int,
         default=2000)
+    techArgs.add_argument(
+        '-t',
+        help="Amount of processes used for demultiplexing, the output is identical to using a single process",
+        type=int,
+        default=1)
+    techArgs.add_argument(
+        '-compression_threads',
+        help="Amount of threads used to compress the output, the output is written as BGZF when supplied. Use this to increase the throughput when the output compression is the bottleneck",
+        type=int,
+        default=None)
+    techArgs.add_argument(
+        '-compression_level',
+        help="Compression level of the output (1-9), lower levels are faster, higher levels yield smaller files",
+        type=int,
+        default=1)
     techArgs.add_argument(
         '--nochunk',
         help="Do not run lanes in separate jobs",
@@ -233,7 +257,10 @@ if __name__ == '__main__':
     # Load barcodes
     barcodeParser = barcodeFileParser.BarcodeParser(
         hammingDistanceExpansion=args.hd,
-        barcodeDirectory=args.barcodeDir)
+        barcodeDirectory=args.barcodeDir,
+        compact=args.compact_barcodes,
+        lazy=True,
+        cache_dir=args.barcode_cache)
 
     # Setup the index parser
     indexFileAlias = args.ifa  # let the multiplex methods decide which index file to use
@@ -245,7 +272,7 @@ if __name__ == '__main__':
         for sequencingIndex in useSequencingIndices:
             print(f"{Fore.GREEN}{sequencingIndex}{Style.RESET_ALL}")
 
-        indexParser = barcodeFileParser.BarcodeParser()
+        indexParser = barcodeFileParser.BarcodeParser(compact=args.compact_barcodes)
         indexFileAlias = 'user'
         for index, sequencingIndex in enumerate(useSequencingIndices):
             indexParser.addBarcode(
@@ -259,7 +286,8 @@ if __name__ == '__main__':
 
     else:  # the sequencing indices are automatically detected
         indexParser = barcodeFileParser.BarcodeParser(
-            hammingDistanceExpansion=args.hdi, barcodeDirectory=args.indexDir)
+            hammingDistanceExpansion=args.hdi, barcodeDirectory=args.indexDir, compact=args.compact_barcodes,
+            lazy=True, cache_dir=args.barcode_cache)
 
     if args.lbi:
         barcodeParser.list(showBarcodes=None)
@@ -396,12 +424,16 @@ if __name__ == '__main__':
                 f'{args.o}/{library}/{prefix}demultiplexed',
                 True,
                 single_cell=args.scsepf,
-                maxHandles=args.fh)
+                maxHandles=args.fh,
+                compression_threads=args.compression_threads,
+                compresslevel=args.compression_level)
             if args.norejects:
                 rejectHandle = None
             else:
                 rejectHandle = FastqHandle(
-                    f'{args.o}/{library}/{prefix}rejects', True)
+                    f'{args.o}/{library}/{prefix}rejects', True,
+                    compression_threads=args.compression_threads,
+                    compresslevel=args.compression_level)
             """Set up statistic file"""
 
             log_location = os.path.abspath(
@@ -429,6 +461,7 @@ if __name__ == '__main__':
                                                                          rejectHandle=rejectHandle,
                                                                          log_handle=log_handle,
                                                                          library=library,
+                                                                         n_processes=args.t,
                                                                          maxReadPairs=None if args.n is None else (args.n - processedReadPairsForThisLib))
                     processedReadPairsForThisLib += processedReadPairs
                     log_handle.write(
@@ -259,17 +259,21 @@ class FeatureAnnotatedMolecule(Molecule):
 
             # Obtain all blocks:
             try:
-                for start, end in self.get_aligned_blocks():
-                    for hit in self.features.findFeaturesBetween(
-                            chromosome=self.chromosome, sampleStart=start, sampleEnd=end, strand=strand):
-                        hit_start, hit_end, hit_id, hit_strand, hit_ids = hit
-                        self.hits[hit_ids].add(
-                            (self.chromosome, (hit_start, hit_end)))
-
-                        if self.capture_locations:
-                            if not hit_id in self.feature_locations:
-                                self.feature_locations[hit_id] = []
-                            self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
+                blocks = list(self.get_aligned_blocks())
+                starts = [start for start, end in blocks]
+                ends = [end for start, end in blocks]
+                # Look up all blocks at once
+                _, feature_indices = self.features.findFeaturesBetweenBatch(
+                    self.chromosome, starts, ends, strand)
+                for feature_index in feature_indices.tolist():
+                    hit_start, hit_end, hit_id, hit_strand, hit_ids = self.features.features[self.chromosome][feature_index]
+                    self.hits[hit_ids].add(
+                        (self.chromosome, (hit_start, hit_end)))
+
+                    if self.capture_locations:
+                        if not hit_id in self.feature_locations:
+                            self.feature_locations[hit_id] = []
+                        self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
 
             except TypeError:
                 # This happens when no reads map
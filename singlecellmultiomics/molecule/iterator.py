@@ -6,6 +6,8 @@ from singlecellmultiomics.utils.prefetch import initialise_dict, initialise
 from singlecellmultiomics.universalBamTagger import QueryNameFlagger
 import pysamiterators.iterators
 import collections
+import heapq
+import itertools
 import pysam
 
 
@@ -18,6 +20,118 @@ class ReadIterator(pysamiterators.iterators.MatePairIterator):
         except StopIteration:
             raise
 
+class UmiIndex():
+    """Index of the UMIs of the molecules belonging to a single hash group
+
+    Used by the MoleculeIterator to find the molecules a fragment could be
+    assigned to without comparing the fragment to every molecule in the group.
+    For umi_hamming_distance 0 the UMI itself is used as key, otherwise every
+    UMI is stored once for every combination of umi_hamming_distance masked
+    positions, two UMIs of the same length are within the hamming distance when
+    they share at least one of these keys.
+
+    Molecules with a UMI which cannot be indexed (containing N, or too short)
+    and molecules with a UMI of a different length than the query are always
+    returned as candidate, this keeps the result identical to comparing against
+    all molecules using Fragment.umi_eq.
+    """
+
+    def __init__(self, umi_hamming_distance, max_keys_per_umi=128):
+        self.umi_hamming_distance = umi_hamming_distance
+        self.max_keys_per_umi = max_keys_per_umi
+        self.index = collections.defaultdict(dict)  # key -> {id(molecule): molecule}
+        self.by_length = collections.defaultdict(dict)  # umi length -> {id(molecule): molecule}
+        self.unindexed = {}  # {id(molecule): molecule}
+        self.indexed_umi = {}  # id(molecule) -> (umi, keys)
+        self.order = {}  # id(molecule) -> insertion order
+        self.added = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def _get_keys(self, umi):
+        """Obtain index keys for the supplied UMI, returns None when the UMI cannot be indexed"""
+        if self.umi_hamming_distance == 0:
+            return [umi]
+        if umi is None or 'N' in umi or len(umi) <= self.umi_hamming_distance:
+            return None
+        keys = [
+            (masked, ''.join(base for i, base in enumerate(umi) if not i in masked))
+            for masked in itertools.combinations(range(len(umi)), self.umi_hamming_distance)
+        ]
+        if len(keys) > self.max_keys_per_umi:
+            return None
+        return keys
+
+    def _index(self, molecule):
+        keys = self._get_keys(molecule.umi)
+        self.indexed_umi[id(molecule)] = (molecule.umi, keys)
+        if keys is None:
+            self.unindexed[id(molecule)] = molecule
+            return
+        for key in keys:
+            self.index[key][id(molecule)] = molecule
+        if self.umi_hamming_distance > 0:
+            self.by_length[len(molecule.umi)][id(molecule)] = molecule
+
+    def add(self, molecule):
+        """Add a molecule to the index"""
+        self.order[id(molecule)] = self.added
+        self.added += 1
+        self._index(molecule)
+
+    def remove(self, molecule):
+        """Remove a molecule from the index"""
+        umi, keys = self.indexed_umi.pop(id(molecule))
+        if keys is None:
+            del self.unindexed[id(molecule)]
+        else:
+            for key in keys:
+                del self.index[key][id(molecule)]
+                if len(self.index[key]) == 0:
+                    del self.index[key]
+            if self.umi_hamming_distance > 0:
+                del self.by_length[len(umi)][id(molecule)]
+                if len(self.by_length[len(umi)]) == 0:
+                    del self.by_length[len(umi)]
+        del self.order[id(molecule)]
+
+    def update(self, molecule):
+        """Re-index a molecule after a fragment has been added to it, the UMI of the molecule might have changed"""
+        if self.indexed_umi[id(molecule)][0] == molecule.umi:
+            return
+        order = self.order[id(molecule)]
+        self.remove(molecule)
+        self.order[id(molecule)] = order
+        self._index(molecule)
+
+    def get_candidates(self, fragment):
+        """Obtain molecules the fragment could be assigned to
+
+        Args:
+            fragment (singlecellmultiomics.fragment.Fragment) : fragment to find candidate molecules for
+
+        Returns:
+            candidates (list) : molecules, in insertion order, or None when the index cannot be used for this fragment
+        """
+        if fragment.umi_hamming_distance != self.umi_hamming_distance:
+            return None
+        keys = self._get_keys(fragment.umi)
+        if keys is None:
+            return None
+
+        hits = dict(self.unindexed)
+        for key in keys:
+            if key in self.index:
+                hits.update(self.index[key])
+        if self.umi_hamming_distance > 0:
+            for umi_length, molecules in self.by_length.items():
+                if umi_length != len(fragment.umi):
+                    hits.update(molecules)
+
+        return sorted(hits.values(), key=lambda molecule: self.order[id(molecule)])
+
+
 class MoleculeIterator():
     """Iterate over molecules in pysam.AlignmentFile or reads from a generator or list
 
@@ -161,6 +275,8 @@ class MoleculeIterator():
                  skip_contigs=None,
                  progress_callback_function=None,
                  min_mapping_qual = None,
+                 index_umis = False,
+                 annotation_batch_size = None,
 
                  **pysamArgs):
         """Iterate over molecules in pysam.AlignmentFile
@@ -181,7 +297,9 @@ class MoleculeIterator():
             perform_qflag (bool):  Make sure the sample/umi etc tags are copied
                 from the read name into bam tags
 
-            pooling_method(int) : 0: no  pooling, 1: only compare molecules with the same sample id and hash
+            pooling_method(int) : 0: no  pooling, 1: only compare molecules with the same sample id and hash,
+                2: same as 1, but molecules are additionally indexed in heaps ordered by ejection coordinate (spanStart - cache_size/2 and spanEnd + cache_size/2),
+                only the molecules which can be ejected are visited when checking for ejection. Yields the same molecules in the same order as 1.
 
             yield_invalid (bool) : When true all fragments which are invalid will be yielded as a molecule
 
@@ -199,6 +317,12 @@ class MoleculeIterator():
 
             min_mapping_qual(int) : Dont process reads with a mapping quality lower than this value. These reads are not yielded as molecules!
 
+            index_umis(bool) : Use a UMI index to find the molecules a fragment can be assigned to, instead of comparing the fragment to all molecules with the same hash.
+                Only used for pooling_method 1 and 2 and fragment classes which have umi_index_compatible set. The resulting molecules are identical.
+
+            annotation_batch_size(int) : Annotate this amount of fragments at once using fragment_class.annotate_batch, instead of annotating every fragment upon initialisation.
+                Only used for fragment classes which have an annotate_batch method when auto_set_intron_exon_features is set in fragment_class_args. The resulting molecules are identical.
+
             **kwargs: arguments to pass to the pysam.AlignmentFile.fetch function
 
         Yields:
@@ -225,6 +349,11 @@ class MoleculeIterator():
         self.iterator_class = iterator_class
         self.max_buffer_size=max_buffer_size
         self.min_mapping_qual = min_mapping_qual
+        self.index_umis = index_umis and pooling_method in (1, 2) and \
+            getattr(fragment_class, 'umi_index_compatible', False)
+        self.annotation_batch_size = annotation_batch_size if \
+            getattr(fragment_class, 'annotate_batch', None) is not None and \
+            self.fragment_class_args.get('auto_set_intron_exon_features', False) else None
 
         self._clear_cache()
 
@@ -234,11 +363,22 @@ class MoleculeIterator():
         self.yielded_fragments = 0
         self.deleted_fragments = 0
         self.check_ejection_iter = 0
+        self.umi_indices = {}  # hash -> UmiIndex
         if self.pooling_method == 0:
             self.molecules = []
         elif self.pooling_method == 1:
             self.molecules_per_cell = collections.defaultdict(
                 list)  # {hash:[], :}
+        elif self.pooling_method == 2:
+            self.molecules_per_cell = collections.defaultdict(
+                list)  # {hash:[], :}
+            # Heaps containing (key, (molecule_index, group_index, molecule))
+            self.end_heap = []
+            self.start_heap = []
+            self.buffered_molecules = set()  # molecule_index of molecules in the heaps
+            self.hash_group_index = {}  # hash -> order of first occurence
+            self.contig_rank = {}  # contig -> order of first occurence
+            self.molecule_index = 0
         else:
             raise NotImplementedError()
 
@@ -251,19 +391,230 @@ class MoleculeIterator():
     def get_molecule_cache_size(self):
         if self.pooling_method == 0:
             return len(self.molecules)
-        elif self.pooling_method == 1:
+        elif self.pooling_method in (1, 2):
             return sum(len(cell_molecules) for cell,
                        cell_molecules in self.molecules_per_cell.items())
 
         else:
             raise NotImplementedError()
 
+    def _index_molecule(self, molecule, hash_group, fragment):
+        if not hash_group in self.umi_indices:
+            self.umi_indices[hash_group] = UmiIndex(fragment.umi_hamming_distance)
+        self.umi_indices[hash_group].add(molecule)
+
+    def _unindex_molecule(self, molecule, hash_group):
+        if self.index_umis:
+            self.umi_indices[hash_group].remove(molecule)
+            if len(self.umi_indices[hash_group]) == 0:
+                del self.umi_indices[hash_group]
+
+    def _get_contig_rank(self, contig):
+        if not contig in self.contig_rank:
+            self.contig_rank[contig] = len(self.contig_rank)
+        return self.contig_rank[contig]
+
+    def _get_ejection_keys(self, molecule):
+        """Obtain the heap keys of a molecule for pooling_method 2
+
+        Returns:
+            end_key (tuple) : (contig_rank, coordinate after which the molecule can be ejected)
+            start_key (tuple) : (-contig_rank, -coordinate before which the molecule can be ejected)
+        """
+        rank = self._get_contig_rank(molecule.chromosome)
+        return ((rank, molecule.spanEnd + molecule.cache_size * 0.5),
+                (-rank, -(molecule.spanStart - molecule.cache_size * 0.5)))
+
+    def _push_molecule(self, molecule, hash_group):
+        """Add a new molecule to the buffer of pooling_method 2"""
+        if not hash_group in self.hash_group_index:
+            self.hash_group_index[hash_group] = len(self.hash_group_index)
+        self.molecules_per_cell[hash_group].append(molecule)
+
+        end_key, start_key = self._get_ejection_keys(molecule)
+        entry = (self.molecule_index, self.hash_group_index[hash_group], molecule)
+        heapq.heappush(self.end_heap, (end_key, entry))
+        heapq.heappush(self.start_heap, (start_key, entry))
+        self.buffered_molecules.add(self.molecule_index)
+        self.molecule_index += 1
+
+    def _pop_heap(self, heap, key_index, limit):
+        """Pop all buffered molecules from the supplied heap with a key below limit
+
+        Molecules of which the span was extended after they were pushed are
+        pushed back with their updated key.
+        """
+        while len(heap):
+            key, entry = heap[0]
+            index, group_index, m = entry
+            if not index in self.buffered_molecules:
+                # Already ejected using the other heap
+                heapq.heappop(heap)
+                continue
+            if key[0] > limit[0] or (key[0] == limit[0] and limit[1] <= key[1]):
+                return
+            current_key = self._get_ejection_keys(m)[key_index]
+            if current_key > key:
+                heapq.heapreplace(heap, (current_key, entry))
+                continue
+            heapq.heappop(heap)
+            self.buffered_molecules.remove(index)
+            yield entry
+
+    def _pop_ejectable_molecules(self, current_chrom, current_position):
+        """Remove all molecules which can be ejected from the buffer of pooling_method 2
+
+        Molecules are kept in two heaps, one ordered by the coordinate after which
+        the molecule can be ejected, and one by the coordinate before which the
+        molecule can be ejected. Only the molecules which can be ejected are visited.
+
+        Returns:
+            molecules (list) : ejectable molecules, in the order pooling_method 1 would yield them
+        """
+        current_rank = self._get_contig_rank(current_chrom)
+        ejected = list(self._pop_heap(self.end_heap, 0, (current_rank, current_position)))
+        ejected += self._pop_heap(self.start_heap, 1, (-current_rank, -current_position))
+
+        if len(ejected) == 0:
+            return []
+
+        ejected.sort(key=lambda entry: (entry[1], entry[0]))
+        ejected_ids = set(id(m) for _, _, m in ejected)
+        for _, _, m in ejected:
+            self._unindex_molecule(m, m.match_hash)
+        for hash_group in set(m.match_hash for _, _, m in ejected):
+            self.molecules_per_cell[hash_group] = [
+                m for m in self.molecules_per_cell[hash_group]
+                if not id(m) in ejected_ids]
+        return [m for _, _, m in ejected]
+
+    def _process_fragment_batch(self, fragments):
+        """Annotate the fragments in a single batch and assign them to molecules"""
+        if len(fragments) == 0:
+            return
+        self.fragment_class.annotate_batch(fragments)
+        for fragment in fragments:
+            yield from self._process_fragment(fragment)
+
+    def _process_fragment(self, fragment):
+        """Assign fragment to a molecule, yields the molecules which can be ejected"""
+        if not fragment.is_valid():
+            if self.yield_invalid:
+                m = self.molecule_class(
+                    fragment, **self.molecule_class_args)
+                m.__finalise__()
+                yield m
+            else:
+                self.deleted_fragments+=1
+            return
+
+        if self.every_fragment_as_molecule:
+            m = self.molecule_class(fragment, **self.molecule_class_args)
+            m.__finalise__()
+            yield m
+            return
+
+        added = False
+        try:
+            if self.pooling_method == 0:
+                for molecule in self.molecules:
+                    if molecule.add_fragment(fragment, use_hash=False):
+                        added = True
+                        break
+            elif self.pooling_method in (1, 2):
+                candidates = self.molecules_per_cell[fragment.match_hash]
+                if self.index_umis and fragment.match_hash in self.umi_indices:
+                    indexed_candidates = self.umi_indices[fragment.match_hash].get_candidates(fragment)
+                    if indexed_candidates is not None:
+                        candidates = indexed_candidates
+                for molecule in candidates:
+                    if molecule.add_fragment(fragment, use_hash=True):
+                        added = True
+                        if self.index_umis:
+                            self.umi_indices[fragment.match_hash].update(molecule)
+                        break
+        except OverflowError:
+            # This means the fragment does belong to a molecule, but the molecule does not accept any more fragments.
+            if self.yield_overflow:
+                m = self.molecule_class(fragment, **self.molecule_class_args)
+                m.set_rejection_reason('overflow')
+                m.__finalise__()
+                yield m
+            else:
+                self.deleted_fragments+=1
+            return
+
+        if not added:
+            if self.pooling_method == 0:
+                self.molecules.append(self.molecule_class(
+                    fragment, **self.molecule_class_args))
+            else:
+                m = self.molecule_class(fragment, **self.molecule_class_args)
+                if self.pooling_method == 2:
+                    self._push_molecule(m, fragment.match_hash)
+                else:
+                    self.molecules_per_cell[fragment.match_hash].append(m)
+                if self.index_umis:
+                    self._index_molecule(m, fragment.match_hash, fragment)
+
+        self.waiting_fragments += 1
+        self.check_ejection_iter += 1
+
+        if self.max_buffer_size is not None and self.waiting_fragments>self.max_buffer_size:
+            raise MemoryError(f'max_buffer_size exceeded with {self.waiting_fragments} waiting fragments')
+
+        if self.check_eject_every is not None and self.check_ejection_iter > self.check_eject_every:
+            current_chrom, _, current_position = fragment.get_span()
+            if current_chrom is None:
+                return
+
+            self.check_ejection_iter = 0
+            if self.pooling_method == 0:
+                to_pop = []
+                for i, m in enumerate(self.molecules):
+                    if m.can_be_yielded(current_chrom, current_position):
+                        to_pop.append(i)
+                        self.waiting_fragments -= len(m)
+                        self.yielded_fragments += len(m)
+
+                for i, j in enumerate(to_pop):
+                    m = self.molecules.pop(j - i)
+                    m.__finalise__()
+                    yield m
+            elif self.pooling_method == 2:
+                for m in self._pop_ejectable_molecules(current_chrom, current_position):
+                    self.waiting_fragments -= len(m)
+                    self.yielded_fragments += len(m)
+                    m.__finalise__()
+                    yield m
+            else:
+                for hash_group, molecules in self.molecules_per_cell.items():
+
+                    to_pop = []
+                    for i, m in enumerate(molecules):
+                        if m.can_be_yielded(
+                                current_chrom, current_position):
+                            to_pop.append(i)
+                            self.waiting_fragments -= len(m)
+                            self.yielded_fragments += len(m)
+
+                    for i, j in enumerate(to_pop):
+                        m = self.molecules_per_cell[hash_group].pop(j - i)
+                        self._unindex_molecule(m, hash_group)
+                        m.__finalise__()
+                        yield m
+
     def __iter__(self):
         if self.perform_qflag:
             qf = self.query_name_flagger
 
         self._clear_cache()
         self.waiting_fragments = 0
+        fragment_class_args = self.fragment_class_args
+        pending_fragments = []
+        if self.annotation_batch_size is not None:
+            # The fragments are annotated in batches by _process_fragment_batch
+            fragment_class_args = dict(fragment_class_args, auto_set_intron_exon_features=False)
         # prepare the source iterator which generates the read pairs:
         if isinstance(self.alignments, pysam.libcalignmentfile.AlignmentFile):
             self.matePairIterator = self.iterator_class(
@@ -313,95 +664,17 @@ class MoleculeIterator():
             if self.perform_qflag:
                 qf.digest([R1, R2])
 
-            fragment = self.fragment_class([R1, R2], **self.fragment_class_args)
-
-            if not fragment.is_valid():
-                if self.yield_invalid:
-                    m = self.molecule_class(
-                        fragment, **self.molecule_class_args)
-                    m.__finalise__()
-                    yield m
-                else:
-                    self.deleted_fragments+=1
-                continue
-
-            if self.every_fragment_as_molecule:
-                m = self.molecule_class(fragment, **self.molecule_class_args)
-                m.__finalise__()
-                yield m
-                continue
-
-            added = False
-            try:
-                if self.pooling_method == 0:
-                    for molecule in self.molecules:
-                        if molecule.add_fragment(fragment, use_hash=False):
-                            added = True
-                            break
-                elif self.pooling_method == 1:
-                    for molecule in self.molecules_per_cell[fragment.match_hash]:
-                        if molecule.add_fragment(fragment, use_hash=True):
-                            added = True
-                            break
-            except OverflowError:
-                # This means the fragment does belong to a molecule, but the molecule does not accept any more fragments.
-                if self.yield_overflow:
-                    m = self.molecule_class(fragment, **self.molecule_class_args)
-                    m.set_rejection_reason('overflow')
-                    m.__finalise__()
-                    yield m
-                else:
-                    self.deleted_fragments+=1
-                continue
-
-            if not added:
-                if self.pooling_method == 0:
-                    self.molecules.append(self.molecule_class(
-                        fragment, **self.molecule_class_args))
-                else:
-                    self.molecules_per_cell[fragment.match_hash].append(
-                        self.molecule_class(fragment, **self.molecule_class_args)
-                    )
-
-            self.waiting_fragments += 1
-            self.check_ejection_iter += 1
-
-            if self.max_buffer_size is not None and self.waiting_fragments>self.max_buffer_size:
-                raise MemoryError(f'max_buffer_size exceeded with {self.waiting_fragments} waiting fragments')
+            fragment = self.fragment_class([R1, R2], **fragment_class_args)
 
-            if self.check_eject_every is not None and self.check_ejection_iter > self.check_eject_every:
-                current_chrom, _, current_position = fragment.get_span()
-                if current_chrom is None:
-                    continue
-
-                self.check_ejection_iter = 0
-                if self.pooling_method == 0:
-                    to_pop = []
-                    for i, m in enumerate(self.molecules):
-                        if m.can_be_yielded(current_chrom, current_position):
-                            to_pop.append(i)
-                            self.waiting_fragments -= len(m)
-                            self.yielded_fragments += len(m)
+            if self.annotation_batch_size is not None:
+                pending_fragments.append(fragment)
+                if len(pending_fragments) >= self.annotation_batch_size:
+                    yield from self._process_fragment_batch(pending_fragments)
+                    pending_fragments = []
+            else:
+                yield from self._process_fragment(fragment)
 
-                    for i, j in enumerate(to_pop):
-                        m = self.molecules.pop(i - j)
-                        m.__finalise__()
-                        yield m
-                else:
-                    for hash_group, molecules in self.molecules_per_cell.items():
-
-                        to_pop = []
-                        for i, m in enumerate(molecules):
-                            if m.can_be_yielded(
-                                    current_chrom, current_position):
-                                to_pop.append(i)
-                                self.waiting_fragments -= len(m)
-                                self.yielded_fragments += len(m)
-
-                        for i, j in enumerate(to_pop):
-                            m = self.molecules_per_cell[hash_group].pop(i - j)
-                            m.__finalise__()
-                            yield m
+        yield from self._process_fragment_batch(pending_fragments)
 
         # Yield remains
         if self.pooling_method == 0:
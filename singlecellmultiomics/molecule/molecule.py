@@ -16,6 +16,22 @@ from singlecellmultiomics.utils import find_ranges, create_MD_tag
 import pandas as pd
 from uuid import uuid4
 
+# Lookup table to find upper case call bytes (methylated calls) in an XM string
+_IS_UPPER_CASE = np.array([chr(i).isupper() for i in range(256)], dtype=bool)
+
+# Columns of the base observation matrices, all bases which are not A, C, G or T are counted as N
+OBSERVATION_BASES = 'ACGTN'
+_OBSERVATION_BASE_INDEX = np.full(256, 4, dtype=np.int64)
+for _index, _base in enumerate('ACGT'):
+    _OBSERVATION_BASE_INDEX[ord(_base)] = _index
+
+BaseObservationMatrix = collections.namedtuple('BaseObservationMatrix', 'positions counts reference_bases')
+BaseObservationMatrix.__doc__ = """Base observations of a molecule on a single contig
+
+    positions (np.array) : sorted reference positions with at least one observation
+    counts (np.array) : int32 array of shape (len(positions), 5) with the A, C, G, T and N observations per position
+    reference_bases (np.array) : reference base (uint8) per position, 0 when unknown, None when not requested
+"""
 
 ###############
 
@@ -1759,82 +1775,66 @@ class Molecule():
 
         # molecule_XM dictionary containing count of contexts
         molecule_XM = collections.Counter(
-            list(
-                d.get(
-                    'context',
-                    '.') for d in self.methylation_call_dict.values()))
+            d.get('context', '.') for d in self.methylation_call_dict.values())
+        molecule_tags = [
+            (total_methylated_tag, molecule_XM['Z'] + molecule_XM['X'] + molecule_XM['H']),
+            (total_unmethylated_tag, molecule_XM['z'] + molecule_XM['x'] + molecule_XM['h']),
+            (total_methylated_CPG_tag, molecule_XM['Z']),
+            (total_unmethylated_CPG_tag, molecule_XM['z']),
+            (total_methylated_CHG_tag, molecule_XM['X']),
+            (total_unmethylated_CHG_tag, molecule_XM['x']),
+            (total_methylated_CHH_tag, molecule_XM['H']),
+            (total_unmethylated_CHH_tag, molecule_XM['h'])
+        ]
+
+        # Build an array containing the call of every reference position, per contig:
+        call_arrays = {}
+        positions_per_contig = collections.defaultdict(list)
+        contexts_per_contig = collections.defaultdict(list)
+        for (chrom, pos), call in call_dict.items():
+            positions_per_contig[chrom].append(pos)
+            contexts_per_contig[chrom].append(call.get('context', '.'))
+        for chrom, positions in positions_per_contig.items():
+            positions = np.array(positions, dtype=np.int64)
+            offset = positions.min()
+            call_array = np.full(positions.max() - offset + 1, ord('.'), dtype=np.uint8)
+            call_array[positions - offset] = np.frombuffer(
+                ''.join(contexts_per_contig[chrom]).encode(), dtype=np.uint8)
+            call_arrays[chrom] = (offset, call_array)
+
         # Contruct XM strings
         if reads is None:
             reads = self.iter_reads()
         for read in reads:
-
-            bis_met_call_string = ''.join([
-                call_dict.get(
-                    (read.reference_name, rpos), {}).get('context', '.')
-                # Obtain all aligned positions from the call dict
-                # iterate all positions in the alignment
-                for qpos, rpos in read.get_aligned_pairs(matches_only=True)
-                if qpos is not None and rpos is not None])
-            # make sure to ignore non matching positions ? is this neccesary?
+            query_positions, reference_positions = \
+                singlecellmultiomics.bamProcessing.get_aligned_pairs_array(read)
+            read_calls = np.full(len(reference_positions), ord('.'), dtype=np.uint8)
+            if read.reference_name in call_arrays:
+                offset, call_array = call_arrays[read.reference_name]
+                indices = reference_positions - offset
+                in_range = (indices >= 0) & (indices < len(call_array))
+                read_calls[in_range] = call_array[indices[in_range]]
 
             read.set_tag(
                 # Write the methylation tag to the read
                 bismark_call_tag,
-                bis_met_call_string
+                read_calls.tobytes().decode()
             )
 
-            # Set total methylated bases
-            read.set_tag(
-                total_methylated_tag,
-                molecule_XM['Z'] + molecule_XM['X'] + molecule_XM['H'])
-
-            # Set total unmethylated bases
-            read.set_tag(
-                total_unmethylated_tag,
-                molecule_XM['z'] + molecule_XM['x'] + molecule_XM['h'])
-
-            # Set total CPG methylated and unmethylated:
-            read.set_tag(
-                total_methylated_CPG_tag,
-                molecule_XM['Z'])
-
-            read.set_tag(
-                total_unmethylated_CPG_tag,
-                molecule_XM['z'])
-
-            # Set total CHG methylated and unmethylated:
-            read.set_tag(
-                total_methylated_CHG_tag,
-                molecule_XM['X'])
-
-            read.set_tag(
-                total_unmethylated_CHG_tag,
-                molecule_XM['x'])
-
-            # Set total CHH methylated and unmethylated:
-            read.set_tag(
-                total_methylated_CHH_tag,
-                molecule_XM['H'])
-
-            read.set_tag(
-                total_unmethylated_CHH_tag,
-                molecule_XM['h'])
-
+            for tag, value in molecule_tags:
+                read.set_tag(tag, value)
 
             # Set XR (Read conversion string)
-            # @todo: this is TAPS specific, inneficient, ugly
-
-            fwd = 0
-            rev = 0
-            for (qpos, rpos, ref_base), call in zip(
-                read.get_aligned_pairs(matches_only=True,with_seq=True),
-                bis_met_call_string):
-                qbase = read.query_sequence[qpos]
-                if call.isupper():
-                    if qbase=='A':
-                        rev+=1
-                    elif qbase=='T':
-                        fwd+=1
+            # Count the methylated calls supported by a T (forward) or A (reverse) in the read
+            # @todo: this is TAPS specific
+            methylated = _IS_UPPER_CASE[read_calls]
+            if methylated.any():
+                query_bases = np.frombuffer(
+                    read.query_sequence.encode(), dtype=np.uint8)[query_positions[methylated]]
+                rev = np.count_nonzero(query_bases == ord('A'))
+                fwd = np.count_nonzero(query_bases == ord('T'))
+            else:
+                rev = fwd = 0
 
             # Set XG (genome conversion string)
             if rev>fwd:
@@ -1990,8 +1990,8 @@ class Molecule():
         if return_allele_informative_base_dict:
             aibd = collections.defaultdict(list)
         try:
-            for (chrom, pos), base in self.get_consensus(
-                    base_obs=self.get_base_observation_dict_NOREF()).items():
+            for (chrom, pos), base in self._base_observation_matrix_consensus(
+                    self.get_base_observation_matrix(span_only=True)).items():
                 c = allele_resolver.getAllelesAt(chrom, pos, base)
                 if c is not None and len(c) == 1:
                     alleles.update(c)
@@ -2040,48 +2040,121 @@ class Molecule():
             for read in reads:
                 read.set_tag(tag, phase_str)
 
-    def get_base_observation_dict_NOREF(self, allow_N=False):
-        '''
-        identical to get_base_observation_dict but does not obtain reference bases,
-        has to be used when no MD tag is present
+    def get_base_observation_matrix(self, return_refbases=False, allow_unsafe=True, span_only=False):
+        """Obtain observed bases at reference aligned locations as count matrices
+
         Args:
-            return_refbases ( bool ):
-                return both observed bases and reference bases
+            return_refbases (bool) : obtain the reference base of every position.
+                The reference bases are obtained from the MD tag when allow_unsafe is True or when no reference
+                is available, otherwise from the reference of the molecule
 
-        Returns:
-            { genome_location (tuple) : base (string) : obs (int) }
-            and
-            { genome_location (tuple) : base (string) if return_refbases is True }
-        '''
+            allow_unsafe (bool) : see return_refbases
 
-        base_obs = collections.defaultdict(collections.Counter)
+            span_only (bool) : only count bases within the span of the fragment the read belongs to
 
-        used = 0  # some alignments yielded valid calls
-        ignored = 0
+        Returns:
+            matrices (dict) : { contig (str) : BaseObservationMatrix }
+        """
+        positions_per_contig = collections.defaultdict(list)
+        bases_per_contig = collections.defaultdict(list)
+        reference_bases_per_contig = collections.defaultdict(list)
         for fragment in self:
             _, start, end = fragment.span
             for read in fragment:
-                if read is None:
+                if read is None or read.query_sequence is None:
                     continue
+                query_positions, reference_positions = \
+                    singlecellmultiomics.bamProcessing.get_aligned_pairs_array(read)
+                if span_only:
+                    in_span = (reference_positions >= start) & (reference_positions <= end)
+                    query_positions, reference_positions = query_positions[in_span], reference_positions[in_span]
+                if len(reference_positions) == 0:
+                    continue
+                query_bases = np.frombuffer(read.query_sequence.encode(), dtype=np.uint8)[query_positions]
+                positions_per_contig[read.reference_name].append(reference_positions)
+                bases_per_contig[read.reference_name].append(_OBSERVATION_BASE_INDEX[query_bases])
+
+                if return_refbases:
+                    if allow_unsafe or self.reference is None:
+                        reference_bases = singlecellmultiomics.bamProcessing.get_aligned_reference_bases(
+                            read, query_positions)
+                    else:
+                        offset = reference_positions.min()
+                        sequence = self.reference.fetch(
+                            read.reference_name, offset, reference_positions.max() + 1).upper().encode()
+                        # Pad positions beyond the end of the reference with N
+                        sequence = np.frombuffer(
+                            sequence.ljust(reference_positions.max() + 1 - offset, b'N'), dtype=np.uint8)
+                        reference_bases = sequence[reference_positions - offset]
+                    reference_bases_per_contig[read.reference_name].append(reference_bases)
+
+        matrices = {}
+        for contig, positions in positions_per_contig.items():
+            positions = np.concatenate(positions)
+            bases = np.concatenate(bases_per_contig[contig])
+            unique_positions, indices = np.unique(positions, return_inverse=True)
+            counts = np.bincount(indices * 5 + bases, minlength=len(unique_positions) * 5).astype(
+                np.int32).reshape(-1, 5)
+            reference_bases = None
+            if return_refbases:
+                reference_bases = np.zeros(len(unique_positions), dtype=np.uint8)
+                # Only positions with a base call which is not N obtain a reference base
+                called = bases != 4
+                reference_bases[indices[called]] = np.concatenate(reference_bases_per_contig[contig])[called]
+            matrices[contig] = BaseObservationMatrix(unique_positions, counts, reference_bases)
+        return matrices
+
+    def _get_cached_base_observation_matrix(self, return_refbases=False, allow_unsafe=True):
+        # The matrix is cached until a fragment is added to the molecule
+        if self.saved_base_obs is None or (return_refbases and not self.saved_base_obs[1]):
+            self.saved_base_obs = (
+                self.get_base_observation_matrix(return_refbases=return_refbases, allow_unsafe=allow_unsafe),
+                return_refbases)
+        return self.saved_base_obs[0]
+
+    @staticmethod
+    def _base_observation_matrix_to_dict(matrices, allow_N=False):
+        base_obs = collections.defaultdict(collections.Counter)
+        columns = OBSERVATION_BASES if allow_N else OBSERVATION_BASES[:4]
+        for contig, matrix in matrices.items():
+            counts = matrix.counts[:, :len(columns)]
+            for position, row in zip(matrix.positions.tolist(), counts.tolist()):
+                observations = {base: n for base, n in zip(columns, row) if n > 0}
+                if len(observations):
+                    base_obs[(contig, position)] = collections.Counter(observations)
+        return base_obs
 
-                for cycle, query_pos, ref_pos in pysamiterators.iterators.ReadCycleIterator(
-                        read, with_seq=False):
-
-                    if query_pos is None or ref_pos is None or ref_pos < start or ref_pos > end:
-                        continue
-                    query_base = read.seq[query_pos]
-                    if query_base == 'N' and not allow_N:
-                        continue
-                    base_obs[(read.reference_name, ref_pos)][query_base] += 1
+    @staticmethod
+    def _base_observation_matrix_consensus(matrices):
+        """Obtain the majority vote consensus from base observation matrices, N observations are ignored"""
+        consensus = {}
+        for contig, matrix in matrices.items():
+            counts = matrix.counts[:, :4]
+            best = counts.max(1)
+            # A consensus is only called when the most observed base is observed more often than all others
+            decided = (best > 0) & ((counts == best[:, None]).sum(1) == 1)
+            bases = np.array(list(OBSERVATION_BASES))[counts[decided].argmax(1)]
+            consensus.update(
+                zip(((contig, position) for position in matrix.positions[decided].tolist()), bases.tolist()))
+        return consensus
 
-        if used == 0 and ignored > 0:
-            raise ValueError('Could not extract any safe data from molecule')
+    def get_base_observation_dict_NOREF(self, allow_N=False):
+        '''
+        identical to get_base_observation_dict but does not obtain reference bases,
+        has to be used when no MD tag is present. Only bases within the span of the fragments are used.
+        Args:
+            allow_N (bool): Keep N base calls in observations
 
-        return base_obs
+        Returns:
+            { genome_location (tuple) : base (string) : obs (int) }
+        '''
+        return self._base_observation_matrix_to_dict(
+            self.get_base_observation_matrix(span_only=True), allow_N=allow_N)
 
     def get_base_observation_dict(self, return_refbases=False, allow_N=False, allow_unsafe=True):
         '''
-        Obtain observed bases at reference aligned locations
+        Obtain observed bases at reference aligned locations.
+        This is a view of the (cached) matrices obtained using get_base_observation_matrix
 
         Args:
             return_refbases ( bool ):
@@ -2093,68 +2166,19 @@ class Molecule():
             and
             { genome_location (tuple) : base (string) if return_refbases is True }
         '''
-
-        # Check if cached is available
-        if self.saved_base_obs is not None:
-            if not return_refbases:
-                return self.saved_base_obs[0]
-            else:
-                if self.saved_base_obs[1] is not None:
-                    return self.saved_base_obs
-
-        base_obs = collections.defaultdict(collections.Counter)
+        matrices = self._get_cached_base_observation_matrix(
+            return_refbases=return_refbases, allow_unsafe=allow_unsafe)
+        base_obs = self._base_observation_matrix_to_dict(matrices)
+        if not return_refbases:
+            return base_obs
 
         ref_bases = {}
-        used = 0  # some alignments yielded valid calls
-        ignored = 0
-        error = None
-        for fragment in self:
-            _, start, end = fragment.span
-
-            used += 1
-            for read in fragment:
-                if read is None:
-                    continue
-
-                if allow_unsafe:
-                    for query_pos, ref_pos, ref_base in read.get_aligned_pairs(matches_only=True, with_seq=True):
-                        if query_pos is None or ref_pos is None:  # or ref_pos < start or ref_pos > end:
-                            continue
-                        query_base = read.seq[query_pos]
-                        # query_qual = read.qual[query_pos]
-                        if query_base == 'N':
-                            continue
-                        base_obs[(read.reference_name, ref_pos)][query_base] += 1
-
-                        if return_refbases:
-                            ref_bases[(read.reference_name, ref_pos)
-                            ] = ref_base.upper()
-
-                else:
-                    for cycle, query_pos, ref_pos, ref_base in pysamiterators.iterators.ReadCycleIterator(
-                            read, with_seq=True, reference=self.reference):
-
-                        if query_pos is None or ref_pos is None:  # or ref_pos < start or ref_pos > end:
-                            continue
-                        query_base = read.seq[query_pos]
-                        # query_qual = read.qual[query_pos]
-                        if query_base == 'N':
-                            continue
-                        base_obs[(read.reference_name, ref_pos)][query_base] += 1
-
-                        if return_refbases:
-                            ref_bases[(read.reference_name, ref_pos)
-                            ] = ref_base.upper()
-
-        if used == 0 and ignored > 0:
-            raise ValueError(f'Could not extract any safe data from molecule {error}')
-
-        self.saved_base_obs = (base_obs, ref_bases)
-
-        if return_refbases:
-            return base_obs, ref_bases
-
-        return base_obs
+        for contig, matrix in matrices.items():
+            known = matrix.reference_bases > 0
+            ref_bases.update(zip(
+                ((contig, position) for position in matrix.positions[known].tolist()),
+                matrix.reference_bases[known].tobytes().decode()))
+        return base_obs, ref_bases
 
     def get_match_mismatch_frequency(self, ignore_locations=None):
         """Get amount of base-calls matching and mismatching the reference sequence,
@@ -2170,19 +2194,18 @@ class Molecule():
         matches = 0
         mismatches = 0
 
-        base_obs, ref_bases = self.get_base_observation_dict(
-            return_refbases=True)
-        for location, obs in base_obs.items():
-            if ignore_locations is not None and location in ignore_locations:
-                continue
-
-            if location in ref_bases:
-                ref = ref_bases[location]
-                if ref not in 'ACTG':  # don't count weird bases in the reference @warn
-                    continue
-                matches += obs[ref]
-                mismatches += sum((base_obs for base,
-                                                base_obs in obs.most_common() if base != ref))
+        matrices = self._get_cached_base_observation_matrix(return_refbases=True)
+        for contig, matrix in matrices.items():
+            # don't count weird bases in the reference @warn
+            reference_index = _OBSERVATION_BASE_INDEX[matrix.reference_bases]
+            use = reference_index < 4
+            if ignore_locations is not None:
+                use &= np.array([(contig, position) not in ignore_locations
+                                 for position in matrix.positions.tolist()], dtype=bool)
+            counts = matrix.counts[use, :4]
+            matched = counts[np.arange(len(counts)), reference_index[use]]
+            matches += int(matched.sum())
+            mismatches += int(counts.sum() - matched.sum())
 
         return matches, mismatches
 
@@ -2244,17 +2267,13 @@ class Molecule():
             return consensus
 
         if base_obs is None:
-            try:
-                base_obs, ref_bases = self.get_base_observation_dict(
-                    return_refbases=True, allow_N=allow_N, allow_unsafe=allow_unsafe)
-            except ValueError as e:
-                # We cannot determine safe regions
-                raise
-
-        for location, obs in base_obs.items():
-            votes = obs.most_common()
-            if len(votes) == 1 or votes[1][1] < votes[0][1]:
-                consensus[location] = votes[0][0]
+            consensus = self._base_observation_matrix_consensus(
+                self._get_cached_base_observation_matrix(allow_unsafe=allow_unsafe))
+        else:
+            for location, obs in base_obs.items():
+                votes = obs.most_common()
+                if len(votes) == 1 or votes[1][1] < votes[0][1]:
+                    consensus[location] = votes[0][0]
 
         if store_consensus:
             self.majority_consensus = consensus
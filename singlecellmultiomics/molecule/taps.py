@@ -59,6 +59,9 @@ class TAPS():
             self.context_mapping[False][''.join(['C'] + list(x))] = 'h'
 
 
+        # Call letters indexed by the context codes of get_methylation_context_codes
+        self.context_code_mapping = {False: '.zxh', True: '.ZXH'}
+
         self.colormap = get_cmap('RdYlBu_r')
         self.colormap.set_bad((0,0,0)) # For reads without C's
 
@@ -117,6 +120,34 @@ class TAPS():
         symbol = self.context_mapping[methylated].get(context, '.')
         return context, symbol
 
+    def position_to_call(
+            self,
+            chromosome,
+            position,
+            observed_base='N',
+            strand=0,
+            reference=None,
+        ):
+        """Extract bismark call letter from a chromosomal location given the observed base, identical to position_to_context(...)[1]
+
+        When the reference provides precomputed methylation contexts (WindowedFastaNoHandle) the context is
+        obtained by an array lookup, otherwise position_to_context is used.
+
+        Returns:
+            bismark_letter(str) : bismark call
+        """
+        get_context_code = getattr(reference, 'get_methylation_context_code', None)
+        code = None if get_context_code is None else get_context_code(chromosome, position, strand)
+        if code is None:
+            return self.position_to_context(chromosome, position, observed_base=observed_base,
+                                            strand=strand, reference=reference)[1]
+        qbase = observed_base.upper()
+        if strand:
+            methylated = (qbase == 'A' and self.taps_strand=='F') or (qbase=='T' and self.taps_strand=='R')
+        else:
+            methylated = (qbase == 'T' and self.taps_strand=='F') or (qbase=='A' and self.taps_strand=='R')
+        return self.context_code_mapping[methylated][code]
+
     def molecule_to_context_call_dict(self, molecule):
         """Extract bismark call_string dictionary from a molecule
 
@@ -275,11 +306,11 @@ class TAPSMolecule(Molecule):
             location:
             {'consensus': consensus[location],
              'reference_base': conversions[location]['ref'],
-             'context': self.taps.position_to_context(
+             'context': self.taps.position_to_call(
                 *location,
                 reference=self.reference,
                 observed_base=observations['obs'],
-                strand=(self.strand if self.taps_strand=='F' else  not self.strand))[1]}
+                strand=(self.strand if self.taps_strand=='F' else  not self.strand))}
             for location, observations in conversions.items()}
 
         # Write bismark tags:
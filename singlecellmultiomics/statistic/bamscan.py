@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pysam
+import pickle
+from multiprocessing import Pool
+from singlecellmultiomics.bamProcessing.bamFunctions import get_contig_sizes, get_contigs_with_reads
+
+
+def get_statistic_regions(bam_path, segment_size=50_000_000):
+    """Divide the bam file in regions which are processed independently
+
+    Args:
+        bam_path (str) : path to indexed bam file
+        segment_size (int) : maximum size of a region in bp
+
+    Returns:
+        regions (list) : [(contig, start, end), ...] in the order of the bam file,
+                         the last region ('*', None, None) contains the unplaced unmapped reads
+    """
+    contigs_with_reads = set(get_contigs_with_reads(bam_path))
+    regions = []
+    for contig, length in get_contig_sizes(bam_path).items():
+        if contig not in contigs_with_reads:
+            continue
+        for start in range(0, length, segment_size):
+            regions.append((contig, start, min(length, start + segment_size)))
+    regions.append(('*', None, None))
+    return regions
+
+
+def _process_bam_region(args):
+    bam_path, contig, start, end, statistics = args
+    statistics = pickle.loads(statistics)
+    with pysam.AlignmentFile(bam_path) as alignments:
+        if contig == '*':
+            reads = alignments.fetch('*')
+        else:
+            reads = alignments.fetch(contig, start, end)
+        for read in reads:
+            # Reads overlapping the start of the region belong to the previous region
+            if contig != '*' and read.reference_start < start:
+                continue
+            for statistic in statistics:
+                statistic.processRead(read)
+    return statistics
+
+
+def process_bam_statistics(bam_path, statistics, n_threads=None, segment_size=50_000_000, head=None, regions=None):
+    """Update all statistics with every read of a bam file, using a single pass over the file
+
+    The bam file is divided in regions, every region is processed by a worker which feeds the reads to an
+    empty copy of the statistics, obtained using empty_copy. The partial statistics of the regions are merged
+    in the order of the bam file into the supplied statistics using merge.
+    When the bam file is not indexed or head is supplied, the reads are processed in a single process.
+
+    Args:
+        bam_path (str) : path to bam file
+        statistics (list) : statistics to update, every statistic needs to implement processRead, merge
+                            and empty_copy
+        n_threads (int) : amount of worker processes, uses all available CPUs when not set
+        segment_size (int) : maximum size of a region in bp
+        head (int) : only process the first head reads of the bam file
+        regions (list) : [(contig, start, end), ...] regions to process, when not supplied the regions are obtained
+                         using get_statistic_regions, covering the complete file
+    """
+    with pysam.AlignmentFile(bam_path) as alignments:
+        if head is not None or not alignments.has_index():
+            for i, read in enumerate(alignments):
+                if head is not None and i >= head:
+                    break
+                for statistic in statistics:
+                    statistic.processRead(read)
+            return
+
+    # Every region starts from empty statistics, observations already present in the
+    # supplied statistics are kept once
+    initial_statistics = pickle.dumps([statistic.empty_copy() for statistic in statistics])
+    if regions is None:
+        regions = get_statistic_regions(bam_path, segment_size=segment_size)
+    tasks = ((bam_path, contig, start, end, initial_statistics) for contig, start, end in regions)
+    with Pool(n_threads) as workers:
+        for region_statistics in workers.imap(_process_bam_region, tasks):
+            for statistic, region_statistic in zip(statistics, region_statistics):
+                statistic.merge(region_statistic)
@@ -37,6 +37,10 @@ class CellReadCount(StatisticHistogram):
             return
         self.molecule_counts[cell] +=1
 
+    def merge(self, other):
+        self.read_counts.update(other.read_counts)
+        self.molecule_counts.update(other.molecule_counts)
+
     def to_csv(self, path):
         pd.DataFrame({'reads':self.read_counts, 'umis':self.molecule_counts}).to_csv(path)
 
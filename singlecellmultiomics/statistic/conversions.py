@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 import seaborn as sns
 import matplotlib.pyplot as plt
-from .statistic import StatisticHistogram
+from .statistic import StatisticHistogram, merge_counter_dict
 import singlecellmultiomics.pyutils as pyutils
 import collections
 import pandas as pd
@@ -48,6 +48,21 @@ class ConversionMatrix(StatisticHistogram):
                             read.get_tag('RS'))
                         self.stranded_base_conversions[reference_base][k] += 1
 
+    def empty_copy(self):
+        return ConversionMatrix(self.args, process_reads=self.process_reads)
+
+    def merge(self, other):
+        # Only the first process_reads reads are used, the observations of other are skipped when
+        # enough reads have been processed already. The observations of other are added completely,
+        # the observations can thus be based on up to process_reads + other.processed_reads - 1 reads,
+        # the processed read count is capped at process_reads.
+        if self.processed_reads >= self.process_reads:
+            return
+        self.processed_reads = min(self.process_reads, self.processed_reads + other.processed_reads)
+        merge_counter_dict(self.conversion_obs, other.conversion_obs)
+        merge_counter_dict(self.base_obs, other.base_obs)
+        merge_counter_dict(self.stranded_base_conversions, other.stranded_base_conversions)
+
     def __repr__(self):
         return f'Observed base conversions'
 
@@ -57,6 +57,11 @@ class FragmentSizeHistogram(StatisticHistogram):
         else:
             self.histogramReject[fragmentSize] += 1
 
+    def merge(self, other):
+        self.histogram.update(other.histogram)
+        self.histogramReject.update(other.histogramReject)
+        self.histogramAccept.update(other.histogramAccept)
+
     def __repr__(self):
         return f'The average fragment size is {pyutils.meanOfCounter(self.histogram)}, SD:{pyutils.varianceOfCounter(self.histogram)}'
 
@@ -25,6 +25,9 @@ class MethylationContextHistogram(StatisticHistogram):
             self.context_obs[tag] += tags.get(f's{tag}', 0)
             self.context_obs[tag.upper()] += tags.get(f's{tag.upper()}', 0)
 
+    def merge(self, other):
+        self.context_obs.update(other.context_obs)
+
     def __repr__(self):
         return f'Methylation status.'
 
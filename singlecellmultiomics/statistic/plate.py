@@ -4,7 +4,7 @@ import string
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from .statistic import StatisticHistogram
+from .statistic import StatisticHistogram, merge_counter_dict
 import singlecellmultiomics.pyutils as pyutils
 import collections
 
@@ -151,6 +151,15 @@ class PlateStatistic(object):
             else:
                 self.skipReasons['No DS'] += 1
 
+    def empty_copy(self):
+        return PlateStatistic(self.args)
+
+    def merge(self, other):
+        merge_counter_dict(self.rawFragmentCount, other.rawFragmentCount)
+        merge_counter_dict(self.usableCount, other.usableCount)
+        merge_counter_dict(self.moleculeCount, other.moleculeCount)
+        self.skipReasons.update(other.skipReasons)
+
     def __repr__(self):
         return 'Plate statistic'
 
@@ -20,6 +20,8 @@ class ReadCount(Statistic):
         self.unmappedReads = collections.Counter()
         self.totalDedupReads = collections.Counter()
         self.totalAssignedSiteReads = collections.Counter({'R1': 0, 'R2': 0})
+        # Mapped reads with RC:i:1 (first read of a molecule for featureCounts layouts)
+        self.totalRCDedupReads = collections.Counter()
         self.rejectionReasons = collections.Counter()
         self.demuxReadCount = 0
         self.rawReadCount = 0
@@ -77,6 +79,12 @@ class ReadCount(Statistic):
                 self.totalMappedReads['R2'] += 1
             else:
                 self.totalMappedReads['R?'] += 1
+
+            if read.has_tag('RC') and read.get_tag('RC') == 1:
+                if read.is_read1:
+                    self.totalRCDedupReads['R1'] += 1
+                elif read.is_read2:
+                    self.totalRCDedupReads['R2'] += 1
         else:
             if read.is_read1:
                 self.unmappedReads['R1'] += 1
@@ -118,6 +126,14 @@ class ReadCount(Statistic):
                     else:
                         self.totalDedupReads['R?'] += 1
 
+    def merge(self, other):
+        self.totalMappedReads.update(other.totalMappedReads)
+        self.unmappedReads.update(other.unmappedReads)
+        self.totalDedupReads.update(other.totalDedupReads)
+        self.totalAssignedSiteReads.update(other.totalAssignedSiteReads)
+        self.totalRCDedupReads.update(other.totalRCDedupReads)
+        self.rejectionReasons.update(other.rejectionReasons)
+
     def setRawReadCount(self, readCount, paired=True):
         self.rawReadCount = readCount * (2 if paired else 1)
 
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 from matplotlib.ticker import MaxNLocator
 import matplotlib.pyplot as plt
-from .statistic import StatisticHistogram
+from .statistic import StatisticHistogram, merge_counter_dict
 import singlecellmultiomics.pyutils as pyutils
 import collections
 import pandas as pd
@@ -14,6 +14,7 @@ matplotlib.use('Agg')
 
 class ScCHICLigation():
     def __init__(self, args):
+        self.args = args
         # cell -> { A_start: count, total_cuts: count }
         self.per_cell_a_obs = collections.defaultdict(collections.Counter)
         # cell -> { TA_start: count, total_cuts: count }
@@ -30,6 +31,13 @@ class ScCHICLigation():
             self.per_cell_ta_obs[sample]['total'] += 1
             self.per_cell_a_obs[sample]['total'] += 1
 
+    def empty_copy(self):
+        return ScCHICLigation(self.args)
+
+    def merge(self, other):
+        merge_counter_dict(self.per_cell_a_obs, other.per_cell_a_obs)
+        merge_counter_dict(self.per_cell_ta_obs, other.per_cell_ta_obs)
+
     def __repr__(self):
         return 'ScCHICLigation: no description'
 
@@ -35,15 +35,49 @@ class Statistic(object):
         """
         pass
 
+    def merge(self, other):
+        """
+        Add the observations of OTHER to this statistic,
+        used to combine the statistics obtained from different regions of a BAM file
+
+        Parameters
+        ----------
+        other : Statistic of the same class
+
+        Returns
+        ----------
+        None
+        """
+        raise NotImplementedError(f'{self.__class__.__name__} cannot be merged')
+
+    def empty_copy(self):
+        """
+        Create a statistic with the same settings as this statistic, without any observations
+
+        Returns
+        ----------
+        Statistic of the same class
+        """
+        return self.__class__(self.args)
+
     def __repr__(self):
         return 'dummy'
 
 
+def merge_counter_dict(target, source):
+    """Add the counters of the dictionary source to the counters of the dictionary target"""
+    for key, counter in source.items():
+        target[key].update(counter)
+
+
 class StatisticHistogram(Statistic):
     def __init__(self, args):
         Statistic.__init__(self, args)
         self.histogram = collections.Counter()
 
+    def merge(self, other):
+        self.histogram.update(other.histogram)
+
     def __repr__(self):
         return f'Mean {pyutils.meanOfCounter(self.histogram)}, SD:{pyutils.varianceOfCounter(self.histogram)}'
 
@@ -15,6 +15,9 @@ class TrimmingStats(StatisticHistogram):
                 'eB') or read.has_tag('A2') or read.has_tag('EB'):
             self.totalFragmentsTrimmed += 1
 
+    def merge(self, other):
+        self.totalFragmentsTrimmed += other.totalFragmentsTrimmed
+
     def __repr__(self):
         return f'Trimmed fragments: {self.totalFragmentsTrimmed}'
 
@@ -14,16 +14,19 @@ import singlecellmultiomics.alleleTools
 from singlecellmultiomics.universalBamTagger.customreads import CustomAssingmentQueryNameFlagger
 from singlecellmultiomics.universalBamTagger.rca_th import RCA_Tidehunter_Flagger
 import singlecellmultiomics.features
+from singlecellmultiomics.features.gtfStore import get_or_create_gtf_store
 from pysamiterators import MatePairIteratorIncludingNonProper, MatePairIterator
-from singlecellmultiomics.universalBamTagger.tagging import generate_tasks, prefetch, run_tagging_tasks
+from singlecellmultiomics.universalBamTagger.tagging import generate_tasks, prefetch, run_tagging_tasks, split_task
 from singlecellmultiomics.bamProcessing.bamBinCounts import blacklisted_binning_contigs,get_bins_from_bed_iter
-from singlecellmultiomics.utils.binning import bp_chunked
-from singlecellmultiomics.bamProcessing import merge_bams, get_contigs_with_reads
-from singlecellmultiomics.fastaProcessing import CachedFastaNoHandle
-from singlecellmultiomics.utils.prefetch import UnitialisedClass
+from singlecellmultiomics.utils.binning import bp_chunked, read_count_chunked
+from singlecellmultiomics.bamProcessing.moleculeSummary import MoleculeSummaryWriter
+from singlecellmultiomics.bamProcessing import merge_bams, concatenate_sorted_bams, get_contigs_with_reads, get_index_read_density
+from singlecellmultiomics.fastaProcessing import WindowedFastaNoHandle
 from multiprocessing import Pool
 from typing import Generator
+from collections import deque
 import argparse
+import queue
 import uuid
 import os
 import sys
@@ -127,6 +130,24 @@ argparser.add_argument(
     type=float,
     help='Maximum time spent on a single genomic location')
 
+argparser.add_argument(
+    '-reads_per_job',
+    default=None,
+    type=int,
+    help='Size the --multiprocess jobs by the amount of reads (estimated from the bam index) instead of by bp. The largest jobs are processed first, and segments which exceed -max_time_per_segment are split and retried instead of being blacklisted')
+
+argparser.add_argument(
+    '-output_assembly',
+    default='merge',
+    choices=['merge', 'concatenate'],
+    help='How the bam files of the --multiprocess jobs are combined into the output bam file. merge: merge all alignments, concatenate: copy the compressed alignments of every job in genomic order and only merge the alignments at the job boundaries (faster, identical alignments)')
+
+argparser.add_argument(
+    '-molecule_summary',
+    default=None,
+    type=str,
+    help='Write a summary with one row per molecule (contig, DS, strand, sample, UMI, af/TF/TR, allele, methylation totals and rejection reason) to this folder, a summary written before to this folder is replaced. The summary can be read using singlecellmultiomics.bamProcessing.moleculeSummary.MoleculeSummary')
+
 argparser.add_argument(
     '-temp_folder',
     default='./',
@@ -221,6 +242,10 @@ tr.add_argument(
     '-introns',
     type=str,
     help='Intron GTF file, use exonGTFtoIntronGTF.py to create this file')
+tr.add_argument(
+    '-gtf_store',
+    type=str,
+    help='Folder to store binary versions of the GTF files in. The GTF files are converted only once, every job then loads only the features of its region instead of parsing the complete GTF file')
 
 cg = argparser.add_argument_group('molecule consensus specific settings')
 cg.add_argument(
@@ -245,6 +270,15 @@ ma.add_argument(
     action='store_true',
     help='Do not use the alignment during deduplication')
 ma.add_argument('-max_associated_fragments',type=int, default=None, help="Limit the maximum amount of reads associated to a single molecule.")
+ma.add_argument(
+    '-pooling_method',
+    type=int,
+    default=1,
+    help="Molecule buffer used by the molecule iterator. 1: per sample/hash lists, 2: per sample/hash lists with a heap indexed on molecule span, only visits ejectable molecules (faster for deep libraries). Both methods produce identical output")
+ma.add_argument(
+    '--no_umi_index',
+    action='store_true',
+    help='Compare every fragment to all molecules with the same hash instead of looking up candidate molecules in an UMI index. Both methods produce identical output')
 
 
 def tag_multiome_multi_processing(
@@ -266,8 +300,23 @@ def tag_multiome_multi_processing(
         use_pool: bool = True,
         one_contig_per_process: bool =False,
         additional_args: dict = None,
-        n_threads=None
+        n_threads=None,
+        reads_per_job: int = None,
+        min_split_size: int = 1000,
+        output_assembly: str = 'merge',
+        summary_path: str = None
     ):
+    """ Run tagging using multiple processes
+
+    The genome is split in segments of bp_per_segment, these segments are grouped into jobs of bp_per_job.
+    When reads_per_job is supplied the jobs are sized by the amount of reads estimated from the bam index instead,
+    the jobs expected to contain the most reads are processed first and segments on which more than
+    max_time_per_segment seconds are spent are split in two and retried, down to min_split_size bp.
+    Only segments of min_split_size which still exceed the time limit are blacklisted.
+    The bam files of the jobs are combined by merging (output_assembly='merge') or by
+    concatenating the compressed alignments (output_assembly='concatenate').
+    When summary_path is supplied every job writes the summary rows of its molecules to a chunk in that folder.
+    """
 
     assert bp_per_job is not None
     assert fragment_size is not None
@@ -316,8 +365,27 @@ def tag_multiome_multi_processing(
                 contig_whitelist=contig_whitelist
             )
 
-        # Chunk into jobs of roughly equal size: (A single job will process multiple segments)
-        job_gen = bp_chunked(regions, bp_per_job)
+        if reads_per_job is None:
+            # Chunk into jobs of roughly equal size: (A single job will process multiple segments)
+            job_gen = bp_chunked(regions, bp_per_job)
+        else:
+            # Chunk into jobs with roughly the same amount of reads, largest jobs first:
+            job_gen = [job for expected_reads, job in sorted(
+                read_count_chunked(regions,
+                                   read_density=get_index_read_density(input_bam_path),
+                                   reads_per_job=reads_per_job,
+                                   fragment_size=fragment_size,
+                                   min_region_size=min_split_size),
+                key=lambda chunk: -chunk[0])]
+
+    split_timeouts = reads_per_job is not None and max_time_per_segment is not None
+    if split_timeouts:
+        # Only write the output of a segment when it is finished, a timed out segment is split and retried
+        additional_args = {**(additional_args if additional_args is not None else {}), 'buffer_output': True}
+
+    if summary_path is not None:
+        MoleculeSummaryWriter.create_summary_folder(summary_path)
+        additional_args = {**(additional_args if additional_args is not None else {}), 'summary_path': summary_path}
 
     tasks = generate_tasks(input_bam_path=input_bam_path,
                            job_gen=job_gen,
@@ -355,19 +423,42 @@ def tag_multiome_multi_processing(
 
         if use_pool:
             workers = Pool(n_threads)
-            job_generator = workers.imap_unordered(run_tagging_tasks, tasks)
-
+            results = queue.Queue()
+            def submit(task):
+                workers.apply_async(run_tagging_tasks, (task,), callback=results.put, error_callback=results.put)
+            def get_result():
+                result = results.get()
+                if isinstance(result, Exception):
+                    raise result
+                return result
         else:
-            job_generator = (run_tagging_tasks(task) for task in tasks)
+            pending = deque()
+            submit = pending.append
+            get_result = lambda: run_tagging_tasks(pending.popleft())
+
+        n_submitted = 0
+        for task in tasks:
+            submit(task)
+            n_submitted += 1
 
         total_processed_molecules = 0
-        for bam, meta in job_generator:
+        n_finished = 0
+        while n_finished < n_submitted: # Jobs can be added while processing
+            bam, meta = get_result()
+            n_finished += 1
             if bam is not None:
                 bam_files_generated.append(bam)
             if len(meta):
                 total_processed_molecules+=meta['total_molecules']
                 timeouts = meta.get('timeout_tasks',[])
                 for timeout in timeouts:
+                    parts = split_task(timeout, fragment_size=fragment_size, min_size=min_split_size) if split_timeouts else None
+                    if parts is not None:
+                        print('splitting', timeout['contig'], timeout['start'], timeout['end'])
+                        for part in parts:
+                            submit(((input_bam_path, temp_folder, max_time_per_segment), [part]))
+                            n_submitted += 1
+                        continue
                     print('blacklisted', timeout['contig'], timeout['start'], timeout['end'])
                     add_blacklisted_region(input_header,
                         contig=timeout['contig'],
@@ -385,7 +476,10 @@ def tag_multiome_multi_processing(
         pysam.index(temp_header_bam_path)
     # merge the results and clean up:
     print('Merging final bam files')
-    merge_bams(list(tagged_bam_generator), out_bam_path)
+    if output_assembly == 'concatenate':
+        concatenate_sorted_bams(list(tagged_bam_generator), out_bam_path)
+    else:
+        merge_bams(list(tagged_bam_generator), out_bam_path)
     if use_pool:
         workers.close()
 
@@ -408,7 +502,8 @@ def tag_multiome_single_thread(
         consensus_model_args={}, # Clearly the consensus model class and arguments should be part of molecule
         ignore_bam_issues=False,
         head=None,
-        no_source_reads=False
+        no_source_reads=False,
+        summary_path=None
         ):
 
     input_bam = pysam.AlignmentFile(input_bam_path, "rb", ignore_truncation=ignore_bam_issues, threads=4)
@@ -444,7 +539,11 @@ def tag_multiome_single_thread(
 
     print('Params:',molecule_iterator_args)
     read_groups = dict()  # Store unique read groups in this dict
-
+    summary = None
+    if summary_path is not None:
+        MoleculeSummaryWriter.create_summary_folder(summary_path)
+        summary = MoleculeSummaryWriter()
+    summary_rows = []
 
 
     with sorted_bam_file(out_bam_path, header=input_header, read_groups=read_groups) as out:
@@ -484,10 +583,18 @@ def tag_multiome_single_thread(
                 # Write the reads to the output file
                 if not no_source_reads:
                     molecule.write_pysam(out)
+
+                if summary is not None:
+                    summary_rows.append(summary.get_row(molecule))
         except Exception as e:
             write_status(out_bam_path,'FAIL, The file is not complete')
             raise e
 
+        if summary is not None:
+            summary.add_region(molecule_iterator_args.get('contig'), molecule_iterator_args.get('start'),
+                               molecule_iterator_args.get('end'), summary_rows)
+            summary.write(summary_path)
+
         # Reached the end of the generator
         write_status(out_bam_path,'Reached end. All ok!')
 
@@ -613,7 +720,9 @@ def run_multiome_tagging(args):
 
     if args.ref is not None:
         try:
-            reference = UnitialisedClass(CachedFastaNoHandle, args.ref)
+            reference = WindowedFastaNoHandle(args.ref)
+            # Check if the reference can be opened:
+            reference.references
             print(f'Loaded reference from {args.ref}')
         except Exception as e:
             print("Error when loading the reference file, continuing without a reference")
@@ -689,10 +798,17 @@ def run_multiome_tagging(args):
         if args.introns is not None and args.exons is None:
             raise ValueError("Please supply both intron and exon GTF files")
 
+        exons_path, introns_path = args.exons, args.introns
+        if args.gtf_store is not None:
+            print("Converting GTF files", end='\r')
+            exons_path = get_or_create_gtf_store(args.exons, args.gtf_store)
+            if args.introns is not None:
+                introns_path = get_or_create_gtf_store(args.introns, args.gtf_store)
+
         transcriptome_features = singlecellmultiomics.features.FeatureContainer(verbose=args.feature_container_verbose)
         print("Loading exons", end='\r')
         transcriptome_features.preload_GTF(
-            path=args.exons,
+            path=exons_path,
             select_feature_type=['exon'],
             identifierFields=(
                 'exon_id',
@@ -704,7 +820,7 @@ def run_multiome_tagging(args):
         if args.introns is not None:
             print("Loading introns", end='\r')
             transcriptome_features.preload_GTF(
-                path=args.introns,
+                path=introns_path,
                 select_feature_type=['intron'],
                 identifierFields=['transcript_id'],
                 store_all=True,
@@ -720,7 +836,7 @@ def run_multiome_tagging(args):
 
 
     bp_per_job = 10_000_000
-    pooling_method=1
+    pooling_method=args.pooling_method
     bp_per_segment = 999_999_999 #@todo make this None or so
     fragment_size = 500
     one_contig_per_process=False
@@ -989,7 +1105,10 @@ def run_multiome_tagging(args):
         'every_fragment_as_molecule': every_fragment_as_molecule,
         'skip_contigs':skip_contig,
         'progress_callback_function':progress_callback_function,
-        'pooling_method' : pooling_method
+        'pooling_method' : pooling_method,
+        'index_umis' : not args.no_umi_index,
+        # Transcriptome fragments are annotated in batches, this has no effect for other fragment classes
+        'annotation_batch_size' : 1000
     }
 
 
@@ -1137,7 +1256,9 @@ def run_multiome_tagging(args):
                                       head=args.head, no_source_reads=args.no_source_reads,
                                       fragment_size=fragment_size, blacklist_path=args.blacklist,bp_per_job=bp_per_job,
                                       bp_per_segment=bp_per_segment, temp_folder_root=args.temp_folder, max_time_per_segment=max_time_per_segment,
-                                      additional_args=consensus_model_args, n_threads=args.tagthreads, one_contig_per_process=one_contig_per_process
+                                      additional_args=consensus_model_args, n_threads=args.tagthreads, one_contig_per_process=one_contig_per_process,
+                                      reads_per_job=args.reads_per_job, output_assembly=args.output_assembly,
+                                      summary_path=args.molecule_summary
                                       )
     else:
 
@@ -1156,7 +1277,8 @@ def run_multiome_tagging(args):
             consensus_model_args={},
             ignore_bam_issues=False,
             head=args.head,
-            no_source_reads=args.no_source_reads
+            no_source_reads=args.no_source_reads,
+            summary_path=args.molecule_summary
             )
 
 
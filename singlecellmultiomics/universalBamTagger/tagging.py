@@ -4,14 +4,37 @@ from datetime import datetime
 from os import remove
 from pysam import AlignmentFile
 from singlecellmultiomics.bamProcessing import sorted_bam_file
+from singlecellmultiomics.bamProcessing.moleculeSummary import MoleculeSummaryWriter
 from uuid import uuid4
 from copy import copy
 from typing import Generator
+from singlecellmultiomics.utils.binning import split_region
+from singlecellmultiomics.utils.prefetch import Prefetcher
+
+
+class TaskOutputBuffer():
+    """Stores the reads written by a tagging task in memory,
+    the reads are only written to the output when the task finished without a timeout.
+    """
+
+    def __init__(self, output):
+        self.header = output.header
+        self.reads = []
+
+    def write(self, read):
+        self.reads.append(read)
+
+    def flush(self, output):
+        for read in self.reads:
+            output.write(read)
+        self.reads = []
+
 
 def prefetch(contig, start, end, fetch_start,fetch_end,molecule_iterator_args):
     """ Prefetch selected region
     Prefetches
         AlleleResolver
+        WindowedFastaNoHandle
     """
 
     new_kwarg_dict = {}
@@ -23,6 +46,9 @@ def prefetch(contig, start, end, fetch_start,fetch_end,molecule_iterator_args):
                     value = value.prefetch(contig,start,end)
                 if key == 'mappability_reader':
                     value = value.prefetch(contig,start,end)
+                if key == 'reference' and isinstance(value, Prefetcher):
+                    # Load the reference sequence of all reads which are fetched
+                    value = value.prefetch(contig,fetch_start,fetch_end)
                 new_args[key] = value
             new_kwarg_dict[iterator_arg] = new_args
         else:
@@ -32,7 +58,8 @@ def prefetch(contig, start, end, fetch_start,fetch_end,molecule_iterator_args):
 def run_tagging_task(alignments, output,
                     contig=None, start=None, end=None, fetch_start=None, fetch_end=None,
                     molecule_iterator_class=None,  molecule_iterator_args={},
-                    read_groups=None, timeout_time=None, enable_prefetch=True, consensus_mode=None, no_source_reads=False):
+                    read_groups=None, timeout_time=None, enable_prefetch=True, consensus_mode=None, no_source_reads=False,
+                    buffer_output=False, summary=None):
     """ Run tagging task for the supplied region
 
     Args:
@@ -48,6 +75,12 @@ def run_tagging_task(alignments, output,
         molecule_iterator_class (class) : Class of the molecule iterator (not initialised, will be constructed using **molecule_iterator_args )
         molecule_iterator_args  (dict) : Arguments for the molecule iterator
 
+        buffer_output (bool) : Only write the reads to the output when the task is finished, when a TimeoutError
+                               is raised nothing is written to output. This allows the task to be split and retried.
+
+        summary (MoleculeSummaryWriter) : when supplied a summary row is collected for every molecule written,
+                               the rows are only added to the summary when the task is finished without a timeout.
+
     Returns:
         statistics : {'molecules_written':molecules_written}
 
@@ -95,6 +128,11 @@ def run_tagging_task(alignments, output,
             raise TimeoutError()
 
 
+    if buffer_output:
+        final_output = output
+        output = TaskOutputBuffer(final_output)
+
+    summary_rows = []
     total_molecules_written = 0
     for i, molecule in enumerate(
             molecule_iterator_class(alignments,  # Input alignments
@@ -143,18 +181,31 @@ def run_tagging_task(alignments, output,
         else:
             raise ValueError(f'Unknown consensus method {consensus_mode}')
 
+        if summary is not None:
+            summary_rows.append(summary.get_row(molecule))
+
         total_molecules_written+=1
 
+    if summary is not None:
+        summary.add_region(contig, start, end, summary_rows)
+
+    if buffer_output:
+        output.flush(final_output)
+
     return {'total_molecules_written': total_molecules_written,
             'time_start': time_start}
 
 
 
-def run_tagging_tasks(args: tuple):
+def run_tagging_tasks(args: tuple, reorder_window: int = 100_000):
     """ Run tagging for one or more tasks
 
     Args:
         args (tuple): (alignments_path, temp_dir, timeout_time), arglist
+            when a task contains 'summary_path' a molecule summary chunk is written to that folder,
+            see singlecellmultiomics.bamProcessing.moleculeSummary
+
+        reorder_window (int): amount of bp the written reads are allowed to be out of order before a sort is required
 
     """
 
@@ -165,13 +216,22 @@ def run_tagging_tasks(args: tuple):
     timeout_tasks = []
     total_molecules = 0
     read_groups = dict()
+    summary = MoleculeSummaryWriter()
+    summary_path = None
 
     with AlignmentFile(alignments_path) as alignments:
+        # Molecules are emitted almost in coordinate order, the reads are sorted while writing,
+        # the output is only sorted afterwards when a read is written more than reorder_window bp out of order
         with sorted_bam_file(target_file, origin_bam=alignments, mode='wb', fast_compression=False,
-                             read_groups=read_groups) as output:
+                             read_groups=read_groups, reorder_window=reorder_window) as output:
             for task in arglist:
+                task_args = {k: v for k, v in task.items() if k != 'summary_path'}
+                if task.get('summary_path') is not None:
+                    summary_path = task['summary_path']
                 try:
-                    statistics = run_tagging_task(alignments, output, read_groups=read_groups, timeout_time=timeout_time, **task)
+                    statistics = run_tagging_task(alignments, output, read_groups=read_groups, timeout_time=timeout_time,
+                                                  summary=summary if task.get('summary_path') is not None else None,
+                                                  **task_args)
                     total_molecules += statistics.get('total_molecules_written', 0)
                 except TimeoutError:
                     timeout_tasks.append( task )
@@ -181,6 +241,8 @@ def run_tagging_tasks(args: tuple):
         'timeout_tasks' : timeout_tasks,
         'total_molecules' : total_molecules,
     }
+    if summary_path is not None:
+        summary.write(summary_path)
 
     if total_molecules>0:
         return target_file, meta
@@ -197,6 +259,28 @@ def run_tagging_tasks(args: tuple):
     return None, meta
 
 
+def split_task(task: dict, fragment_size: int, min_size: int = 1000):
+    """ Split a tagging task in two halves
+
+    Args:
+        task (dict) : task to split, as generated by generate_tasks
+        fragment_size (int) : padding of the fetch coordinates at the split point
+        min_size (int) : do not split tasks of this size or smaller
+
+    Returns:
+        tasks (list) : two new tasks, or None when the task cannot be split
+    """
+    if any(task.get(k) is None for k in ('contig', 'start', 'end', 'fetch_start', 'fetch_end')):
+        return None
+    if task['end'] - task['start'] <= min_size:
+        return None
+
+    region = (task['contig'], task['start'], task['end'], task['fetch_start'], task['fetch_end'])
+    parts = split_region(region, [(task['start'] + task['end']) // 2], fragment_size)
+    return [{**task, 'start': start, 'end': end, 'fetch_start': fetch_start, 'fetch_end': fetch_end}
+            for contig, start, end, fetch_start, fetch_end in parts]
+
+
 def generate_tasks(input_bam_path: str, temp_folder: str, job_gen: Generator, iteration_args: dict,
                    additional_args: dict,
                    max_time_per_segment: int = None) -> Generator:
@@ -10,7 +10,8 @@ from singlecellmultiomics.utils import prob_to_phred
 from pysamiterators import CachedFasta
 from array import array
 from uuid import uuid4
-from singlecellmultiomics.bamProcessing import merge_bams, get_contigs_with_reads, has_variant_reads
+from singlecellmultiomics.bamProcessing import merge_bams, get_contigs_with_reads, has_variant_reads, \
+    get_aligned_pairs_array, get_aligned_reference_bases
 import argparse
 import pickle
 import gzip
@@ -44,6 +45,197 @@ def get_covariate_key(read, qpos, refpos, reference, refbase, cycle_bin_size=3,
     return qual, read.is_read2, int(round(cycle / cycle_bin_size)) * cycle_bin_size, context
 
 
+# Base -> code, complementary bases sum to 3. Other bases (N, IUPAC codes) are 4
+_COVARIATE_BASE_CODES = np.full(256, 4, dtype=np.int64)
+for _code, _base in enumerate('ACGT'):
+    _COVARIATE_BASE_CODES[ord(_base)] = _code
+
+
+def encode_reference(sequence: str):
+    """Convert a reference sequence to an array of base codes, which can be supplied to CovariateTable.encode"""
+    return _COVARIATE_BASE_CODES[np.frombuffer(sequence.upper().encode(), dtype=np.uint8)]
+
+
+class CovariateTable():
+    """Dense table of (mismatch, match) counts for every base call covariate
+
+    The covariates are identical to the keys generated by get_covariate_key: (base quality, is read 2,
+    binned cycle, k-mer context). Every covariate is packed into a single integer code, which is calculated
+    for all aligned bases of a read at once. The codes are buffered and counted using np.bincount,
+    tables of different jobs are merged by adding the count arrays.
+
+    Contexts which contain a base other than ACGT, or do not fit on the reference, are replaced by the query base
+    (get_covariate_key only does this for contexts containing N). Bases with a quality above max_quality or a cycle
+    above max_cycle have no covariate code.
+
+    Example:
+        >>> table = CovariateTable(cycle_bin_size=3, k_rad=1)
+        >>> codes = table.encode(read, query_positions, reference_positions, encode_reference(window), window_start)
+        >>> table.add(codes, matched)
+        >>> table.to_dict() # identical to the dictionary generated by extract_covariates
+    """
+
+    def __init__(self, cycle_bin_size=3, k_rad=1, max_quality=63, max_cycle=512, buffer_size=1_000_000):
+        self.cycle_bin_size = cycle_bin_size
+        self.k_rad = k_rad
+        self.max_quality = max_quality
+        self.max_cycle = max_cycle
+        self.buffer_size = buffer_size
+
+        self.context_size = 2 * k_rad + 1
+        # Every k-mer, followed by the four single base contexts
+        self.n_contexts = 4 ** self.context_size + 4
+        self.n_cycle_bins = int(round(max_cycle / cycle_bin_size)) + 1
+        self.n_codes = (max_quality + 1) * 2 * self.n_cycle_bins * self.n_contexts
+        self.counts = np.zeros((self.n_codes, 2), dtype=np.int64)  # mismatches, matches
+        self.buffer = array('q')
+
+    def encode(self, read, query_positions, reference_positions, reference_codes, reference_start):
+        """Obtain the covariate codes of aligned bases of a read
+
+        Args:
+            read (pysam.AlignedSegment) : read to encode
+            query_positions (np.array) : query positions of the bases to encode, see get_aligned_pairs_array
+            reference_positions (np.array) : reference positions of the bases to encode
+            reference_codes (np.array) : reference window, encoded using encode_reference
+            reference_start (int) : reference position of the first base of the window
+
+        Returns:
+            codes (np.array) : covariate code for every base, -1 when the base has no covariate
+        """
+        k_rad = self.k_rad
+        sequence = np.frombuffer(read.query_sequence.encode(), dtype=np.uint8)
+        query_bases = _COVARIATE_BASE_CODES[sequence[query_positions]]
+        qualities = np.frombuffer(read.query_qualities, dtype=np.uint8)[query_positions].astype(np.int64)
+
+        if read.is_reverse:
+            cycles = len(sequence) - query_positions
+        else:
+            cycles = query_positions + 1
+        # np.rint rounds half to even, like round()
+        cycle_bins = np.rint(cycles / self.cycle_bin_size).astype(np.int64)
+
+        # Obtain the context of every base, the middle base is the query base
+        window = (reference_positions - reference_start)[:, None] + np.arange(-k_rad, k_rad + 1)
+        in_window = ((window >= 0) & (window < len(reference_codes))).all(axis=1)
+        context = reference_codes[np.clip(window, 0, max(0, len(reference_codes) - 1))] if len(reference_codes) \
+            else np.full(window.shape, 4, dtype=np.int64)
+        context[:, k_rad] = query_bases
+        full_context = in_window & (context < 4).all(axis=1)
+        if read.is_reverse:
+            context = 3 - context[:, ::-1]
+            single_base = 3 - query_bases
+        else:
+            single_base = query_bases
+        context_codes = np.where(
+            full_context,
+            context @ (4 ** np.arange(self.context_size - 1, -1, -1, dtype=np.int64)),
+            4 ** self.context_size + single_base)
+
+        codes = ((qualities * 2 + read.is_read2) * self.n_cycle_bins + cycle_bins) * self.n_contexts + context_codes
+        codes[(query_bases == 4) | (qualities > self.max_quality) | (cycle_bins >= self.n_cycle_bins)] = -1
+        return codes
+
+    def encode_key(self, key):
+        """Obtain the code of a key generated by get_covariate_key, returns None when the key cannot be encoded"""
+        if key is None:
+            return None
+        qual, is_read2, cycle, context = key
+        cycle_bin = cycle // self.cycle_bin_size
+        if qual > self.max_quality or cycle_bin >= self.n_cycle_bins:
+            return None
+        context_codes = [_COVARIATE_BASE_CODES[ord(base)] for base in context]
+        if any(code == 4 for code in context_codes):
+            return None
+        if len(context) == self.context_size:
+            context_code = sum(code * 4 ** (self.context_size - 1 - i) for i, code in enumerate(context_codes))
+        elif len(context) == 1:
+            context_code = 4 ** self.context_size + context_codes[0]
+        else:
+            return None
+        return ((qual * 2 + is_read2) * self.n_cycle_bins + cycle_bin) * self.n_contexts + context_code
+
+    def decode(self, code):
+        """Obtain the key (identical to get_covariate_key) of a covariate code"""
+        code, context_code = divmod(int(code), self.n_contexts)
+        code, cycle_bin = divmod(code, self.n_cycle_bins)
+        qual, is_read2 = divmod(code, 2)
+        if context_code >= 4 ** self.context_size:
+            context = 'ACGT'[context_code - 4 ** self.context_size]
+        else:
+            context = ''.join('ACGT'[(context_code >> (2 * (self.context_size - 1 - i))) & 3]
+                              for i in range(self.context_size))
+        return qual, bool(is_read2), cycle_bin * self.cycle_bin_size, context
+
+    def add(self, codes, matched):
+        """Add base calls to the table
+
+        Args:
+            codes (np.array) : covariate codes, bases with code -1 are ignored
+            matched (np.array) : boolean array, True when the base call matches the reference
+        """
+        valid = codes >= 0
+        self.buffer.frombytes((codes[valid] * 2 + matched[valid]).astype(np.int64).tobytes())
+        if len(self.buffer) >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self.buffer) == 0:
+            return
+        self.counts += np.bincount(np.frombuffer(self.buffer, dtype=np.int64),
+                                   minlength=self.n_codes * 2).reshape(-1, 2)
+        self.buffer = array('q')
+
+    def merge(self, other):
+        """Add the counts of other to this table, the tables need to be created using the same arguments"""
+        if other.counts.shape != self.counts.shape:
+            raise ValueError('The covariate tables were created using different arguments')
+        self._flush()
+        other._flush()
+        self.counts += other.counts
+
+    def to_dict(self):
+        """Obtain the counts as dictionary ( covariate_key: [mismatches, matches], .. )"""
+        self._flush()
+        return {self.decode(code): array('l', self.counts[code].tolist())
+                for code in np.flatnonzero(self.counts.any(axis=1)).tolist()}
+
+    def get_phred_lookup(self, covariate_phreds):
+        """Obtain an array with the phred score of every covariate code
+
+        Args:
+            covariate_phreds (dict) : phred score for every covariate key, generated by covariate_obs_to_phreds.
+                The value of key None is used for covariates which are not present
+
+        Returns:
+            lookup (np.array) : phred score (uint8) for every code, the last element contains the value
+                of key None, this element is used for code -1
+        """
+        lookup = np.full(self.n_codes + 1, covariate_phreds[None], dtype=np.uint8)
+        for key, phred in covariate_phreds.items():
+            code = self.encode_key(key)
+            if code is not None:
+                lookup[code] = phred
+        return lookup
+
+    def __getstate__(self):
+        # Only the non-zero counts are stored, this keeps the transfer between processes cheap
+        self._flush()
+        state = self.__dict__.copy()
+        state['counts'] = np.flatnonzero(self.counts)
+        state['count_values'] = self.counts.ravel()[state['counts']]
+        state['buffer'] = None
+        return state
+
+    def __setstate__(self, state):
+        indices = state.pop('counts')
+        values = state.pop('count_values')
+        self.__dict__.update(state)
+        self.counts = np.zeros((self.n_codes, 2), dtype=np.int64)
+        self.counts.ravel()[indices] = values
+        self.buffer = array('q')
+
+
 def add_keys_excluding_context_covar(covariates, covar_phreds, k_rad=1):
     k_rad = 1
     for base in 'ACTG':
@@ -74,26 +266,26 @@ def covariate_obs_to_phreds(covariates, k_rad):
 
     return covar_phreds
 
-def extract_covariates(bam_path: str,
-                       reference_path: str,
-                       contig: str,
-                       start: int,
-                       end: int,
-                       start_fetch: int,
-                       end_fetch: int,
-                       filter_kwargs: dict,
-                       covariate_kwargs: dict):
+def extract_covariate_table(bam_path: str,
+                            reference_path: str,
+                            contig: str,
+                            start: int,
+                            end: int,
+                            start_fetch: int,
+                            end_fetch: int,
+                            filter_kwargs: dict,
+                            covariate_kwargs: dict):
     """
     Count mismatches and matches for similar base-calls
 
     Returns:
-        match_mismatch(dict) : dictionary ( covariate_key: [mismatches, matches], .. )
+        table(CovariateTable) : table containing the mismatches and matches for every covariate
     """
     # known is a set() containing locations of known variation (snps)
     # @todo: extend to indels
     global known  # <- Locations, set of (contig, position) tuples to ignore
 
-    joined = dict()
+    table = CovariateTable(**covariate_kwargs)
 
     # Filters which select which reads are used to estimate covariates:
     min_mapping_quality = filter_kwargs.get('min_mapping_quality', 0)
@@ -109,45 +301,60 @@ def extract_covariates(bam_path: str,
             with pysam.VariantFile(path) as bf:
                 for record in bf.fetch(contig, start_fetch, end_fetch):
                     blacklist.add(record.pos)
-
+    blacklist = np.array(sorted(blacklist), dtype=np.int64)
 
     with AlignmentFile(bam_path) as alignments,  FastaFile(reference_path) as fa:
-        reference = CachedFasta(fa)  # @todo: prefetch selected region
+        # Only bases between start and end are counted, the reference is fetched once for this region
+        window_start = max(0, start - table.k_rad)
+        window = encode_reference(fa.fetch(contig, window_start, end + table.k_rad + 1))
+
         for read in alignments.fetch(contig, start_fetch, end_fetch):
             if (deduplicate and read.is_duplicate) or \
                     (read.is_qcfail and filter_qcfailed) or \
                     (read.mapping_quality < min_mapping_quality):
                 continue
 
-            for qpos, refpos, refbase in read.get_aligned_pairs(matches_only=True, with_seq=True):
+            query_positions, reference_positions = get_aligned_pairs_array(read)
+            reference_bases = get_aligned_reference_bases(read, query_positions)
 
-                if refpos > end or refpos < start:  # Prevent the same location to be counted multiple times
-                    continue
+            # Prevent the same location to be counted multiple times
+            selected = (reference_positions <= end) & (reference_positions >= start) & (reference_bases != ord('N'))
+            if len(blacklist):
+                selected &= ~np.isin(reference_positions, blacklist)
+            if len(known):
+                selected &= np.fromiter(((read.reference_name, refpos) not in known
+                                         for refpos in reference_positions.tolist()),
+                                        dtype=bool, count=len(reference_positions))
 
-                if refpos in blacklist:
-                    continue
+            query_positions = query_positions[selected]
+            codes = table.encode(read, query_positions, reference_positions[selected], window, window_start)
+            matched = reference_bases[selected] == np.frombuffer(read.query_sequence.encode(), dtype=np.uint8)[query_positions]
+            table.add(codes, matched)
+    return table
 
-                refbase = refbase.upper()
-                if refbase == 'N' or (read.reference_name, refpos) in known:
-                    continue
 
-                key = get_covariate_key(read, qpos, refpos, reference, refbase, **covariate_kwargs)
-                if key is None:
-                    continue
+def extract_covariates(bam_path: str,
+                       reference_path: str,
+                       contig: str,
+                       start: int,
+                       end: int,
+                       start_fetch: int,
+                       end_fetch: int,
+                       filter_kwargs: dict,
+                       covariate_kwargs: dict):
+    """
+    Count mismatches and matches for similar base-calls
 
-                matched = (refbase == read.query_sequence[qpos])
-                try:
-                    joined[key][matched] += 1
-                except KeyError:
-                    if matched:
-                        joined[key] = array('l', [0, 1])
-                    else:
-                        joined[key] = array('l', [1, 0])
-    return joined
+    Returns:
+        match_mismatch(dict) : dictionary ( covariate_key: [mismatches, matches], .. )
+    """
+    return extract_covariate_table(bam_path, reference_path, contig, start, end, start_fetch, end_fetch,
+                                   filter_kwargs, covariate_kwargs).to_dict()
 
 
 def extract_covariates_wrapper(kwargs):
-    return extract_covariates(**kwargs)
+    # The tables of the jobs are merged by extract_covariates_from_bam, the table is returned instead of the dictionary
+    return extract_covariate_table(**kwargs)
 
 
 def extract_covariates_from_bam(bam_path, reference_path, known_variants, n_processes=None, bin_size=10_000_000,
@@ -160,7 +367,7 @@ def extract_covariates_from_bam(bam_path, reference_path, known_variants, n_proc
     global known
     known = known_variants
 
-    joined = dict()
+    joined = None
 
     job_generation_args = {
         'contig_length_resource': bam_path,
@@ -200,15 +407,11 @@ def extract_covariates_from_bam(bam_path, reference_path, known_variants, n_proc
                                              blacklisted_binning_contigs(**job_generation_args)))):
             print(round(100 * (i / jobs_total), 1), end='\r')
 
-            for key, tf in r.items():
-                try:
-                    joined[key][0] += tf[0]
-                    joined[key][1] += tf[1]
-                except KeyError:
-                    joined[key] = array('l', [0, 0])
-                    joined[key][0] += tf[0]
-                    joined[key][1] += tf[1]
-    return joined
+            if joined is None:
+                joined = r
+            else:
+                joined.merge(r)
+    return dict() if joined is None else joined.to_dict()
 
 
 def recalibrate_base_calls(read, reference, joined_prob, covariate_kwargs):
@@ -230,11 +433,34 @@ def recalibrate_base_calls(read, reference, joined_prob, covariate_kwargs):
     read.query_qualities = new_qualities
 
 
+def recalibrate_base_calls_vectorised(read, reference, phred_lookup, table):
+    """Replace the base qualities of the aligned bases of read by the recalibrated qualities
+
+    Identical to recalibrate_base_calls, but the covariates of all bases are obtained at once
+
+    Args:
+        read (pysam.AlignedSegment) : read to recalibrate
+        reference : reference handle which supports .fetch()
+        phred_lookup (np.array) : phred score for every covariate code, see CovariateTable.get_phred_lookup
+        table (CovariateTable) : table used to encode the covariates
+    """
+    new_qualities = np.zeros(len(read.query_qualities), dtype=np.uint8)
+    query_positions, reference_positions = get_aligned_pairs_array(read)
+    if len(query_positions):
+        window_start = max(0, read.reference_start - table.k_rad)
+        window = encode_reference(reference.fetch(read.reference_name, window_start, read.reference_end + table.k_rad))
+        new_qualities[query_positions] = phred_lookup[
+            table.encode(read, query_positions, reference_positions, window, window_start)]
+    read.query_qualities = array('B', new_qualities.tobytes())
+
+
 def _recalibrate_reads(bam_path, reference_path, contig, start, end, covariate_kwargs, **kwargs):
     # Recalibrate the reads in bam_path
 
     global joined_prob  # Global to share over multiprocessing
     # joined_prob contains  P(error| d), where d is a descriptor generated by get_covariate_key
+    # it is stored as a lookup array of the covariate codes generated by CovariateTable
+    table = CovariateTable(**covariate_kwargs)
 
     o_path = f'out_{uuid4()}.bam'
 
@@ -246,7 +472,7 @@ def _recalibrate_reads(bam_path, reference_path, contig, start, end, covariate_k
         with AlignmentFile(o_path, header=alignments.header, mode='wb') as out:
             # Iterate all reads in the source bam file:
             for read in alignments.fetch(contig, start, end):
-                recalibrate_base_calls(read, reference, joined_prob, covariate_kwargs)
+                recalibrate_base_calls_vectorised(read, reference, joined_prob, table)
                 out.write(read)
 
     pysam.index(o_path)
@@ -264,7 +490,7 @@ def recalibrate_reads(bam_path, target_bam_path, reference_path, n_processes, co
         'fragment_size': 0
     }
     global joined_prob
-    joined_prob = covariates
+    joined_prob = CovariateTable(**covariate_kwargs).get_phred_lookup(covariates)
 
     print(len(covariates), 'discrete elements')
     with Pool(n_processes) as workers:
@@ -86,3 +86,102 @@ def bp_chunked(job_generator, bp_per_job):
             bp_current=0
             current_tasks=[]
     yield current_tasks
+
+
+def _cumulative_reads(read_density, contig, window_size):
+    """ Obtain the coordinates and cumulative estimated read counts of a contig, used for interpolation """
+    density = read_density.get(contig, np.zeros(1))
+    return (np.arange(len(density) + 1) * window_size,
+            np.concatenate(([0], np.cumsum(density))))
+
+
+def estimate_region_reads(read_density, contig, start, end, window_size=16384):
+    """ Estimate the amount of reads in a region
+
+    Args:
+        read_density(dict) : {contig : estimated reads per window}, see bamProcessing.get_index_read_density
+        contig(str) : contig of the region
+        start(int) : start coordinate of the region
+        end(int) : end coordinate of the region (exclusive)
+        window_size(int) : size of the windows in read_density
+
+    Returns:
+        expected_reads(float)
+    """
+    coordinates, cumulative = _cumulative_reads(read_density, contig, window_size)
+    a, b = np.interp((start, end), coordinates, cumulative)
+    return b - a
+
+
+def split_region(region, split_points, fragment_size=0):
+    """ Split a region (contig, start, end) or (contig, start, end, fetch_start, fetch_end) at the supplied coordinates
+
+    The fetch boundaries of the new parts are placed fragment_size away from the split points,
+    but never exceed the fetch boundaries of the original region.
+
+    Args:
+        region(tuple) : (contig, start, end) or (contig, start, end, fetch_start, fetch_end)
+        split_points(iterable) : coordinates to split at, coordinates outside (start, end) are ignored
+        fragment_size(int) : padding of the fetch boundaries at the split points
+
+    Returns:
+        parts(list) : list of regions in the same format as the supplied region
+    """
+    contig, start, end = region[:3]
+    bounds = [start] + sorted(set(int(p) for p in split_points if start < p < end)) + [end]
+    if len(region) == 3:
+        return [(contig, a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    fetch_start, fetch_end = region[3:5]
+    return [(contig, a, b,
+             fetch_start if a == start else max(fetch_start, a - fragment_size),
+             fetch_end if b == end else min(fetch_end, b + fragment_size))
+            for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def read_count_chunked(job_generator, read_density, reads_per_job, fragment_size=0, window_size=16384, min_region_size=1000):
+    """ Chunk an iterator containing coordinate sorted tasks in chunks containing roughly reads_per_job reads
+
+    Regions which are expected to contain more than reads_per_job reads are split in parts containing
+    roughly the same amount of reads.
+
+    Args:
+        job_generator : iterable of commands, format (contig, start, end) or (contig, start, end, fetch_start, fetch_end)
+        read_density(dict) : {contig : estimated reads per window}, see bamProcessing.get_index_read_density
+        reads_per_job (int) : Amount of expected reads per chunk of jobs/tasks
+        fragment_size(int) : padding of the fetch boundaries of split regions, see split_region
+        window_size(int) : size of the windows in read_density
+        min_region_size(int) : regions are not split into parts smaller than this size
+
+    Yields:
+        expected_reads, chunk(list) :  expected amount of reads, [(contig, start, end, *task),(contig, start, end, *task),..]
+    """
+    reads_current = 0
+    current_tasks = []
+    for job in job_generator:
+        contig, start, end = job[:3]
+        coordinates, cumulative = _cumulative_reads(read_density, contig, window_size)
+        expected_reads = estimate_region_reads(read_density, contig, start, end, window_size)
+
+        n_parts = int(min( np.ceil(expected_reads / reads_per_job), (end - start) // min_region_size ))
+        if n_parts > 1:
+            # Obtain the coordinates at which the cumulative amount of reads reaches a multiple of reads_per_job
+            a = np.interp(start, coordinates, cumulative)
+            targets = a + np.arange(1, n_parts) * (expected_reads / n_parts)
+            right = np.clip(np.searchsorted(cumulative, targets, side='left'), 1, len(cumulative) - 1)
+            fraction = (targets - cumulative[right - 1]) / np.maximum(cumulative[right] - cumulative[right - 1], 1e-9)
+            split_points = coordinates[right - 1] + fraction * (coordinates[right] - coordinates[right - 1])
+            parts = split_region(job, split_points, fragment_size)
+        else:
+            parts = [job]
+
+        for part in parts:
+            part_reads = estimate_region_reads(read_density, contig, part[1], part[2], window_size)
+            if len(current_tasks) and reads_current + part_reads > reads_per_job:
+                yield reads_current, current_tasks
+                reads_current = 0
+                current_tasks = []
+            reads_current += part_reads
+            current_tasks.append(part)
+    if len(current_tasks):
+        yield reads_current, current_tasks
@@ -4,6 +4,7 @@
 import singlecellmultiomics
 from collections import Counter
 from singlecellmultiomics.bamProcessing import sorted_bam_file, has_variant_reads
+from singlecellmultiomics.bamProcessing import bamExtractVariants
 from singlecellmultiomics.molecule import NlaIIIMolecule,MoleculeIterator,train_consensus_model,get_consensus_training_data, Molecule
 from singlecellmultiomics.fragment import NlaIIIFragment, Fragment
 from singlecellmultiomics.variants import VariantWrapper
@@ -109,6 +110,13 @@ def filter_alt_calls(alt_phased, threshold):
 
 
 
+def recall_variants_sweep(args):
+    """Sweep-line version of recall_variants, see bamExtractVariants.recall_variants_sweep"""
+    variant_calls, locations_done, _ = bamExtractVariants.recall_variants_sweep(
+        (*args, None), max_associated_fragments=20, max_ref_molecules=1_000)
+    return variant_calls, locations_done
+
+
 def recall_variants(args):
 
     variants, alignment_file_path, target_path, mode, germline_variants_path, germline_variants_sample, germline_bam_path, window_radius, MAX_REF_MOLECULES,max_buffer_size = args
@@ -279,6 +287,7 @@ if __name__ == '__main__':
 
 
     argparser.add_argument('-jobsize', type=int,default=5,help='Amount of variants being processed per Thread ')
+    argparser.add_argument('--sweep', action='store_true', help='Assemble the molecules of nearby variants only once, use a large -jobsize for the best performance')
 
     args = argparser.parse_args()
 
@@ -297,13 +306,14 @@ if __name__ == '__main__':
             block_size=args.jobsize,
             min_qual=args.minqual
             )
+    recall_function = recall_variants_sweep if args.sweep else recall_variants
     if args.t==1:
 
         def dummy_imap(func, args):
             for arg in args:
                 yield func(arg)
 
-        for i,(vc,done) in enumerate(dummy_imap(recall_variants, jobs )):
+        for i,(vc,done) in enumerate(dummy_imap(recall_function, jobs )):
 
             for cell, calls in vc.items():
                 variant_calls[cell].update(calls)
@@ -313,7 +323,7 @@ if __name__ == '__main__':
 
             print('Collecting variant calls')
             for i,(vc,done) in enumerate(
-                workers.imap_unordered(recall_variants,jobs)):
+                workers.imap_unordered(recall_function,jobs)):
 
                 for cell, calls in vc.items():
                     variant_calls[cell].update(calls)
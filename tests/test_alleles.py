@@ -4,7 +4,7 @@ import unittest
 import itertools
 import pysam
 import os
-from singlecellmultiomics.alleleTools import AlleleResolver
+from singlecellmultiomics.alleleTools import AlleleResolver, AlleleIndex
 import pysam
 
 """
@@ -53,6 +53,62 @@ class TestAlleleResolver(unittest.TestCase):
         except Exception as e:
             raise
 
+    def test_allele_index(self):
+        index = AlleleIndex.from_dict({
+            19: {'A': {'SAMPLE_A'}, 'T': {'SAMPLE_B'}},
+            21: {'G': {'SAMPLE_A'}, 'A': {'SAMPLE_B'}},
+            39: {'C': {'SAMPLE_B'}}
+        })
+        self.assertEqual(index.get_alleles_at(19, 'T'), {'SAMPLE_B'})
+        self.assertIsNone(index.get_alleles_at(19, 'C'))
+        self.assertIsNone(index.get_alleles_at(20, 'A'))
+        self.assertEqual(
+            list(index.get_codes([19, 20, 21, 39], [ord('A'), ord('A'), ord('A'), ord('C')]) > 0),
+            [True, False, True, True])
+
+        # Write, memory map and slice the index
+        index_path = './data/test.alleles'
+        index.write(index_path)
+        loaded = AlleleIndex.load(index_path)
+        self.assertEqual(list(loaded.positions), [19, 21, 39])
+        self.assertEqual(loaded.get_alleles_at(21, 'A'), {'SAMPLE_B'})
+        region = loaded.slice(20, 39)
+        self.assertEqual(list(region.positions), [21, 39])
+        self.assertEqual(region.get_alleles_at(39, 'C'), {'SAMPLE_B'})
+        del loaded
+        os.remove(index_path)
+
+    def test_prefetch(self):
+        test_vcf_path = './data/prefetch.vcf'
+        with open(test_vcf_path,'w') as f:
+            f.write("""##fileformat=VCFv4.0
+##contig=<ID=1,length=42>
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE_A\tSAMPLE_B
+1\t20\t.\tA\tT\t42\tPASS\tDP=4\tGT\t0/0\t1/1
+1\t22\t.\tG\tA\t42\tPASS\tDP=4\tGT\t0/0\t1/1
+1\t40\t.\tA\tC\t42\tPASS\tDP=4\tGT\t./.\t1/1
+""")
+        vcf_path = pysam.tabix_index(test_vcf_path, preset='vcf', force=True)
+
+        for use_cache in (False, True, True):
+            ar = AlleleResolver(vcffile=vcf_path, lazyLoad=True, use_cache=use_cache)
+            prefetched = ar.prefetch('1', 0, 25)
+            # The prefetched resolver only holds the variants in the region:
+            self.assertNotIn(39, prefetched.allele_indices['1'].positions)
+            self.assertEqual(prefetched.getAllelesAt('1', 21, 'A'), set(['SAMPLE_B']))
+            self.assertIsNone(prefetched.getAllelesAt('1', 39, 'C'))
+            # The original resolver was not modified
+            self.assertNotIn('1', ar.allele_indices)
+            self.assertEqual(ar.getAllelesAt('1', 39, 'C'), set(['SAMPLE_B']))
+
+        os.remove(vcf_path)
+        os.remove(vcf_path + '.tbi')
+        for cache_file in os.listdir(f'{vcf_path}_allele_cache'):
+            os.remove(f'{vcf_path}_allele_cache/{cache_file}')
+        os.rmdir(f'{vcf_path}_allele_cache')
+
 
 if __name__ == '__main__':
     unittest.main()
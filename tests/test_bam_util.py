@@ -7,13 +7,142 @@ import pysam
 import pysamiterators.iterators
 from singlecellmultiomics.bamProcessing import sorted_bam_file,write_program_tag,verify_and_fix_bam
 from singlecellmultiomics.bamProcessing.bamExtractSamples import extract_samples
+from singlecellmultiomics.bamProcessing.bamExtractVariants import recall_variants, recall_variants_sweep, \
+    get_variant_clusters, VariantWrapper
 import os
 import sys
+import io
+import contextlib
 from shutil import copyfile,rmtree
-from singlecellmultiomics.bamProcessing import get_contigs_with_reads
+from singlecellmultiomics.bamProcessing import get_contigs_with_reads, get_index_read_density, concatenate_sorted_bams, \
+    get_aligned_pairs_array, get_aligned_reference_bases
+from singlecellmultiomics.utils.binning import read_count_chunked, split_region
+from singlecellmultiomics.statistic import ReadCount, FragmentSizeHistogram, OversequencingHistogram, CellReadCount, \
+    PlateStatistic, ConversionMatrix, process_bam_statistics
+import argparse
 
 class TestFunctions(unittest.TestCase):
 
+    def test_process_bam_statistics(self):
+        args = argparse.Namespace(head=None)
+        def get_statistics():
+            return [ReadCount(args), FragmentSizeHistogram(args), OversequencingHistogram(args),
+                    CellReadCount(args), PlateStatistic(args)]
+
+        serial = get_statistics()
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as alignments:
+            for read in alignments:
+                for statistic in serial:
+                    statistic.processRead(read)
+
+        # Use regions smaller than the fragments to check reads spanning region boundaries are counted once
+        regions = [('chr1', 0, 164_820_000)] + \
+            [('chr1', start, start + 150) for start in range(164_820_000, 164_850_000, 150)] + \
+            [('chr1', 164_850_000, 248_956_422), ('*', None, None)]
+        parallel = get_statistics()
+        process_bam_statistics('./data/mini_nla_test.bam', parallel, n_threads=2, regions=regions)
+        for a, b in zip(serial, parallel):
+            self.assertEqual({k: v for k, v in vars(a).items() if k != 'args'},
+                             {k: v for k, v in vars(b).items() if k != 'args'})
+        self.assertEqual(parallel[0].totalMappedReads['R1'], serial[0].totalMappedReads['R1'])
+        self.assertTrue(parallel[0].totalMappedReads['R1'] > 0)
+
+    def test_process_bam_statistics_keeps_existing_observations(self):
+        args = argparse.Namespace(head=None)
+        regions = [('chr1', start, start + 5000) for start in range(164_820_000, 164_850_000, 5000)] + \
+            [('*', None, None)]
+        serial, parallel = FragmentSizeHistogram(args), FragmentSizeHistogram(args)
+        for statistic in (serial, parallel):
+            statistic.histogram['seed'] = 1
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as alignments:
+            for read in alignments:
+                serial.processRead(read)
+        conversions = ConversionMatrix(args, process_reads=50)
+        process_bam_statistics('./data/mini_nla_test.bam', [parallel, conversions], n_threads=2, regions=regions)
+        self.assertEqual(parallel.histogram['seed'], 1)
+        self.assertEqual(serial.histogram, parallel.histogram)
+        self.assertEqual(conversions.processed_reads, 50)
+
+    def test_read_count_dedup_exact_rc(self):
+        header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 1000}]})
+        rc = ReadCount(argparse.Namespace(head=None))
+        for read_count, flag in [(1, 64), (12, 64), (10, 64), (100, 64), (1, 128), (1, 64 | 256), (1, 64 | 4)]:
+            read = pysam.AlignedSegment(header)
+            read.query_name = f'read_{read_count}_{flag}'
+            read.flag = flag | 1
+            read.reference_id = 0
+            read.reference_start = 100
+            read.query_sequence = 'ACGT'
+            read.cigarstring = '4M'
+            read.set_tag('RC', read_count)
+            rc.processRead(read)
+        # Only mapped primary reads with RC exactly 1 are deduplicated reads, RC:i:12 is not
+        self.assertEqual(rc.totalRCDedupReads['R1'], 1)
+        self.assertEqual(rc.totalRCDedupReads['R2'], 1)
+        self.assertEqual(rc.totalMappedReads['R1'], 4)
+
+    def test_recall_variants_sweep(self):
+        variants = [VariantWrapper(None, pos=pos, contig='chr1', ref=ref, alts=(alt,))
+                    for pos, ref, alt in [(164834900, 'A', 'G'), (164834750, 'C', 'T'), (164835300, 'G', 'A'),
+                                          (164834901, 'T', 'C'), (164837000, 'A', 'C')]]
+        clusters = list(get_variant_clusters(sorted(variants, key=lambda v: v.pos), 600))
+        self.assertEqual([len(cluster) for cluster in clusters], [4, 1])
+
+        args = (variants, './data/mini_nla_test.bam', None, 'NLA', None, None, None, 600, 5000, 100_000, None)
+        self.assertEqual(recall_variants(args), recall_variants_sweep(args))
+
+    def test_recall_variants_sweep_phased(self):
+        # Heterozygous germline variants to phase the molecules with
+        germline_path = './data/write_test_germline.vcf'
+        header = pysam.VariantHeader()
+        header.contigs.add('chr1', length=248956422)
+        header.formats.add('GT', 1, 'String', 'Genotype')
+        header.add_sample('GERM')
+        with pysam.VariantFile(germline_path, 'w', header=header) as out:
+            for pos, ref, alt in [(164834882, 'A', 'C'), (164835127, 'C', 'A'),
+                                  (164835213, 'G', 'T'), (164835232, 'G', 'T')]:
+                record = out.new_record(contig='chr1', start=pos - 1, alleles=(ref, alt))
+                record.samples['GERM']['GT'] = (0, 1)
+                out.write(record)
+        pysam.tabix_index(germline_path, preset='vcf', force=True)
+
+        # A single cluster, the molecules overlap multiple variants of the cluster
+        variants = [VariantWrapper(None, pos=pos, contig='chr1', ref=ref, alts=(alt,))
+                    for pos, ref, alt in [(164835216, 'C', 'A'), (164835223, 'G', 'T'), (164835233, 'A', 'T'),
+                                          (164834894, 'A', 'C'), (164834895, 'C', 'A'), (164834928, 'G', 'T')]]
+        args = (variants, './data/mini_nla_test.bam', None, 'NLA', germline_path + '.gz', 'GERM', None, 600, 5000,
+                100_000, None)
+        expected = recall_variants(args)
+        self.assertEqual(expected, recall_variants_sweep(args))
+
+        variant_calls, locations_done, phased_variants = expected
+        self.assertEqual(len(locations_done), 6)
+        self.assertEqual(len(phased_variants), 6)
+        # Reference calls (0) are made using the phased germline variants:
+        self.assertTrue(any(len(calls) > 1 and 0 in calls.values() for calls in variant_calls.values()))
+        os.remove(germline_path + '.gz')
+        os.remove(germline_path + '.gz.tbi')
+
+    def test_recall_variants_sweep_buffer_exceeded(self):
+        messages = []
+        # Clusters of one variant and of two variants for which the buffer is exceeded,
+        # no reads are mapped around the last variant
+        for positions in ([164834894, 164837000], [164834894, 164835216, 164837000]):
+            variants = [VariantWrapper(None, pos=pos, contig='chr1', ref='A', alts=('C',)) for pos in positions]
+            args = (variants, './data/mini_nla_test.bam', None, 'NLA', None, None, None, 600, 5000, 2, None)
+            for recall in (recall_variants, recall_variants_sweep):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    result = recall(args)
+                self.assertEqual(result[1], {('chr1', 164837000, 'A', 'C')})
+                messages.append([line for line in output.getvalue().splitlines()
+                                 if line.startswith('Buffer exceeded')])
+        # Every variant for which the buffer is exceeded is reported once
+        self.assertEqual(messages[0], ['Buffer exceeded for chr1 164834894'])
+        self.assertEqual(messages[0], messages[1])
+        self.assertEqual(messages[2], ['Buffer exceeded for chr1 164834894', 'Buffer exceeded for chr1 164835216'])
+        self.assertEqual(messages[2], messages[3])
+
     def test_get_contigs_with_reads_1(self):
         cwr = list(get_contigs_with_reads('./data/mini_nla_test.bam'))
         self.assertEqual(len(cwr), 1)
@@ -24,8 +153,106 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(len(cwr), 1)
         self.assertIn('8', cwr)
 
+    def test_get_index_read_density(self):
+        density = get_index_read_density('./data/mini_nla_test.bam')
+        self.assertAlmostEqual(density['chr1'].sum(), 563)
+        self.assertEqual(density['chr2'].sum(), 0)
+        # All reads of the test file are located at chr1:164834728
+        self.assertAlmostEqual(density['chr1'][164834728//16384], 563)
+
+    def test_read_count_chunked(self):
+        density = get_index_read_density('./data/mini_nla_test.bam')
+        chunks = list(read_count_chunked(
+            [('chr1', 0, 248956422, 0, 248956422), ('chr2', 0, 242193529, 0, 242193529)],
+            density, reads_per_job=100, fragment_size=500))
+        # The region containing reads is split in parts of at most 100 reads:
+        self.assertTrue(all(expected_reads <= 100+1e-6 for expected_reads, chunk in chunks))
+        self.assertAlmostEqual(sum(expected_reads for expected_reads, chunk in chunks), 563)
+        # The parts cover the complete contigs without overlap:
+        regions = [region for expected_reads, chunk in chunks for region in chunk]
+        self.assertEqual(regions[0][1], 0)
+        for (contig, start, end, fetch_start, fetch_end), next_region in zip(regions, regions[1:]):
+            if next_region[0] == contig:
+                self.assertEqual(end, next_region[1])
+                self.assertEqual(fetch_end, end+500)
+
+    def test_split_region(self):
+        self.assertEqual(
+            split_region(('chr1', 100, 1000, 50, 1050), [500], fragment_size=200),
+            [('chr1', 100, 500, 50, 700), ('chr1', 500, 1000, 300, 1050)])
+        self.assertEqual(
+            split_region(('chr1', 100, 1000, 50, 1050), [500], fragment_size=1000),
+            [('chr1', 100, 500, 50, 1050), ('chr1', 500, 1000, 50, 1050)])
+
+    def test_get_aligned_pairs_array(self):
+        read = pysam.AlignedSegment()
+        read.reference_start = 100
+        read.query_sequence = 'A' * 22
+        read.cigarstring = '3S5M2I4M10N3=1D2X3S'
+        query_positions, reference_positions = get_aligned_pairs_array(read)
+        self.assertEqual(list(zip(query_positions.tolist(), reference_positions.tolist())),
+                         read.get_aligned_pairs(matches_only=True))
+
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            for read in f:
+                query_positions, reference_positions = get_aligned_pairs_array(read)
+                self.assertEqual(list(zip(query_positions.tolist(), reference_positions.tolist())),
+                                 read.get_aligned_pairs(matches_only=True))
+
+    def test_get_aligned_reference_bases(self):
+        read = pysam.AlignedSegment()
+        read.reference_start = 100
+        read.query_sequence = 'AAATAGGTAC'
+        read.cigarstring = '10M'
+        read.set_tag('MD', '5T4')
+        query_positions, reference_positions = get_aligned_pairs_array(read)
+        self.assertEqual(get_aligned_reference_bases(read).tobytes(), b'AAATATGTAC')
+        # The substitutions of the MD tag are located on the complete alignment, also when a subset is selected
+        selected = reference_positions >= 103
+        self.assertEqual(get_aligned_reference_bases(read, query_positions[selected]).tobytes(), b'TATGTAC')
+
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            for read in f:
+                if read.is_unmapped:
+                    continue
+                query_positions, reference_positions = get_aligned_pairs_array(read)
+                expected = [refbase.upper().encode() for qpos, refpos, refbase in
+                            read.get_aligned_pairs(matches_only=True, with_seq=True)]
+                self.assertEqual(get_aligned_reference_bases(read).tobytes(), b''.join(expected))
+                selected = query_positions % 3 == 0
+                self.assertEqual(get_aligned_reference_bases(read, query_positions[selected]).tobytes(),
+                                 b''.join(e for e, s in zip(expected, selected) if s))
+
 class TestSorted(unittest.TestCase):
 
+    def test_concatenate_sorted_bams(self):
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            header = f.header.to_dict()
+            reads = list(f)
+
+        # Split the reads in three overlapping parts, the reads of the first part extend into the second part
+        parts = [reads[:200] + reads[220:240:2], reads[200:220] + reads[221:240:2] + reads[240:400], reads[400:]]
+        paths = []
+        for i, part in enumerate(parts):
+            paths.append(f'./data/write_test_concat_{i}.bam')
+            with sorted_bam_file(paths[-1], header=header) as out:
+                for read in part:
+                    out.write(read)
+
+        write_path = './data/write_test_concat.bam'
+        concatenate_sorted_bams(paths[::-1], write_path)
+        with pysam.AlignmentFile(write_path) as f:
+            written = list(f)
+        # The output is sorted and contains every read once:
+        self.assertEqual([read.reference_start for read in written], [read.reference_start for read in reads])
+        self.assertEqual(
+            sorted((read.reference_start, read.query_name, read.is_read1) for read in written),
+            sorted((read.reference_start, read.query_name, read.is_read1) for read in reads))
+        self.assertEqual(len(list(pysam.AlignmentFile(write_path).fetch(written[0].reference_name))), len(reads))
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        os.remove(write_path)
+        os.remove(write_path + '.bai')
+
     def test_verify_and_fix_bam_autoindex(self):
         file_path_without_index = './data/temp_without_index.bam'
         copyfile('./data/mini_nla_test.bam',file_path_without_index)
@@ -79,6 +306,28 @@ class TestSorted(unittest.TestCase):
         except Exception as e:
             pass
 
+    def test_write_to_sorted_reorder_window(self):
+        write_path = './data/write_test_reorder.bam'
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            reads = list(f)
+            # Swap every pair of reads, these are written at most 100bp out of order,
+            # when the reads are written in reverse order the file needs to be sorted afterwards:
+            swapped = [read for i in range(0, len(reads) - 1, 2) for read in (reads[i + 1], reads[i])]
+            for write_order, expect_sorted in ((swapped, True), (swapped[::-1], False)):
+                with sorted_bam_file(write_path, origin_bam=f, reorder_window=100,
+                                     read_groups={'A.1.LIB_1': {'ID': 'A.1.LIB_1', 'SM': 'LIB_1'}}) as out:
+                    for read in write_order:
+                        out.write(read)
+                self.assertEqual(out.is_sorted, expect_sorted)
+
+                with pysam.AlignmentFile(write_path) as written:
+                    self.assertEqual(written.header.to_dict()['RG'], [{'ID': 'A.1.LIB_1', 'SM': 'LIB_1'}])
+                    starts = [read.reference_start for read in written]
+                    self.assertEqual(len(starts), len(reads) - len(reads) % 2)
+                    self.assertEqual(starts, sorted(starts))
+                os.remove(write_path)
+                os.remove(write_path+'.bai')
+
     def test_write_to_sorted_custom_compression(self):
         write_path = './data/write_test.bam'
         with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
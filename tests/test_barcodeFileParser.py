@@ -2,6 +2,10 @@
 # -*- coding: utf-8 -*-
 import unittest
 import itertools
+import os
+import shutil
+import pickle
+import pkg_resources
 
 import singlecellmultiomics.barcodeFileParser.barcodeFileParser as barcodeFileParser
 
@@ -102,6 +106,78 @@ class TestBarcodeParser(unittest.TestCase):
         self.assertEqual(barcode,'AAA')
         self.assertEqual(hd,1)
 
+    def test_packed_hamming_expansion_identical(self):
+        dict_parser = barcodeFileParser.BarcodeParser()
+        packed_parser = barcodeFileParser.BarcodeParser(compact=True)
+        for b in (dict_parser, packed_parser):
+            for index, barcode in enumerate(['AAAA', 'AATT', 'TTTT', 'GCGC']):
+                b.addBarcode(barcodeFileAlias='test', barcode=barcode, index=f'TEST{index}')
+            b.expand(2, 'test')
+        self.assertIn('test', packed_parser.packedBarcodes)
+        self.assertEqual(dict_parser.getTargetCount('test'), packed_parser.getTargetCount('test'))
+
+        # Test all barcodes of the same length, including collisions and barcodes which are too far away:
+        for query in itertools.product('ACGTN', repeat=4):
+            query = ''.join(query)
+            self.assertEqual(
+                dict_parser.getIndexCorrectedBarcodeAndHammingDistance(query, 'test'),
+                packed_parser.getIndexCorrectedBarcodeAndHammingDistance(query, 'test'))
+        for query in ['AAA', 'AAAAA', 'AAXA', '']:
+            self.assertEqual(
+                packed_parser.getIndexCorrectedBarcodeAndHammingDistance(query, 'test'), (None, None, None))
+
+    def test_packed_save_load(self):
+        b = barcodeFileParser.BarcodeParser(compact=True)
+        b.addBarcode(barcodeFileAlias='test', barcode='AAA', index=1)
+        b.addBarcode(barcodeFileAlias='test', barcode='TTT', index='TEST2')
+        b.expand(1, 'test')
+        b.save_packed('test', './data/write_test_barcodes.bct')
+
+        loaded = barcodeFileParser.BarcodeParser(compact=True)
+        loaded.load_packed('test', './data/write_test_barcodes.bct')
+        os.remove('./data/write_test_barcodes.bct')
+        self.assertEqual(loaded.getIndexCorrectedBarcodeAndHammingDistance('TTT', 'test'), ('TEST2', 'TTT', 0))
+        self.assertEqual(loaded.getIndexCorrectedBarcodeAndHammingDistance('ANA', 'test'), (1, 'AAA', 1))
+        self.assertEqual(loaded.getIndexCorrectedBarcodeAndHammingDistance('ATT', 'test'), ('TEST2', 'TTT', 1))
+        self.assertEqual(loaded.getIndexCorrectedBarcodeAndHammingDistance('CCC', 'test'), (None, None, None))
+
+    def test_packed_pickle(self):
+        b = barcodeFileParser.BarcodeParser(compact=True)
+        b.addBarcode(barcodeFileAlias='test', barcode='AAA', index=1)
+        b.addBarcode(barcodeFileAlias='test', barcode='TTT', index='TEST2')
+        b.expand(1, 'test')
+        b.save_packed('test', './data/write_test_barcodes_pickle.bct')
+
+        # Both a table built in memory and a memory mapped table should survive a pickle round trip
+        loaded = barcodeFileParser.BarcodeParser(compact=True)
+        loaded.load_packed('test', './data/write_test_barcodes_pickle.bct')
+        for parser in (b, loaded):
+            restored = pickle.loads(pickle.dumps(parser))
+            for query in ['AAA', 'ANA', 'ATT', 'CCC']:
+                self.assertEqual(
+                    restored.getIndexCorrectedBarcodeAndHammingDistance(query, 'test'),
+                    b.getIndexCorrectedBarcodeAndHammingDistance(query, 'test'))
+        os.remove('./data/write_test_barcodes_pickle.bct')
+
+    def test_lazy_cached_expansion(self):
+        barcode_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/barcodes/')
+        cache_dir = './data/write_test_barcode_cache'
+        reference = barcodeFileParser.BarcodeParser(barcode_folder, hammingDistanceExpansion=1)
+
+        for i in range(2): # The first iteration writes the cache, the second reads it
+            b = barcodeFileParser.BarcodeParser(barcode_folder, hammingDistanceExpansion=1, lazy=True, cache_dir=cache_dir)
+            self.assertEqual(len(b.barcodes), 0)
+            for query in ['ACACACTA', 'ACACACTT', 'NCACACTA', 'CCCCCCCC']:
+                self.assertEqual(
+                    b.getIndexCorrectedBarcodeAndHammingDistance(query, 'maya_384NLA'),
+                    reference.getIndexCorrectedBarcodeAndHammingDistance(query, 'maya_384NLA'))
+            # Only the used alias is loaded:
+            self.assertEqual(list(b.packedBarcodes), ['maya_384NLA'])
+            self.assertEqual(b.getTargetCount('maya_384NLA'), reference.getTargetCount('maya_384NLA'))
+
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        shutil.rmtree(cache_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
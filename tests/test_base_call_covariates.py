@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import pickle
+import pysam
+import numpy as np
+from singlecellmultiomics.bamProcessing import get_aligned_pairs_array
+from singlecellmultiomics.utils.base_call_covariates import CovariateTable, encode_reference, get_covariate_key, \
+    covariate_obs_to_phreds, recalibrate_base_calls, recalibrate_base_calls_vectorised
+
+"""
+These tests check if the integer coded covariate table is identical to the per-base covariates
+"""
+
+
+class ReferenceFromMD():
+    """Reference which supports .fetch(), obtained from the MD tags of the reads, unknown bases are N"""
+
+    def __init__(self, reads):
+        self.bases = {}
+        for read in reads:
+            for qpos, refpos, refbase in read.get_aligned_pairs(matches_only=True, with_seq=True):
+                self.bases[(read.reference_name, refpos)] = refbase.upper()
+
+    def fetch(self, contig, start, end):
+        return ''.join(self.bases.get((contig, position), 'N') for position in range(start, end))
+
+
+def get_test_reads():
+    with pysam.AlignmentFile('./data/mini_nla_test.bam') as alignments:
+        return [read for read in alignments if not read.is_unmapped]
+
+
+def add_reads(table, reads, reference):
+    for read in reads:
+        query_positions, reference_positions = get_aligned_pairs_array(read)
+        window_start = max(0, read.reference_start - table.k_rad)
+        window = reference.fetch(read.reference_name, window_start, read.reference_end + table.k_rad)
+        codes = table.encode(read, query_positions, reference_positions, encode_reference(window), window_start)
+        reference_bases = np.array([ord(reference.fetch(read.reference_name, p, p + 1))
+                                    for p in reference_positions.tolist()], dtype=np.uint8)
+        sequence = np.frombuffer(read.query_sequence.encode(), dtype=np.uint8)
+        table.add(codes, reference_bases == sequence[query_positions])
+
+
+class TestCovariateTable(unittest.TestCase):
+
+    def test_encode_identical_to_covariate_key(self):
+        reads = get_test_reads()
+        reference = ReferenceFromMD(reads)
+        for k_rad in (0, 1, 2):
+            table = CovariateTable(cycle_bin_size=3, k_rad=k_rad)
+            for read in reads:
+                query_positions, reference_positions = get_aligned_pairs_array(read)
+                window_start = max(0, read.reference_start - k_rad)
+                window = reference.fetch(read.reference_name, window_start, read.reference_end + k_rad)
+                codes = table.encode(read, query_positions, reference_positions,
+                                     encode_reference(window), window_start)
+                for qpos, refpos, code in zip(query_positions.tolist(), reference_positions.tolist(), codes.tolist()):
+                    key = get_covariate_key(read, qpos, refpos, reference, None, cycle_bin_size=3, k_rad=k_rad)
+                    expected = table.encode_key(key)
+                    self.assertEqual(code, -1 if expected is None else expected)
+                    if code != -1:
+                        self.assertEqual(table.decode(code), key)
+
+    def test_merge_identical_to_single_pass(self):
+        reads = get_test_reads()
+        reference = ReferenceFromMD(reads)
+
+        single = CovariateTable()
+        add_reads(single, reads, reference)
+
+        first, second = CovariateTable(), CovariateTable()
+        add_reads(first, reads[::2], reference)
+        add_reads(second, reads[1::2], reference)
+        # Tables are transferred between processes when the covariates are extracted in parallel:
+        first.merge(pickle.loads(pickle.dumps(second)))
+
+        self.assertTrue(len(single.to_dict()) > 0)
+        self.assertEqual(single.to_dict(), first.to_dict())
+        self.assertTrue((single.counts == first.counts).all())
+
+    def test_recalibrate_vectorised_identical(self):
+        reads = get_test_reads()
+        reference = ReferenceFromMD(reads)
+        covariate_kwargs = {'cycle_bin_size': 3, 'k_rad': 1}
+
+        table = CovariateTable(**covariate_kwargs)
+        add_reads(table, reads, reference)
+        covariate_phreds = covariate_obs_to_phreds(table.to_dict(), k_rad=1)
+        phred_lookup = table.get_phred_lookup(covariate_phreds)
+
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as alignments:
+            for read in alignments:
+                if read.is_unmapped:
+                    continue
+                copy = pysam.AlignedSegment.fromstring(read.to_string(), alignments.header)
+                recalibrate_base_calls(read, reference, covariate_phreds, covariate_kwargs)
+                recalibrate_base_calls_vectorised(copy, reference, phred_lookup, table)
+                self.assertEqual(list(read.query_qualities), list(copy.query_qualities))
+
+
+if __name__ == '__main__':
+    unittest.main()
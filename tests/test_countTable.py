@@ -3,8 +3,16 @@
 import unittest
 from types import SimpleNamespace
 import singlecellmultiomics.bamProcessing.bamToCountTable
+from singlecellmultiomics.countTableProcessing import SparseCountTable
+import collections
+import gzip
+import os
+import tempfile
+import pandas as pd
+import scipy.sparse
 
-from singlecellmultiomics.bamProcessing.bamBinCounts import range_contains_overlap,blacklisted_binning
+from singlecellmultiomics.bamProcessing.bamBinCounts import range_contains_overlap,blacklisted_binning, \
+    bin_count_block_from_dict, bin_count_blocks_to_frame
 
 class TestIterables(unittest.TestCase):
 
@@ -17,6 +25,22 @@ class TestIterables(unittest.TestCase):
             range_contains_overlap( list( blacklisted_binning(0,2000,bin_size,blacklist) ) + blacklist)
         )
 
+    def test_bin_count_blocks(self):
+        jobs = [
+            {('chr1', 0, 100): {'A': 1, 'B': 3}, ('chr1', 100, 200): {'B': 2}},
+            {('chr2', 0, 100): {'C': 5}},
+            {('chr1', 200, 300): {'A': 4, 'C': 1}}
+        ]
+        counts = {}
+        samples, blocks = {}, []
+        for job in jobs:
+            counts.update(job)
+            block = bin_count_block_from_dict(job)
+            blocks.append((block.bin_ids, [samples.setdefault(s, len(samples)) for s in block.samples], block.counts))
+
+        pd.testing.assert_frame_equal(
+            bin_count_blocks_to_frame(blocks, samples), pd.DataFrame(counts).T, check_index_type=False)
+
 
 
 class TestCountTable(unittest.TestCase):
@@ -334,6 +358,66 @@ class TestCountTable(unittest.TestCase):
         self.assertEqual( df.sum(1).sum(), 765 )
         self.assertEqual( df.loc[:,['A3-P15-1-1_25']].sum(skipna=True).sum(skipna=True), 12.0 )
 
+    def test_parallel_counting(self):
+        """ Test if counting using multiple processes yields the same table as counting using a single process """
+        args = dict(
+                alignmentfiles=['./data/mini_nla_test.bam'],
+                o=None,
+                head=None,
+                bin=1000,
+                sliding=250,
+                binTag='DS',
+                byValue=None,
+                bedfile=None,
+                showtags=False,
+                featureTags=None,
+                joinedFeatureTags='reference_name',
+                sampleTags='SM', proper_pairs_only=False, no_indels=False, max_base_edits=None, no_softclips=False,
+                minMQ=0,
+                filterXA=False,
+                dedup=False,
+                divideMultimapping=False,
+                contig=None,
+                blacklist=None,
+                r1only=False,
+                r2only=False,
+                filterMP=False,
+                keepOverBounds=False,
+                doNotDivideFragments=False,
+                splitFeatures=False,
+                feature_delimiter=',',
+                noNames=False)
+        serial = singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(
+            SimpleNamespace(**args), return_df=True)
+        parallel = singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(
+            SimpleNamespace(t=2, shard_size=50_000_000, **args), return_df=True)
+        self.assertTrue(serial.equals(parallel))
+        self.assertEqual(list(serial.index), list(parallel.index))
+        self.assertEqual(list(serial.columns), list(parallel.columns))
+
+    def test_sparse_count_table(self):
+        """ Test if the sparse count table yields the same table as a dictionary of Counters """
+        table = SparseCountTable(buffer_size=3)
+        count_dict = collections.defaultdict(collections.Counter)
+        increments = [(('B',), ('chr1', 0, 10), 1), (('A',), ('chr2', 0, 10), 0.5), (('B',), ('chr2', 0, 10), 2),
+                      (('A',), ('chr1', 0, 10), 1), (('C',), ('chr1', 10, 20), 0), (('B',), ('chr1', 0, 10), 1),
+                      (('C',), ('chr1', 0, 10), 3)]
+        for sample, feature, value in increments:
+            table.add(sample, feature, value)
+            count_dict[sample][feature] += value
+
+        self.assertEqual(len(table), 6)
+        self.assertTrue(table.to_dataframe().equals(pd.DataFrame.from_dict(count_dict)))
+        self.assertEqual(table.to_sparse().sum(), 8.5)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'table.npz')
+            table.write_sparse(path)
+            matrix = scipy.sparse.load_npz(path)
+            self.assertEqual((matrix != table.to_sparse()).nnz, 0)
+            with gzip.open(f'{path}.samples.tsv.gz', 'rt') as f:
+                self.assertEqual(f.read().split(), ['B', 'A', 'C'])
+
 
 
 
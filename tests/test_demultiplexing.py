@@ -6,6 +6,8 @@ from singlecellmultiomics.barcodeFileParser.barcodeFileParser import BarcodePars
 from singlecellmultiomics.modularDemultiplexer.demultiplexModules.CELSeq2 import CELSeq2_c8_u6_NH
 from singlecellmultiomics.modularDemultiplexer.demultiplexModules.scCHIC import SCCHIC_384w_c8_u3_cs2
 from singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods import UmiBarcodeDemuxMethod
+from singlecellmultiomics.modularDemultiplexer.demultiplexingStrategyLoader import DemultiplexingStrategyLoader
+import os
 import pkg_resources
 
 class TestUmiBarcodeDemux(unittest.TestCase):
@@ -177,5 +179,48 @@ class TestUmiBarcodeDemux(unittest.TestCase):
         self.assertEqual( demultiplexed_record[0].tags['bi'], 1)
 
 
+class RecordCollector():
+    def __init__(self):
+        self.records = []
+
+    def write(self, records):
+        self.records.append([str(record) for record in records])
+
+
+class TestDemultiplexingStrategyLoader(unittest.TestCase):
+
+    def test_multiprocess_demultiplex_identical_output(self):
+        barcode_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/barcodes/')
+        index_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/indices/')
+        dmx = DemultiplexingStrategyLoader(barcodeParser=BarcodeParser(barcode_folder),
+                                           indexParser=BarcodeParser(index_folder))
+        strategies = dmx.getSelectedStrategiesFromStringList(['NLAIII384C8U3'], verbose=False)
+
+        # Write read pairs, every third read pair has an invalid barcode:
+        barcodes = ['ACACACTA', 'ACACATAG', 'NNNNNNNN']
+        fastq_paths = ['./data/write_test_demux_R1.fastq', './data/write_test_demux_R2.fastq']
+        with open(fastq_paths[0], 'w') as r1, open(fastq_paths[1], 'w') as r2:
+            for i in range(250):
+                header = f'@NS500414:628:H7YVNBGXC:1:11101:{i}:1046'
+                seq = f'ATC{barcodes[i % 3]}CATGAGCAGGTTCTTCAGGTTCCCTGTAGTTGTGTGG'
+                r1.write(f'{header} 1:N:0:GTGAAA\n{seq}\n+\n{"E" * len(seq)}\n')
+                r2.write(f'{header} 2:N:0:GTGAAA\n{seq[::-1]}\n+\n{"E" * len(seq)}\n')
+
+        outputs = []
+        for n_processes in (1, 2):
+            target, rejects = RecordCollector(), RecordCollector()
+            processed, yields = dmx.demultiplex(fastq_paths, strategies=strategies, library='TEST',
+                                                targetFile=target, rejectHandle=rejects,
+                                                n_processes=n_processes, batch_size=16)
+            outputs.append((processed, yields, target.records, rejects.records))
+        for path in fastq_paths:
+            os.remove(path)
+
+        self.assertEqual(outputs[0][0], 250)
+        self.assertEqual(outputs[0][1]['NLAIII384C8U3'], 167)
+        self.assertEqual(len(outputs[0][3]), 83)
+        self.assertEqual(outputs[0], outputs[1])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import gzip
+import os
+import itertools
+import threading
+from singlecellmultiomics.fastqProcessing.fastqIterator import FastqIterator, FastqBatchIterator, read_fastq_blocks
+from singlecellmultiomics.fastqProcessing.fastqHandle import FastqHandle
+import pysam
+
+
+class TestFastqIterator(unittest.TestCase):
+
+    def test_batch_iterator_identical_records(self):
+        paths = ['./data/write_test_R1.fastq.gz', './data/write_test_R2.fastq']
+        with gzip.open(paths[0], 'wt') as r1, open(paths[1], 'w') as r2:
+            for i in range(100):
+                r1.write(f'@read{i} 1:N:0:GTGAAA\nACGTN{"A" * (i % 7)}\n+\nEEEEE{"E" * (i % 7)}\n')
+                # Trailing whitespace and carriage returns are removed:
+                r2.write(f'@read{i} 2:N:0:GTGAAA \r\nTTGCA\r\n+\r\nAAAAE\r\n')
+
+        expected = list(FastqIterator(*paths))
+        for chunk_size in (1, 7, 4096):
+            for threaded in (True, False):
+                batches = list(FastqBatchIterator(*paths, batch_size=16, chunk_size=chunk_size, threaded=threaded))
+                self.assertTrue(all(len(batch) <= 16 for batch in batches))
+                self.assertEqual(list(itertools.chain.from_iterable(batches)), expected)
+        self.assertEqual(len(expected), 100)
+        self.assertEqual(expected[3][1].header, '@read3 2:N:0:GTGAAA')
+
+        for path in paths:
+            os.remove(path)
+
+    def test_read_blocks_missing_final_newline(self):
+        path = './data/write_test_noeol.fastq'
+        with open(path, 'w') as f:
+            f.write('@a\nACGT\n+\nEEEE\n@b\nTT\n+\nEE')
+        records = list(itertools.chain.from_iterable(read_fastq_blocks(path, chunk_size=3)))
+        os.remove(path)
+        self.assertEqual([record.header for record in records], ['@a', '@b'])
+        self.assertEqual(records[1].qual, 'EE')
+
+    def test_read_blocks_stopped_early(self):
+        path = './data/write_test_stopped.fastq.gz'
+        with gzip.open(path, 'wt') as f:
+            for i in range(1000):
+                f.write(f'@read{i}\nACGTACGT\n+\nEEEEEEEE\n')
+        threads = threading.active_count()
+        # Only consume the first block, the reader thread is waiting for room in the queue
+        blocks = read_fastq_blocks(path, chunk_size=64, threaded=True)
+        self.assertEqual(next(blocks)[0].header, '@read0')
+        self.assertEqual(threading.active_count(), threads + 1)
+        blocks.close()
+        self.assertEqual(threading.active_count(), threads)
+        os.remove(path)
+
+
+class TestFastqHandle(unittest.TestCase):
+
+    def test_threaded_bgzf_output(self):
+        records = [(f'@read{i} 1:N:0\nACGT{"A" * (i % 50)}\n+\nEEEE{"E" * (i % 50)}\n',
+                    f'@read{i} 2:N:0\nTTTT\n+\nEEEE\n') for i in range(5000)]
+        handle = FastqHandle('./data/write_test_bgzf_', True, compression_threads=2)
+        # Use small buffers to obtain many blocks
+        for writer in handle.handles:
+            writer.buffer_size = 1000
+        for pair in records:
+            handle.write(pair)
+        handle.close()
+
+        paths = ['./data/write_test_bgzf_R1.fastq.gz', './data/write_test_bgzf_R2.fastq.gz']
+        for path, expected in zip(paths, zip(*records)):
+            # The output is readable as gzip and as BGZF
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(f.read(), ''.join(expected))
+            with pysam.BGZFile(path) as f:
+                self.assertEqual(f.read().decode(), ''.join(expected))
+        self.assertEqual(len(list(FastqIterator(*paths))), 5000)
+        for path in paths:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
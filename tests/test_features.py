@@ -2,8 +2,9 @@
 # -*- coding: utf-8 -*-
 import unittest
 import itertools
+import os
 
-from singlecellmultiomics.features import FeatureContainer
+from singlecellmultiomics.features import FeatureContainer, GTFStore, IntervalIndex
 
 """
 These tests check if the feature container is working correctly
@@ -162,6 +163,69 @@ class TestFeatureContainer(unittest.TestCase):
         #printFormatted("[BRIGHT]Test for finding closest feature")
         self.expect(  f.findNearestFeature('chr1', 0, None ), '1')
 
+    def test_interval_index_batch(self):
+        starts = [(i * 7919) % 10_000 for i in range(500)]
+        ends = [start + (i * 104729) % [50, 1000, 20_000][i % 3] for i, start in enumerate(starts)]
+        strands = ['+-'[i % 2] for i in range(500)]
+        index = IntervalIndex(starts, ends, strands)
+
+        query_starts = list(range(0, 12_000, 37))
+        query_ends = [start + (start % 5) * 20 for start in query_starts]
+        for strand in (None, '+'):
+            hits = set(zip(*(indices.tolist() for indices in index.query(query_starts, query_ends, strand))))
+            expected = {(query, interval)
+                        for query, (query_start, query_end) in enumerate(zip(query_starts, query_ends))
+                        for interval, (start, end) in enumerate(zip(starts, ends))
+                        if start <= query_end and end >= query_start and strand in (None, strands[interval])}
+            self.assertEqual(hits, expected)
+
+        f = FeatureContainer()
+        f.addFeature('chr1', 10, 1000, 'gene', '+', '')
+        f.addFeature('chr1', 100, 200, 'exonA', '+', '')
+        f.addFeature('chr1', 300, 400, 'exonB', '-', '')
+        f.sort()
+        blocks, features = f.findFeaturesBetweenBatch('chr1', [150, 350, 2000], [160, 450, 2010], '+')
+        self.assertEqual(list(zip(blocks.tolist(), [f.features['chr1'][i][2] for i in features])),
+                         [(0, 'gene'), (0, 'exonA'), (1, 'gene')])
+
+    def test_gtf_store(self):
+        gtf_path, store_path = './data/write_test.gtf', './data/write_test.gtfstore'
+        with open(gtf_path, 'w') as f:
+            f.write('#!genome-build test\n')
+            for i in range(200):
+                contig = ['1', 'chrX'][i % 2]
+                feature_type = ['exon', 'gene', 'transcript'][i % 3]
+                start = (i * 7919) % 100_000 + 1
+                f.write(f'{contig}\thavana\t{feature_type}\t{start}\t{start + (i * 31) % 4000}\t.\t{"+-"[i % 5 > 2]}\t.\t'
+                        f'gene_id "G{i % 20}"; transcript_id "T{i % 50}"; exon_id "E{i}"; tag "basic";\n')
+        GTFStore.create(gtf_path, store_path)
+
+        for kwargs in (dict(),
+                       dict(select_feature_type=['exon'], identifierFields=('exon_id', 'gene_id'), store_all=True),
+                       dict(contig='1', region_start=10_000, region_end=30_000, store_all=True),
+                       dict(contig='chrX', region_start=0, region_end=5000, identifierFields=None)):
+            from_gtf, from_store = FeatureContainer(), FeatureContainer()
+            from_gtf.loadGTF(gtf_path, **kwargs)
+            from_store.loadGTF(store_path, **kwargs)
+            self.assertEqual(sorted(from_gtf.features), sorted(from_store.features))
+            for contig in from_gtf.features:
+                self.assertEqual(sorted(from_gtf.features[contig]), sorted(from_store.features[contig]))
+
+        # Prefetching from the store yields the same features as prefetching from the GTF
+        from_gtf, from_store = FeatureContainer(), FeatureContainer()
+        from_gtf.preload_GTF(path=gtf_path, store_all=True)
+        from_store.preload_GTF(path=store_path, store_all=True)
+        self.assertEqual(from_gtf.prefetch('1', 5000, 6000).features, from_store.prefetch('1', 5000, 6000).features)
+
+        # Loading stops after head features, also when the features are located on multiple contigs
+        from_gtf, from_store = FeatureContainer(), FeatureContainer()
+        from_gtf.loadGTF(gtf_path, head=10, store_all=True)
+        from_store.loadGTF(store_path, head=10, store_all=True)
+        self.assertEqual(sum(len(features) for features in from_gtf.features.values()),
+                         sum(len(features) for features in from_store.features.values()))
+        os.remove(gtf_path)
+        os.remove(store_path)
+
 
 if __name__ == '__main__':
     unittest.main()
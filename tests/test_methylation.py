@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import unittest
-from singlecellmultiomics.methylation import MethylationCountMatrix
+import os
+import pysam
+import pickle
+import numpy as np
+import pandas as pd
+from singlecellmultiomics.methylation import MethylationCountMatrix, SparseMethylationCountMatrix
+from singlecellmultiomics.fastaProcessing import CachedFastaNoHandle, WindowedFastaNoHandle
+from singlecellmultiomics.molecule import TAPS
 
 """
 These tests check if the methylation module is working correctly
@@ -39,6 +46,65 @@ class TestMethylationCountMatrix(unittest.TestCase):
         self.assertEqual(mA.get_bulk_frame()['methylated'].sum(), 3)
         self.assertEqual(mA.get_bulk_frame()['unmethylated'].sum(), 3)
 
+    def test_sparse_matrix(self):
+        dense, sparse = MethylationCountMatrix(), SparseMethylationCountMatrix(buffer_size=7)
+        rng = np.random.default_rng(0)
+        for i in range(500):
+            sample = f'sample_{rng.integers(7)}'
+            start = int(rng.integers(50))
+            location = ('chr1' if start % 3 else 'chr2', start, start + 1)
+            methylated = bool(rng.random() < 0.5)
+            dense[sample, location][methylated] += 1
+            sparse.add(sample, location, methylated)
+
+        other_dense, other_sparse = MethylationCountMatrix(), SparseMethylationCountMatrix()
+        other_dense['sample_new', ('chr3', 10, 11)][1] += 2
+        other_sparse.add('sample_new', ('chr3', 10, 11), True, count=2)
+        dense.update(other_dense)
+        sparse.update(other_sparse)
+
+        for dtype in ('methylated', 'unmethylated', 'beta'):
+            pd.testing.assert_frame_equal(
+                sparse.get_frame(dtype).sort_index().sort_index(axis=1),
+                dense.get_frame(dtype).sort_index().sort_index(axis=1), check_dtype=False)
+        pd.testing.assert_frame_equal(sparse.get_bulk_frame().sort_index(),
+                                      dense.get_bulk_frame().sort_index(), check_dtype=False)
+
+        restored = pickle.loads(pickle.dumps(sparse))
+        pd.testing.assert_frame_equal(restored.get_frame('beta'), sparse.get_frame('beta'))
+
+        dense.prune(min_samples=2, min_variance=0.1)
+        sparse.prune(min_samples=2, min_variance=0.1)
+        pd.testing.assert_frame_equal(
+            sparse.get_frame('beta').sort_index().sort_index(axis=1),
+            dense.get_frame('beta').sort_index().sort_index(axis=1), check_dtype=False)
+
+
+class TestTAPSContext(unittest.TestCase):
+
+    def test_windowed_reference_context_calls(self):
+        sequence = ('ACGTCGCAGCTTCCAGNCGNCCGGATCGcgtaCTGCAAC' * 30)
+        fasta_path = './data/write_test_reference.fa'
+        with open(fasta_path, 'w') as f:
+            f.write('>chr1\n' + '\n'.join(sequence[i:i + 60] for i in range(0, len(sequence), 60)) + '\n')
+
+        reference = CachedFastaNoHandle(fasta_path)
+        # The window contains the region 300-800 and 50 bases of padding
+        windowed = WindowedFastaNoHandle(fasta_path, padding=50).prefetch('chr1', 300, 800)
+        self.assertEqual(windowed.fetch('chr1', 260, 280), sequence[260:280])
+        self.assertEqual(windowed.fetch('chr1', 10, 20), sequence[10:20])
+
+        for taps_strand in 'FR':
+            taps = TAPS(taps_strand=taps_strand)
+            for position in range(0, len(sequence)):
+                for strand in (False, True):
+                    for observed_base in 'CTGA':
+                        self.assertEqual(
+                            taps.position_to_context('chr1', position, observed_base, strand, reference=reference)[1],
+                            taps.position_to_call('chr1', position, observed_base, strand, reference=windowed))
+        os.remove(fasta_path)
+        os.remove(fasta_path + '.fai')
+
 
 
 if __name__ == '__main__':
@@ -6,6 +6,7 @@ import singlecellmultiomics.fragment
 import pysam
 import pysamiterators.iterators
 import os
+import collections
 
 from singlecellmultiomics.molecule import MoleculeIterator, CHICMolecule
 from singlecellmultiomics.fragment import CHICFragment
@@ -367,6 +368,36 @@ class TestMolecule(unittest.TestCase):
 
             self.assertEqual(''.join( list(molecule.get_consensus().values()) ), 'CATGAGTTAGATATGGACTCTTCTTCAGACACTTTGTTTAAATTTTAAATTTTTTTCTGATTGCATATTACTAAAAATGTGTTATGAATATTTTCCATATCATTAAACATTCTTCTCAAGCATAACTTTAAATAACTGCATTATAGAAAATTTACGCTACTTTTGTTTTTGTTTTTTTTTTTTTTTTTTTACTATTATTAATAACACGGTGG')
 
+    def test_base_observation_matrix(self):
+        """Test if the base observation matrix agrees with the observations of the reads"""
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            for molecule in singlecellmultiomics.molecule.MoleculeIterator(
+                    alignments=f,
+                    molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                    fragment_class=singlecellmultiomics.fragment.NlaIIIFragment):
+
+                expected = {}
+                for read in molecule.iter_reads():
+                    for query_pos, ref_pos, ref_base in read.get_aligned_pairs(matches_only=True, with_seq=True):
+                        query_base = read.query_sequence[query_pos]
+                        if query_base != 'N':
+                            expected.setdefault((read.reference_name, ref_pos), []).append(query_base)
+
+                matrices = molecule.get_base_observation_matrix(return_refbases=True)
+                self.assertEqual(sum(int(matrix.counts[:, :4].sum()) for matrix in matrices.values()),
+                                 sum(len(bases) for bases in expected.values()))
+
+                base_obs, ref_bases = molecule.get_base_observation_dict(return_refbases=True)
+                self.assertEqual(set(base_obs), set(expected))
+                for location, bases in expected.items():
+                    self.assertEqual(dict(base_obs[location]), dict(collections.Counter(bases)))
+
+                matches, mismatches = molecule.get_match_mismatch_frequency()
+                self.assertEqual(matches + mismatches, sum(
+                    len(bases) for location, bases in expected.items() if ref_bases[location] in 'ACGT'))
+                self.assertEqual(matches, sum(
+                    bases.count(ref_bases[location]) for location, bases in expected.items()))
+
     def test_fragment_sizes(self):
 
         with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
@@ -493,6 +524,80 @@ class TestMolecule(unittest.TestCase):
     def test_molecule_pooling_nlaIIIoptim_umi_mismatch(self):
         self._pool_test(1,1)
 
+    def test_molecule_pooling_heap_exact_umi(self):
+        self._pool_test(2,0)
+
+    def test_molecule_pooling_heap_umi_mismatch(self):
+        self._pool_test(2,1)
+
+    def test_molecule_pooling_heap_identical_output(self):
+        # The heap based buffer should yield exactly the same molecules in the same order
+        for check_eject_every in [10, 100]:
+            results = []
+            for pooling_method in [1, 2]:
+                with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+                    results.append( [
+                        (molecule.sample, molecule.umi, molecule.span, len(molecule))
+                        for molecule in singlecellmultiomics.molecule.MoleculeIterator(
+                            alignments=f,
+                            molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                            fragment_class=singlecellmultiomics.fragment.NlaIIIFragment,
+                            molecule_class_args={'cache_size':50},
+                            check_eject_every=check_eject_every,
+                            pooling_method=pooling_method)
+                    ])
+            self.assertEqual(results[0], results[1])
+
+    def test_molecule_umi_index_identical_output(self):
+        # Looking up candidate molecules using the UMI index should not change the molecules
+        for hd in [0, 1, 2]:
+            for pooling_method in [1, 2]:
+                results = []
+                for index_umis in [False, True]:
+                    with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+                        results.append( [
+                            (molecule.sample, molecule.umi, molecule.span, len(molecule))
+                            for molecule in singlecellmultiomics.molecule.MoleculeIterator(
+                                alignments=f,
+                                molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                                fragment_class=singlecellmultiomics.fragment.NlaIIIFragment,
+                                fragment_class_args={'umi_hamming_distance':hd},
+                                pooling_method=pooling_method,
+                                index_umis=index_umis)
+                        ])
+                self.assertEqual(results[0], results[1])
+
+    def test_transcript_annotation_batch_identical_output(self):
+        # Annotating the fragments in batches should not change the annotations
+        import singlecellmultiomics.features
+        features = singlecellmultiomics.features.FeatureContainer()
+        for i, start in enumerate(range(164834600, 164835600, 100)):
+            for feature_type, offset, strand in (('exon', 0, '+'), ('intron', 60, '+'), ('exon', 30, '-')):
+                meta = (('gene_id', f'G{i // 3}'), ('transcript_id', f'T{i // 3}'), ('exon_id', f'E{i}{strand}'), ('type', feature_type))
+                features.addFeature('chr1', start + offset, start + offset + 50, name=f'{feature_type}{i}', strand=strand, data=meta)
+        features.sort()
+
+        results = []
+        for annotation_batch_size in [None, 7, 1000]:
+            with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+                molecules = []
+                for molecule in singlecellmultiomics.molecule.MoleculeIterator(
+                        alignments=f,
+                        molecule_class=singlecellmultiomics.molecule.TranscriptMolecule,
+                        fragment_class=singlecellmultiomics.fragment.SingleEndTranscriptFragment,
+                        fragment_class_args={'features': features, 'stranded': True, 'auto_set_intron_exon_features': True},
+                        annotation_batch_size=annotation_batch_size):
+                    molecule.write_tags()
+                    molecules.append([(read.query_name, read.get_tag('GN') if read.has_tag('GN') else None,
+                                       read.get_tag('EX') if read.has_tag('EX') else None,
+                                       read.get_tag('IN') if read.has_tag('IN') else None,
+                                       read.get_tag('JN') if read.has_tag('JN') else None)
+                                      for read in molecule.iter_reads()])
+            results.append(molecules)
+        self.assertTrue(any(read[1] is not None for molecule in results[0] for read in molecule))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
     def test_max_associated_fragments(self):
 
         for i in range(1,3):
@@ -4,8 +4,13 @@ import unittest
 import itertools
 import pysam
 import os
+import shutil
+import collections
 import singlecellmultiomics.universalBamTagger.universalBamTagger as ut
 import singlecellmultiomics.universalBamTagger.bamtagmultiome as tm
+from singlecellmultiomics.bamProcessing.moleculeSummary import MoleculeSummary, MoleculeSummaryWriter
+from singlecellmultiomics.bamProcessing.bamFunctions import get_r1_counts_per_cell
+from singlecellmultiomics.bamProcessing.bamAnalyzeCutDistances import get_sc_cut_dictionary
 
 """
 These tests check if the tagger is working correctly
@@ -201,6 +206,54 @@ class TestMultiomeTaggingNLA(unittest.TestCase):
         os.remove(write_path)
         os.remove(write_path+'.bai')
 
+    def test_molecule_summary_multi_process(self):
+        write_path = './data/write_test_summary.bam'
+        summary_path = './data/write_test_summary.molecules'
+        tm.run_multiome_tagging_cmd(f'./data/mini_nla_test.bam --multiprocess -output_assembly concatenate -method nla -molecule_summary {summary_path} -o {write_path}'.split(' '))
+
+        summary = MoleculeSummary(summary_path)
+        molecules = summary.fetch()
+        self.assertEqual(len(molecules), len(summary))
+        self.assertEqual(summary.get_contigs(), ['chr1'])
+        self.assertTrue( (molecules['af'] >= 1).all() )
+
+        with pysam.AlignmentFile(write_path) as f:
+            written = collections.Counter(
+                (read.get_tag('SM'), read.get_tag('DS'), read.get_tag('RX'), read.get_tag('af'))
+                for read in f if read.is_read1 and read.get_tag('RC') == 0)
+        self.assertEqual(written, collections.Counter(zip(molecules['sample'], molecules['DS'],
+                                                          molecules['umi'], molecules['af'])))
+
+        # The summary yields the same results as reading the bam file:
+        self.assertEqual(get_r1_counts_per_cell(write_path), get_r1_counts_per_cell(summary_path))
+        for strand_specific in (False, True):
+            from_bam = get_sc_cut_dictionary(write_path, strand_specific=strand_specific)
+            from_summary = get_sc_cut_dictionary(summary_path, strand_specific=strand_specific)
+            self.assertEqual(
+                {contig: dict(cuts) for contig, cuts in from_bam.items()},
+                {contig: dict(cuts) for contig, cuts in from_summary.items()})
+
+        # Region queries only return molecules with a site in the region:
+        region = summary.fetch('chr1', 164834865, 164834900, columns=['DS'])
+        self.assertTrue( len(region) > 0 )
+        self.assertTrue( ((region['DS'] >= 164834865) & (region['DS'] < 164834900)).all() )
+        self.assertEqual(len(summary.fetch('chr2')), 0)
+
+        # Tagging again into the same folder replaces the summary:
+        os.remove(write_path)
+        os.remove(write_path+'.bai')
+        tm.run_multiome_tagging_cmd(f'./data/mini_nla_test.bam --multiprocess -output_assembly concatenate -method nla -molecule_summary {summary_path} -o {write_path}'.split(' '))
+        self.assertEqual(len(MoleculeSummary(summary_path)), len(summary))
+
+        # A folder which is not a summary is not overwritten:
+        self.assertFalse(MoleculeSummary.is_summary('./data'))
+        with self.assertRaises(ValueError):
+            MoleculeSummaryWriter.create_summary_folder('./data')
+
+        os.remove(write_path)
+        os.remove(write_path+'.bai')
+        shutil.rmtree(summary_path)
+
 
 if __name__ == '__main__':
     unittest.main()